@@ -1,15 +1,19 @@
 # Simple script to run the youtube_follower package
-from youtube_follower import youtube_follower
+from youtube_follower.orchestrator import run_batch
 from youtube_follower.utils import get_top_news_videos
 
 root_videos = get_top_news_videos()
 
-for video_id in root_videos:
-    yf = youtube_follower.YoutubeFollower(
-    	    root_id=video_id,
-            n_splits=4,
-            depth=20,
-            const_depth=5,
-            sample=True)
-    yf.run()
-
+# crawl the roots in parallel; the top news trees overlap heavily, so the
+# workers share a cache of scraped recommendations and API metadata
+run_batch(root_videos,
+          n_workers=4,
+          fetch_rate=10,
+          cache_path='data/cache.sqlite',
+          crawl_kwargs=dict(
+              n_splits=4,
+              depth=20,
+              const_depth=5,
+              sample=True,
+              n_workers=8,
+              pipeline=True))
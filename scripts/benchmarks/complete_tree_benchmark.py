@@ -0,0 +1,156 @@
+# Benchmark of complete_tree (scripts/data_preparation/complete_tree.py) on
+# large synthetic crawl trees, against the original per-video implementation
+# (kept below as legacy_complete_tree). Both are run with the same seed and
+# their outputs must be identical.
+#
+# The trees are built the way the crawler builds them: breadth first from a
+# root, n_splits recommendations per video, one sampled recommendation from
+# const_depth on, empty recommendations (a None row) for leaves, and videos
+# seen before in the search not followed again.
+#
+# The legacy implementation is quadratic in the rows it adds, so it is only run
+# on the smaller trees (see --legacy-max-rows).
+#
+# usage: python complete_tree_benchmark.py [--n-videos N] [--seed S] [--legacy-max-rows R]
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '../data_preparation'))
+
+from complete_tree import complete_tree, complete_tree_setup
+
+# (n_splits, depth, const_depth)
+CONFIGS = [(3, 5, 5), (4, 6, 6), (3, 10, 4), (3, 20, 5), (4, 20, 5), (5, 20, 5)]
+
+
+def synthetic_tree(n_splits, depth, const_depth, n_videos=20000, seed=0):
+	"""
+	Truncated recommendation tree of a crawl over a random graph
+
+	INPUT:
+		n_splits, depth, const_depth: crawl parameters (the crawl samples)
+		n_videos: (int) videos in the graph; fewer means more revisits
+		seed: (int)
+
+	OUTPUT:
+		(pd.DataFrame) rows like the recommendations table
+		(columns=['video_id', 'recommendation', 'depth'])
+	"""
+	rng = np.random.RandomState(seed)
+	related = rng.randint(0, n_videos, size=(n_videos, n_splits))
+	seen = {0}
+	level = [0]
+	rows = []
+	for d in range(depth + 1):
+		next_level = []
+		for video in level:
+			if d == depth:
+				rows.append(('v{}'.format(video), None, d))
+				continue
+			recs = related[video]
+			if d >= const_depth:
+				recs = recs[rng.randint(0, n_splits, size=1)]
+			for rec in recs:
+				rows.append(('v{}'.format(video), 'v{}'.format(rec), d))
+				if rec not in seen:
+					seen.add(rec)
+					next_level.append(rec)
+		level = next_level
+	return pd.DataFrame(rows, columns=['video_id', 'recommendation', 'depth'])
+
+
+def list_difference(l1, l2):
+	return [i for i in l1 if not i in l2 or l2.remove(i)]
+
+
+def legacy_complete_tree(df, search_id, n_splits=4, max_depth=20, const_depth=5, rng=np.random):
+	"""
+	complete_tree before vectorization, with pd.concat in place of the removed
+	DataFrame.append and the RNG as an argument
+	"""
+	res = complete_tree_setup(df)[0]
+	vid_depths = (df[['video_id', 'depth']]
+				  .drop_duplicates()
+				  .set_index('video_id')
+				  .depth
+				  .to_dict())
+	vid_recs = (df[['video_id', 'recommendation']]
+				.groupby('video_id')
+				.agg(lambda x: list(x))
+				.recommendation
+				.to_dict())
+	v_id = max(res.vertex_id.values)
+	prev_recs = []
+	for depth in range(max_depth + 1):
+		parent_ids = list((res
+						   .query('depth == @depth')
+						   .video_id
+						   .unique()))
+		truncd_ids = list_difference(prev_recs, parent_ids)
+		for video_id in truncd_ids:
+			v_id += 1
+			if video_id is None or video_id not in vid_recs:
+				continue
+			recs = vid_recs[video_id]
+			source_depth = vid_depths[video_id]
+			if depth >= const_depth and source_depth < const_depth:
+				recs = rng.choice(recs, 1)
+			if not recs:
+				to_append_l = [[video_id, depth, v_id, None]]
+			else:
+				to_append_l = [[video_id, depth, v_id, rec] for rec in recs]
+			to_append = pd.DataFrame(to_append_l,
+									 columns=['video_id','depth','vertex_id','recommendation'])
+			res = pd.concat([res, to_append])
+		prev_recs = list(res
+						 .query('depth == @depth')
+						 .recommendation
+						 .values)
+	res = res.assign(search_id=search_id).sort_values(['depth', 'video_id'])
+	return res
+
+
+def normalized(res):
+	"""
+	res with plain values, so outputs can be compared regardless of dtypes
+	"""
+	res = res.astype({'video_id': object, 'recommendation': object})
+	res['recommendation'] = res.recommendation.where(res.recommendation.notna(), None).map(
+		lambda rec: rec if rec is None else str(rec))
+	return res
+
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description='complete_tree benchmark on synthetic trees')
+	parser.add_argument('--n-videos', type=int, default=20000, help='videos in the synthetic graph')
+	parser.add_argument('--seed', type=int, default=0)
+	parser.add_argument('--legacy-max-rows', type=int, default=20000,
+						help='only run the legacy implementation on full trees up to this size')
+	args = parser.parse_args()
+
+	print('{:>8} {:>6} {:>6} {:>8} {:>8} {:>10} {:>10} {:>8}'.format(
+		'n_splits', 'depth', 'const', 'rows', 'full', 'legacy s', 'vector s', 'speedup'))
+	for n_splits, depth, const_depth in CONFIGS:
+		df = synthetic_tree(n_splits, depth, const_depth, args.n_videos, args.seed)
+		kwargs = dict(n_splits=n_splits, max_depth=depth, const_depth=const_depth)
+
+		start = time.perf_counter()
+		res = complete_tree(df, 1, rng=np.random.RandomState(args.seed), **kwargs)
+		seconds = time.perf_counter() - start
+
+		if len(res) > args.legacy_max_rows:
+			legacy_seconds = float('nan')
+		else:
+			start = time.perf_counter()
+			legacy = legacy_complete_tree(df, 1, rng=np.random.RandomState(args.seed), **kwargs)
+			legacy_seconds = time.perf_counter() - start
+			pd.testing.assert_frame_equal(normalized(res), normalized(legacy), check_dtype=False)
+
+		print('{:>8} {:>6} {:>6} {:>8} {:>8} {:>10.2f} {:>10.3f} {:>7.0f}x'.format(
+			n_splits, depth, const_depth, len(df), len(res), legacy_seconds, seconds,
+			legacy_seconds / seconds), flush=True)
@@ -0,0 +1,149 @@
+# End-to-end benchmark of YoutubeFollower.run against the local stand-in for
+# YouTube (fake_youtube.py), so performance changes can be checked offline.
+#
+# The watch-page server runs in its own process. Each crawl configuration
+# runs in a fresh process, with its own database and the fake API client
+# installed, and we report:
+#   nodes/s     videos in the tree per second of wall time
+#   api/node    Data API calls per video in the tree
+#   peak MB     peak RSS of the crawling process
+#   db s        seconds spent writing to the database
+#
+# usage: python crawl_benchmark.py [--n-videos N] [--latency S] [--error-rate P] ...
+#        (python crawl_benchmark.py -h for all options)
+import argparse
+import multiprocessing
+import os
+import queue
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '../..'))
+
+import fake_youtube
+
+# (n_splits, depth, sample); sampled crawls branch until depth 3
+CONFIGS = [(3, 4, False), (4, 4, False), (3, 5, False), (3, 10, True), (4, 10, True)]
+CONST_DEPTH = 3
+
+
+def run_server(args, urls):
+	graph = fake_youtube.FakeGraph(args.n_videos, n_related=args.n_related, skew=args.skew)
+	server = fake_youtube.serve(graph, latency=args.latency, error_rate=args.error_rate)
+	urls.put(server.watch_url)
+	while True:
+		time.sleep(3600)
+
+
+class Timer():
+	"""
+	Accumulates the time spent in the functions it wraps, counting nested
+	calls of wrapped functions once
+	"""
+	def __init__(self):
+		self.seconds = 0
+		self.depth = 0
+
+	def wrap(self, fn):
+		def timed(*args, **kwargs):
+			self.depth += 1
+			start = time.perf_counter()
+			try:
+				return fn(*args, **kwargs)
+			finally:
+				self.depth -= 1
+				if self.depth == 0:
+					self.seconds += time.perf_counter() - start
+		return timed
+
+
+def crawl(args, config, watch_url, results):
+	"""
+	Runs one crawl (in a fresh process) and puts its measurements on results
+	"""
+	from youtube_follower import db_utils, utils
+	from youtube_follower.scheduler import Scheduler
+	from youtube_follower.youtube_follower import YoutubeFollower
+
+	n_splits, depth, sample = config
+	workdir = tempfile.mkdtemp(prefix='crawl_benchmark_')
+	os.chdir(workdir)
+	db_path = os.path.join(workdir, 'crawl.sqlite')
+	# creates the tables
+	db_utils.create_connection(db_path).close()
+
+	graph = fake_youtube.FakeGraph(args.n_videos, n_related=args.n_related, skew=args.skew)
+	client = fake_youtube.FakeClient(graph, latency=args.api_latency, error_rate=args.error_rate)
+	utils.set_client(client)
+	# pace nothing: the stand-in's latency is what we are measuring against
+	utils.scheduler = Scheduler(api_rate=1e6, fetch_rate=1e6, daily_quota=1e9)
+
+	# the database writes of every mode go through these
+	timer = Timer()
+	db_utils.create_record = timer.wrap(db_utils.create_record)
+	db_utils.save_checkpoint = timer.wrap(db_utils.save_checkpoint)
+	db_utils.BatchWriter.flush = timer.wrap(db_utils.BatchWriter.flush)
+	YoutubeFollower.save_results = timer.wrap(YoutubeFollower.save_results)
+
+	start = time.time()
+	yf = YoutubeFollower(graph.video_id(1), n_splits=n_splits, depth=depth,
+						 const_depth=CONST_DEPTH, sample=sample, verbose=0,
+						 db_path=db_path, n_workers=args.n_workers,
+						 pipeline=args.pipeline, stream=args.stream, seed=0,
+						 watch_url=watch_url)
+	yf.run()
+	seconds = time.time() - start
+
+	results.put({'nodes': len(yf.search_info),
+				 'seconds': seconds,
+				 'api_calls': sum(client.calls.values()),
+				 # kilobytes on linux
+				 'peak_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+				 'db_seconds': timer.seconds})
+	shutil.rmtree(workdir)
+
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description='Crawl benchmark against a local stand-in for YouTube')
+	parser.add_argument('--n-videos', type=int, default=100000, help='videos in the fake graph')
+	parser.add_argument('--n-related', type=int, default=20, help='recommendations per watch page')
+	parser.add_argument('--skew', type=float, default=1.0,
+						help='> 1 concentrates recommendations on popular videos')
+	parser.add_argument('--latency', type=float, default=0.05, help='mean watch-page latency (s)')
+	parser.add_argument('--api-latency', type=float, default=0.1, help='mean API call latency (s)')
+	parser.add_argument('--error-rate', type=float, default=0, help='fraction of requests failing with 503')
+	parser.add_argument('--n-workers', type=int, default=8, help='concurrent watch-page fetches')
+	parser.add_argument('--pipeline', action='store_true', help='fetch metadata during the crawl')
+	parser.add_argument('--stream', action='store_true', help='stream rows to the database')
+	args = parser.parse_args()
+
+	ctx = multiprocessing.get_context('spawn')
+	urls = ctx.Queue()
+	server = ctx.Process(target=run_server, args=(args, urls), daemon=True)
+	server.start()
+	watch_url = urls.get()
+
+	print('{:>8} {:>6} {:>7} {:>7} {:>8} {:>9} {:>9} {:>8} {:>7}'.format(
+		'n_splits', 'depth', 'sample', 'nodes', 'seconds', 'nodes/s', 'api/node', 'peak MB', 'db s'))
+	try:
+		for config in CONFIGS:
+			results = ctx.Queue()
+			proc = ctx.Process(target=crawl, args=(args, config, watch_url, results))
+			proc.start()
+			while True:
+				try:
+					result = results.get(timeout=1)
+					break
+				except queue.Empty:
+					if not proc.is_alive():
+						raise RuntimeError('crawl {} failed'.format(config))
+			proc.join()
+			print('{:>8} {:>6} {:>7} {:>7} {:>8.1f} {:>9.1f} {:>9.2f} {:>8.0f} {:>7.2f}'.format(
+				config[0], config[1], str(config[2]), result['nodes'], result['seconds'],
+				result['nodes'] / result['seconds'], result['api_calls'] / result['nodes'],
+				result['peak_mb'], result['db_seconds']))
+	finally:
+		server.terminate()
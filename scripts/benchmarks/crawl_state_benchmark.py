@@ -0,0 +1,109 @@
+# Memory of the crawler's in-memory state (youtube_follower/crawl_state.py)
+# against the dicts of dicts it used to keep, per visited video.
+#
+# The state of an unsampled crawl of n_nodes videos is built both ways, from
+# the same synthetic graph as frontier_benchmark.py: every video recommends
+# n_splits others (as freshly parsed strings, like the crawler gets them) and
+# has the metadata fields utils.get_metadata returns, with short values. Its
+# channel is one of n_nodes / 20. Memory is measured with tracemalloc,
+# including the strings, so the metadata values count the same both ways.
+# Streaming crawls only keep the depth of each video and its channel_id.
+#
+# usage: python crawl_state_benchmark.py [n_nodes] [n_splits]
+import os
+import sys
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '../..'))
+
+from frontier_benchmark import recommendations
+from youtube_follower.crawl_state import ChannelRecord, MetadataTable, SearchInfo, VideoRecord
+
+SEARCH_ID = 1
+
+
+def video_metadata(node, n_nodes):
+	return {'title': 'title {}'.format(node),
+			'postdate': '2019-01-01T00:00:00Z',
+			'description': 'description {}'.format(node),
+			'category': str(node % 30),
+			'channel_id': 'UC{:022d}'.format(node % max(n_nodes // 20, 1)),
+			'likes': str(node), 'dislikes': str(node), 'views': str(node), 'n_comments': str(node)}
+
+
+def channel_metadata(channel):
+	return {'name': 'channel {}'.format(channel), 'country': 'US',
+			'date_created': '2010-01-01T00:00:00Z', 'n_subscribers': str(channel),
+			'n_videos': str(channel), 'n_views': str(channel), 'categories': ['Politics']}
+
+
+def build(n_nodes, n_splits, compact, stream):
+	"""
+	Builds the state of a crawl of n_nodes videos: yields search_info,
+	video_info and channel_info in turn, as each is filled in
+	"""
+	if compact:
+		search_info = SearchInfo(SEARCH_ID, recommendations=not stream)
+		video_info = MetadataTable(VideoRecord, ids=search_info.ids)
+		channel_info = MetadataTable(ChannelRecord)
+	else:
+		search_info, video_info, channel_info = {}, {}, {}
+
+	for node in range(n_nodes):
+		video_id = 'v{:010d}'.format(node)
+		recs = recommendations(node, n_nodes, n_splits)
+		depth = node.bit_length()
+		if compact:
+			search_info.add(video_id, [] if stream else recs, depth)
+		elif stream:
+			search_info[video_id] = {'depth': depth}
+		else:
+			search_info[video_id] = {'search_id': SEARCH_ID, 'recommendations': recs, 'depth': depth}
+	yield search_info
+
+	for node in range(n_nodes):
+		data = video_metadata(node, n_nodes)
+		if stream:
+			data = {'channel_id': data['channel_id']}
+		elif not compact:
+			data['search_id'] = SEARCH_ID
+		video_info.update({'v{:010d}'.format(node): data})
+	yield video_info
+
+	for channel in range(max(n_nodes // 20, 1)):
+		data = {} if stream else channel_metadata(channel)
+		if not stream and not compact:
+			data['search_id'] = SEARCH_ID
+		channel_info.update({'UC{:022d}'.format(channel): data})
+	yield channel_info
+
+
+def measure(n_nodes, n_splits, compact, stream):
+	"""
+	Bytes per visited video of each part of the state
+	"""
+	sizes = []
+	tracemalloc.start()
+	before = tracemalloc.get_traced_memory()[0]
+	state = []
+	for part in build(n_nodes, n_splits, compact, stream):
+		state.append(part)
+		now = tracemalloc.get_traced_memory()[0]
+		sizes.append((now - before) / n_nodes)
+		before = now
+	tracemalloc.stop()
+	return sizes
+
+
+if __name__ == "__main__":
+	n_nodes = int(sys.argv[1]) if len(sys.argv) > 1 else 10**5
+	n_splits = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+
+	print('bytes per node, {} videos, {} recommendations each'.format(n_nodes, n_splits))
+	print('{:>8} {:>8} {:>12} {:>12} {:>12} {:>8}'.format(
+		'stream', 'state', 'search_info', 'video_info', 'channel_info', 'total'))
+	for stream in [False, True]:
+		for compact in [False, True]:
+			sizes = measure(n_nodes, n_splits, compact, stream)
+			print('{:>8} {:>8} {:>12.0f} {:>12.0f} {:>12.0f} {:>8.0f}'.format(
+				str(stream), 'compact' if compact else 'dict', *sizes, sum(sizes)), flush=True)
@@ -0,0 +1,61 @@
+# Benchmarks recommendation extraction on synthetic watch pages (see
+# watch_pages.fixture_pages):
+# the streaming extractor (youtube_follower.extract) against a full
+# BeautifulSoup parse + parse_soup with each of the crawler's parsers.
+# Also reports how much of each page the extractor had to read.
+#
+# usage: python extract_benchmark.py [n_splits] [repeats]
+import io
+import logging
+import os
+import sys
+import time
+from types import SimpleNamespace
+
+from bs4 import BeautifulSoup
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '../..'))
+
+from youtube_follower import extract
+from youtube_follower.youtube_follower import YoutubeFollower
+
+from watch_pages import fixture_pages
+
+
+def best_of(fn, repeats):
+	"""
+	Returns (result, fastest wall time in seconds) over repeats calls of fn
+	"""
+	times = []
+	for _ in range(repeats):
+		start = time.perf_counter()
+		result = fn()
+		times.append(time.perf_counter() - start)
+	return result, min(times)
+
+
+if __name__ == "__main__":
+	n_splits = int(sys.argv[1]) if len(sys.argv) > 1 else 4
+	repeats = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+
+	# parse_soup only needs n_splits and a logger from the follower
+	follower = SimpleNamespace(n_splits=n_splits, logger=logging.getLogger('benchmark'))
+
+	print('{:<22} {:>11} {:>12} {:>12} {:>8}'.format(
+		'fixture', 'method', 'ms / page', 'bytes read', 'speedup'))
+	for name, html in sorted(fixture_pages()):
+		html = html.encode('utf-8')
+
+		recs, fast = best_of(
+			lambda: extract.read_recommendations(io.BytesIO(html), n_splits), repeats)
+		recs, read = recs
+		print('{:<22} {:>11} {:>12.3f} {:>12} {:>8}'.format(
+			name, 'stream', fast * 1e3, len(read), ''))
+
+		for parser in ['lxml', 'html.parser', 'html5lib']:
+			soup_recs, slow = best_of(
+				lambda: YoutubeFollower.parse_soup(follower, BeautifulSoup(html, parser)),
+				repeats)
+			assert soup_recs == recs, 'extractor disagrees with {}'.format(parser)
+			print('{:<22} {:>11} {:>12.3f} {:>12} {:>7.0f}x'.format(
+				name, parser, slow * 1e3, len(html), slow / fast))
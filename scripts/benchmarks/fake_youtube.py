@@ -0,0 +1,272 @@
+# Local stand-in for YouTube, so the crawler can be run and timed offline.
+#
+# FakeGraph is a deterministic synthetic recommendation graph: every video
+# recommends n_related others and belongs to one of n_channels channels.
+# serve() runs an HTTP server with watch pages for it (rendered like the
+# extract benchmark's pages, see watch_pages.py) and FakeClient answers the Data API calls the
+# crawler makes (install it with youtube_follower.utils.set_client). Both can
+# add latency and fail a fraction of requests with 503s.
+#
+# usage: python fake_youtube.py [port] [n_videos]   (serves until interrupted)
+import json
+import random
+import sys
+import threading
+import time
+import zlib
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import urlparse, parse_qs
+
+from googleapiclient.errors import HttpError
+
+from watch_pages import render_watch_page
+
+# filler variants for the rendered pages
+N_TEMPLATES = 16
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+	# http.server has this from Python 3.7 only
+	daemon_threads = True
+
+
+def lcg(x):
+	return (6364136223846793005 * x + 1442695040888963407) % (1 << 64)
+
+
+class FakeGraph():
+	def __init__(self, n_videos=100000, n_related=20, n_channels=1000, skew=1.0, seed=0):
+		"""
+		INPUT:
+			n_videos: (int) number of videos
+			n_related: (int) recommendations on each watch page
+			n_channels: (int) number of channels the videos are spread over
+			skew: (float) 1 recommends videos uniformly; larger values
+				  concentrate recommendations on a few popular videos, so
+				  crawls revisit more
+			seed: (int) picks a different graph of the same shape
+		"""
+		self.n_videos = n_videos
+		self.n_related = n_related
+		self.n_channels = n_channels
+		self.skew = skew
+		self.seed = seed
+
+	def video_id(self, index):
+		return 'v{:010d}'.format(index)
+
+	def index(self, video_id):
+		"""
+		Index of video_id, or None if it is not in the graph
+		"""
+		if len(video_id) != 11 or video_id[0] != 'v' or not video_id[1:].isdigit():
+			return None
+		index = int(video_id[1:])
+		return index if index < self.n_videos else None
+
+	def related(self, video_id):
+		"""
+		Recommended video_ids of video_id, in sidebar order
+		"""
+		x = lcg(self.index(video_id) ^ (self.seed << 32))
+		recs = []
+		for _ in range(self.n_related):
+			x = lcg(x)
+			u = (x >> 11) / float(1 << 53)
+			recs.append(self.video_id(int(self.n_videos * u ** self.skew)))
+		return recs
+
+	def channel_id(self, video_id):
+		return 'UC{:022d}'.format(lcg(self.index(video_id) + self.seed) % self.n_channels)
+
+	def page(self, video_id, script_kb=120, comments=40):
+		"""
+		Watch page html (bytes) of video_id
+		"""
+		return render_watch_page(video_id, self.related(video_id),
+								 seed=self.index(video_id) % N_TEMPLATES,
+								 script_kb=script_kb, comments=comments).encode('utf-8')
+
+
+def delay(latency):
+	"""
+	Sleeps for about latency seconds (uniform between half and 1.5 times it)
+	"""
+	if latency > 0:
+		time.sleep(random.uniform(0.5, 1.5) * latency)
+
+
+def serve(graph, port=0, latency=0, error_rate=0, script_kb=120, comments=40):
+	"""
+	Serves watch pages for graph at http://127.0.0.1:port/watch?v=<video_id> on
+	a background thread. Unknown videos get a 404.
+
+	INPUT:
+		graph: (FakeGraph)
+		port: (int) 0 to pick a free port
+		latency: (float) mean seconds before each response
+		error_rate: (float) fraction of requests answered with a 503
+		script_kb, comments: page size, see watch_pages.render_watch_page
+
+	OUTPUT:
+		server: (ThreadingHTTPServer) with a watch_url attribute to hand to
+				YoutubeFollower; call shutdown() to stop it
+	"""
+	class Handler(BaseHTTPRequestHandler):
+		def do_GET(self):
+			delay(latency)
+			url = urlparse(self.path)
+			video_id = parse_qs(url.query).get('v', [''])[0]
+			if random.random() < error_rate:
+				self.send_error(503)
+			elif url.path != '/watch' or graph.index(video_id) is None:
+				self.send_error(404)
+			else:
+				body = graph.page(video_id, script_kb, comments)
+				self.send_response(200)
+				self.send_header('Content-Type', 'text/html; charset=utf-8')
+				self.send_header('Content-Length', str(len(body)))
+				self.end_headers()
+				self.wfile.write(body)
+
+		def log_message(self, format, *args):
+			pass
+
+	server = ThreadingHTTPServer(('127.0.0.1', port), Handler)
+	server.watch_url = 'http://127.0.0.1:{}/watch?v={{}}'.format(server.server_address[1])
+	threading.Thread(target=server.serve_forever, daemon=True).start()
+	return server
+
+
+class FakeResponse(dict):
+	def __init__(self, status):
+		self.status = status
+		self.reason = 'Service Unavailable'
+
+
+class FakeRequest():
+	def __init__(self, client, method, handler, kwargs):
+		self.client = client
+		self.method = method
+		self.handler = handler
+		self.kwargs = kwargs
+
+	def execute(self):
+		delay(self.client.latency)
+		with self.client.lock:
+			self.client.calls[self.method] = self.client.calls.get(self.method, 0) + 1
+		if random.random() < self.client.error_rate:
+			content = json.dumps({'error': {'errors': [{'reason': 'backendError'}]}})
+			raise HttpError(FakeResponse(503), content.encode('utf-8'))
+		return {'items': self.handler(**self.kwargs)}
+
+
+class FakeResource():
+	def __init__(self, client, name):
+		self.client = client
+		self.name = name
+
+	def list(self, **kwargs):
+		return FakeRequest(self.client, self.name + '.list',
+						   getattr(self.client, '_' + self.name), kwargs)
+
+
+class FakeClient():
+	def __init__(self, graph, latency=0, error_rate=0):
+		"""
+		Answers the Data API calls the crawler makes with metadata for graph.
+		Counts the calls per method in calls.
+
+		INPUT:
+			graph: (FakeGraph)
+			latency: (float) mean seconds per call
+			error_rate: (float) fraction of calls failing with a 503
+		"""
+		self.graph = graph
+		self.latency = latency
+		self.error_rate = error_rate
+		self.calls = {}
+		self.lock = threading.Lock()
+
+	def videos(self):
+		return FakeResource(self, 'videos')
+
+	def channels(self):
+		return FakeResource(self, 'channels')
+
+	def playlistItems(self):
+		return FakeResource(self, 'playlistItems')
+
+	def search(self):
+		return FakeResource(self, 'search')
+
+	def commentThreads(self):
+		return FakeResource(self, 'commentThreads')
+
+	def _videos(self, id, part, **kwargs):
+		items = []
+		for video_id in id.split(','):
+			video_id = video_id.strip()
+			index = self.graph.index(video_id)
+			if index is None:
+				continue
+			item = {'id': video_id}
+			if 'snippet' in part:
+				item['snippet'] = {'title': 'Video {}'.format(index),
+								   'publishedAt': '2019-01-01T00:00:00.000Z',
+								   'description': 'Description of video {}'.format(index),
+								   'categoryId': str(25 + index % 3),
+								   'channelId': self.graph.channel_id(video_id)}
+			if 'statistics' in part:
+				item['statistics'] = {'likeCount': str(index % 997),
+									  'dislikeCount': str(index % 97),
+									  'viewCount': str(index % 99991),
+									  'commentCount': str(index % 991)}
+			items.append(item)
+		return items
+
+	def _channels(self, id, part, **kwargs):
+		items = []
+		for channel_id in id.split(','):
+			index = int(channel_id.strip()[2:])
+			item = {'id': channel_id.strip()}
+			if 'snippet' in part:
+				item['snippet'] = {'title': 'Channel {}'.format(index), 'country': 'US',
+								   'publishedAt': '2010-01-01T00:00:00.000Z'}
+			if 'statistics' in part:
+				item['statistics'] = {'subscriberCount': str(index * 10),
+									  'videoCount': str(index % 500),
+									  'viewCount': str(index * 1000)}
+			if 'topicDetails' in part and index % 4:
+				item['topicDetails'] = {'topicCategories': [
+					'https://en.wikipedia.org/wiki/Politics',
+					'https://en.wikipedia.org/wiki/Society'][:index % 2 + 1]}
+			items.append(item)
+		return items
+
+	def _playlistItems(self, playlistId, maxResults=5, **kwargs):
+		start = zlib.crc32(playlistId.encode('utf-8')) % self.graph.n_videos
+		return [{'contentDetails': {'videoId': self.graph.video_id((start + i) % self.graph.n_videos)}}
+				for i in range(maxResults)]
+
+	def _search(self, q, maxResults=5, **kwargs):
+		start = zlib.crc32(q.encode('utf-8')) % self.graph.n_videos
+		return [{'id': {'videoId': self.graph.video_id((start + i) % self.graph.n_videos)},
+				 'snippet': {'title': q}} for i in range(maxResults)]
+
+	def _commentThreads(self, videoId, maxResults=5, **kwargs):
+		return [{'snippet': {'topLevelComment': {'snippet': {'textOriginal': 'Comment {}'.format(i)}}}}
+				for i in range(maxResults)]
+
+
+if __name__ == "__main__":
+	port = int(sys.argv[1]) if len(sys.argv) > 1 else 8000
+	n_videos = int(sys.argv[2]) if len(sys.argv) > 2 else 100000
+	server = serve(FakeGraph(n_videos), port=port)
+	print('Serving watch pages at {}'.format(server.watch_url.format('v0000000000')))
+	try:
+		while True:
+			time.sleep(3600)
+	except KeyboardInterrupt:
+		server.shutdown()
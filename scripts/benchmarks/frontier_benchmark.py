@@ -0,0 +1,110 @@
+# Benchmarks the crawler's BFS frontier against a synthetic recommendation graph.
+#
+# Each of the n_nodes videos recommends n_splits pseudo-random videos (computed,
+# not stored, so the graph itself costs no memory). We run an unsampled crawl
+# over the whole graph and report the cost per visited node in windows, which
+# should stay flat as the crawl grows. The list-based queue the crawler used
+# to have is run on a small graph for comparison.
+#
+# usage: python frontier_benchmark.py [n_nodes] [n_splits]
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '../..'))
+
+from youtube_follower.frontier import Frontier
+
+
+def recommendations(node, n_nodes, n_splits):
+	"""
+	Deterministic pseudo-random out-edges of node in the synthetic graph
+	"""
+	recs = []
+	x = node
+	for _ in range(n_splits):
+		x = (6364136223846793005 * x + 1442695040888963407) % (1 << 64)
+		recs.append('v{:010d}'.format((x >> 16) % n_nodes))
+	return recs
+
+
+def crawl_frontier(n_nodes, n_splits, window, by_level=True):
+	"""
+	Visits every node reachable from node 0 with Frontier. Returns a list of
+	(nodes visited, seconds per node over the last window)
+	"""
+	search_info = {}
+	frontier = Frontier('v{:010d}'.format(0), seen=search_info)
+	timings = []
+	start = time.perf_counter()
+
+	def visit(video_id, depth):
+		nonlocal start
+		recs = recommendations(int(video_id[1:]), n_nodes, n_splits)
+		search_info[video_id] = {'recommendations': recs, 'depth': depth}
+		frontier.extend(recs)
+		if len(search_info) % window == 0:
+			now = time.perf_counter()
+			timings.append((len(search_info), (now - start) / window))
+			start = now
+
+	while frontier:
+		if by_level:
+			depth, level = frontier.pop_level()
+			for video_id in level:
+				visit(video_id, depth)
+		else:
+			depth, video_id = frontier.pop()
+			visit(video_id, depth)
+	return timings
+
+
+def crawl_list(n_nodes, n_splits, window):
+	"""
+	The crawler's original list-based BFS (queue.pop(0), `in queue`)
+	"""
+	search_info = {}
+	queue = ['v{:010d}'.format(0)]
+	inactive_queue = []
+	timings = []
+	start = time.perf_counter()
+	depth = 0
+	while True:
+		if not queue and not inactive_queue:
+			return timings
+		if not queue:
+			queue = list(set(inactive_queue))
+			inactive_queue = []
+			depth += 1
+		video_id = queue.pop(0)
+		recs = recommendations(int(video_id[1:]), n_nodes, n_splits)
+		search_info[video_id] = {'recommendations': recs, 'depth': depth}
+		for rec in recs:
+			if rec in search_info or rec in queue:
+				continue
+			inactive_queue.append(rec)
+		if len(search_info) % window == 0:
+			now = time.perf_counter()
+			timings.append((len(search_info), (now - start) / window))
+			start = now
+
+
+def report(name, timings):
+	print(name)
+	print('{:>12} {:>14}'.format('nodes', 'usec / node'))
+	for n, per_node in timings:
+		print('{:>12} {:>14.2f}'.format(n, per_node * 1e6))
+	print()
+
+
+if __name__ == "__main__":
+	n_nodes = int(sys.argv[1]) if len(sys.argv) > 1 else 10**6
+	n_splits = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+
+	report('Frontier, level-by-level ({} nodes)'.format(n_nodes),
+		   crawl_frontier(n_nodes, n_splits, window=n_nodes // 10))
+	report('Frontier, node-by-node ({} nodes)'.format(n_nodes),
+		   crawl_frontier(n_nodes, n_splits, window=n_nodes // 10, by_level=False))
+	small = 20000
+	report('list queue ({} nodes)'.format(small),
+		   crawl_list(small, n_splits, window=small // 10))
@@ -0,0 +1,143 @@
+# Synthetic watch pages in the (desktop, pre-Polymer) layout the crawler parses.
+#
+# The related videos sit in the watch sidebar as `related-list-item` <li>s
+# (an autoplay item, then the rest), after a large <head> of inline scripts
+# and before the description and comments, like the real pages.
+#
+# fixture_pages() gives the pages extract_benchmark.py parses; they are
+# generated (deterministically) when needed rather than kept in the repo.
+#
+# usage: python watch_pages.py   (writes the fixture pages to fixtures/, to
+#                                 look at them)
+import functools
+import os
+import random
+
+ALPHABET = 'ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789-_'
+
+RELATED_ITEM = '''<li class="video-list-item related-list-item  show-video-time related-list-item-compact-video">
+    <div class="content-wrapper">
+      <a href="/watch?v={video_id}" class=" content-link spf-link  yt-uix-sessionlink      spf-link " data-sessionlink="itct={token}" title="{title}" rel=" spf-prefetch nofollow" data-visibility-tracking="{token}">
+        <span dir="ltr" class="title" aria-describedby="description-id-{n}">
+          {title}
+        </span>
+        <span class="accessible-description" id="description-id-{n}">
+          - Duration: {minutes}:{seconds:02d}.
+        </span>
+        <span class="stat attribution"><span class="" >{channel}</span></span>
+        <span class="stat view-count">{views:,} views</span>
+      </a>
+    </div>
+    <div class="thumb-wrapper">
+      <a href="/watch?v={video_id}" class=" thumb-link spf-link  yt-uix-sessionlink      spf-link " data-sessionlink="itct={token}" rel=" spf-prefetch nofollow" aria-hidden="true" tabindex="-1">
+        <span class="yt-uix-simple-thumb-wrap yt-uix-simple-thumb-related" tabindex="0" data-vid="{video_id}"><img aria-hidden="true" width="168" height="94" alt="" data-ytimg="1" src="https://i.ytimg.com/vi/{video_id}/hqdefault.jpg?sqp={token}" style="top: 0px"></span>
+      </a>
+      <span class="video-time">{minutes}:{seconds:02d}</span>
+      <button class="yt-uix-button yt-uix-button-size-small yt-uix-button-default yt-uix-button-empty yt-uix-button-has-icon no-icon-markup addto-button video-actions spf-nolink hide-until-delayloaded addto-watch-later-button-sign-in yt-uix-tooltip" type="button" onclick=";return false;" title="Watch Later" role="button" data-video-ids="{video_id}"></button>
+    </div>
+  </li>
+'''
+
+
+def random_id(rng):
+	return ''.join(rng.choice(ALPHABET) for _ in range(11))
+
+
+def random_words(rng, n):
+	words = ['news', 'live', 'president', 'report', 'full', 'interview', 'breaking',
+			 'update', 'debate', 'analysis', 'video', 'today', 'world', 'week']
+	return ' '.join(rng.choice(words) for _ in range(n)).capitalize()
+
+
+def related_item(rng, video_id, n):
+	return RELATED_ITEM.format(video_id=video_id, n=n, token=random_id(rng) * 4,
+							   title=random_words(rng, 8), channel=random_words(rng, 2),
+							   minutes=rng.randrange(60), seconds=rng.randrange(60),
+							   views=rng.randrange(10**7))
+
+
+@functools.lru_cache(maxsize=64)
+def head_script(seed, script_kb):
+	"""
+	Inline script filler of the page rendered with seed, and the state of the
+	page's RNG after it. Cached, as it is most of the cost of a page.
+	"""
+	rng = random.Random(seed)
+	script = ''.join('var ytcfg_{} = "{}";\n'.format(i, random_id(rng) * 8)
+					 for i in range(script_kb * 1024 // 110))
+	return script, rng.getstate()
+
+
+def render_watch_page(video_id, related, seed=0, script_kb=120, comments=40):
+	"""
+	Renders a watch page for video_id recommending the video_ids in related
+
+	INPUT:
+		video_id: (str)
+		related: (list) recommended video_ids, in sidebar order
+		seed: (int) seed for the filler text
+		script_kb: (int) approximate size of the inline scripts in <head>
+		comments: (int) number of filler comments after the sidebar
+
+	OUTPUT:
+		(str) page html
+	"""
+	script, state = head_script(seed, script_kb)
+	rng = random.Random()
+	rng.setstate(state)
+	items = [related_item(rng, rec, n) for n, rec in enumerate(related)]
+	autoplay, rest = items[:1], items[1:]
+	comment_html = ''.join(
+		'<div class="comment-renderer"><div class="comment-renderer-text-content">{}</div></div>\n'
+		.format(random_words(rng, 30)) for _ in range(comments))
+	return '''<!DOCTYPE html><html lang="en" data-cast-api-enabled="true"><head>
+<title>{title} - YouTube</title>
+<script>{script}</script>
+<link rel="stylesheet" href="/yts/cssbin/www-core-webp-vfl.css" name="www-core">
+</head><body dir="ltr" id="body" class=" ltr exp-responsive site-center-aligned">
+<div id="page" class="watch"><div id="content">
+<div id="watch7-main-container"><div id="watch7-main" class="clearfix">
+<div id="watch7-content" class="watch-main-col" itemscope itemid="" itemtype="http://schema.org/VideoObject">
+<meta itemprop="videoId" content="{video_id}">
+<div id="watch-headline-title"><h1 class="watch-title-container"><span id="eow-title" class="watch-title" dir="ltr" title="{title}">{title}</span></h1></div>
+</div>
+<div id="watch7-sidebar" class="watch-sidebar"><div id="watch7-sidebar-contents" class="watch-sidebar-gutter yt-card yt-card-has-padding yt-uix-expander yt-uix-expander-collapsed">
+<div class="watch-sidebar-section"><div class="autoplay-bar"><div class="checkbox-on-off"><label for="autoplay-checkbox">Autoplay</label></div><h4 class="watch-sidebar-head">Up next</h4>
+<ul class="video-list">
+{autoplay}</ul></div></div>
+<hr class="watch-sidebar-separation-line">
+<div class="watch-sidebar-section"><div class="watch-sidebar-body"><ul id="watch-related" class="video-list">
+{rest}</ul></div></div>
+</div></div>
+<div id="watch-discussion" class="branded-page-box yt-card scrolldetect">{comments}</div>
+</div></div></div></div></body></html>
+'''.format(title=random_words(rng, 8), script=script, video_id=video_id,
+		   autoplay=''.join(autoplay), rest=''.join(rest), comments=comment_html)
+
+
+def fixture_pages(n_pages=3):
+	"""
+	The benchmark's watch pages, the same on every call
+
+	OUTPUT:
+		pages: (list) (name, html) of each page, name as watch_<video_id>.html
+	"""
+	rng = random.Random(2019)
+	pages = []
+	for seed in range(n_pages):
+		video_id = random_id(rng)
+		related = [random_id(rng) for _ in range(20)]
+		pages.append(('watch_{}.html'.format(video_id),
+					  render_watch_page(video_id, related, seed=seed)))
+	return pages
+
+
+if __name__ == "__main__":
+	fixture_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+	if not os.path.isdir(fixture_dir):
+		os.mkdir(fixture_dir)
+	for name, html in fixture_pages():
+		path = os.path.join(fixture_dir, name)
+		with open(path, 'w') as f:
+			f.write(html)
+		print('Wrote {}'.format(path))
@@ -1,124 +1,249 @@
+import argparse
+import multiprocessing
+import os
 import sqlite3
+import time
+
 import pandas as pd
 import numpy as np
 	
 def complete_tree_setup(df):
 	"""
-	`complete_tree`-specific helper. Sets up deep copy of df + dicts of
-	video depths and recommendations for speedy lookup
+	`complete_tree`-specific helper. Sets up a copy of df with vertex ids, and
+	array-backed lookups of video depths and recommendations
 	
 	INPUT:
 		pd.DataFrame of recommendations
 	
 	OUTPUT 
-		res: (pd.DataFrame) deep copy of df with vertex_id column
-		depths: (dict) dict of depths for videos in df
-		recs: (dict) dict of recommendations for videos in df
+		res: (pd.DataFrame) copy of df with vertex_id column
+		videos: (pd.Index) sorted video_ids of df
+		depths: (np.array) depth of each video in videos
+		offsets: (np.array) the recommendations of videos[i] are
+				 recs[offsets[i]:offsets[i + 1]], in the order of df
+		recs: (np.array) recommendations grouped by video
 	
 	"""
 	res = df.copy().filter(['video_id', 'recommendation', 'depth'])
 	res['vertex_id'] = (res
 						.groupby(['depth','video_id'])
 						.ngroup())
-	# video depths and recs as dicts for fast lookup
+	codes, videos = pd.factorize(df.video_id, sort=True)
+	videos = pd.Index(videos, dtype=object)
+	# like groupby, leave out rows without a video_id
+	has_id = codes >= 0
+	# one depth per video (if there are several, the one a dict built from
+	# the distinct (video_id, depth) pairs would keep)
 	depths = (df[['video_id', 'depth']]
-				  .drop_duplicates()
-				  .set_index('video_id')
-				  .depth
-				  .to_dict())
-	recs = (df[['video_id', 'recommendation']]
-			   .groupby('video_id')
-			   .agg(lambda x: list(x))
-			   .recommendation
-			   .to_dict())
-	return res, depths, recs
-
-def list_difference(l1, l2):
+			  .drop_duplicates()
+			  .drop_duplicates('video_id', keep='last')
+			  .set_index('video_id')
+			  .depth
+			  .reindex(videos)
+			  .values)
+	order = np.argsort(codes[has_id], kind='stable')
+	recs = df.recommendation.to_numpy(dtype=object)[has_id][order]
+	counts = np.bincount(codes[has_id], minlength=len(videos))
+	offsets = np.concatenate([[0], np.cumsum(counts)])
+	return res, videos, depths, offsets, recs
+
+
+def truncated(prev_recs, parent_ids):
 	"""
-	Returns l1 - l2
-	e.g. list_difference([1,2,2,3,3,4], [2,2,3]) = [1,3,4]
+	Returns the recommendations in prev_recs (np.array) that were not followed:
+	every occurrence of a video except the first one of each parent in
+	parent_ids. Same as removing parent_ids from prev_recs one at a time.
 	
 	"""
-	return [i for i in l1 if not i in l2 or l2.remove(i)]
+	prev = pd.Series(prev_recs, dtype=object)
+	followed = prev.isin(parent_ids) & ~prev.duplicated()
+	return prev_recs[~followed.values]
 	
 
-def complete_tree(df, search_id, n_splits=4, max_depth=20, const_depth=5):
+def complete_tree(df, search_id, n_splits=4, max_depth=20, const_depth=5, rng=None):
 	"""
-	Function which fills in a truncated tree.
+	Function which fills in a truncated tree. Builds each level with array
+	operations: the recommendations of every truncated video of a level are
+	added at once.
 	
 	INPUT:
 		df: pd.DataFrame with out-edges (columns=['video_id', 'depth', 'recommendation'])
 		search_id: (int) id of the tree to populate
 		n_splits: (int) splitting factor
 		const_depth: (int) depth at which out-edges are sampled
+		rng: (np.random.RandomState) for the sampling; None for np.random
 	
 	OUTPUT:
 		(pd.DataFrame) full tree
 	
 	"""
-	res, vid_depths, vid_recs = complete_tree_setup(df)
+	if rng is None:
+		rng = np.random
+	res, videos, vid_depths, offsets, vid_recs = complete_tree_setup(df)
+	video_ids = df.video_id.to_numpy(dtype=object)
+	rec_ids = df.recommendation.to_numpy(dtype=object)
+	row_depths = df.depth.values
 	# get starting vertex index for new additions
 	v_id = max(res.vertex_id.values)
-	prev_recs = []
+	levels = []
+	prev_recs = np.array([], dtype=object)
 	for depth in range(max_depth + 1):
-		parent_ids = list((res
-					 .query('depth == @depth')
-					 .video_id
-					 .unique()))
-		# get the recommendations that were not followed at the next level
-		truncd_ids = list_difference(prev_recs, parent_ids)
-		for video_id in truncd_ids:
-			v_id += 1
-			# skip if None or we don't have recommendations 
-			if video_id is None or video_id not in vid_recs:
-				continue
-		
-			recs = vid_recs[video_id]
-			source_depth = vid_depths[video_id]
-			
-			# sample if we  are sampling, but our source recommendations were not sampled
-			if depth >= const_depth and source_depth < const_depth:
-				recs = np.random.choice(recs, 1)
-				
-			if not recs:
-				to_append_l = [[video_id, depth, v_id, None]]
-			else:
-				to_append_l = [[video_id, depth, v_id, rec] for rec in recs]
-			to_append = pd.DataFrame(to_append_l,
-									columns=['video_id','depth','vertex_id','recommendation'])
-			res = res.append(to_append)
-			
+		at_depth = row_depths == depth
+		parent_ids = pd.unique(video_ids[at_depth])
+		# get the recommendations that were not followed at the next level;
+		# each gets a vertex id, even if we skip it
+		truncd_ids = truncated(prev_recs, parent_ids)
+		vertex_ids = np.arange(v_id + 1, v_id + 1 + len(truncd_ids))
+		v_id += len(truncd_ids)
+
+		# skip if None or we don't have recommendations
+		pos = videos.get_indexer(pd.Index(truncd_ids, dtype=object))
+		known = pos >= 0
+		truncd_ids, vertex_ids, pos = truncd_ids[known], vertex_ids[known], pos[known]
+		n_recs = offsets[pos + 1] - offsets[pos]
+		start = offsets[pos]
+
+		# sample if we are sampling, but our source recommendations were not
+		# sampled. One randint over the lot draws the same numbers as a
+		# choice(recs, 1) per video, in order.
+		sampled = (depth >= const_depth) & (vid_depths[pos] < const_depth)
+		if sampled.any():
+			start[sampled] += rng.randint(0, n_recs[sampled])
+		n_rows = np.where(sampled, 1, n_recs)
+
+		# one row per recommendation (one for sampled videos)
+		row_start = np.cumsum(n_rows) - n_rows
+		within = np.arange(n_rows.sum()) - np.repeat(row_start, n_rows)
+		recs = vid_recs[np.repeat(start, n_rows) + within]
+		# a sampled recommendation that is falsy (None, '') is stored as None
+		was_sampled = np.repeat(sampled, n_rows)
+		falsy = np.array([not rec for rec in recs[was_sampled]], dtype=bool)
+		recs[np.flatnonzero(was_sampled)[falsy]] = None
+
+		if len(recs):
+			levels.append(pd.DataFrame({'video_id': np.repeat(truncd_ids, n_rows),
+										'recommendation': recs,
+										'depth': depth,
+										'vertex_id': np.repeat(vertex_ids, n_rows)},
+									   index=within))
 		# update previous recs 
-		prev_recs = list(res
-			.query('depth == @depth')
-			.recommendation
-			.values)
+		prev_recs = np.concatenate([rec_ids[at_depth], recs])
 
+	res = pd.concat([res] + levels)
 	res = res.assign(search_id=search_id).sort_values(['depth', 'video_id'])
 	return res
 
 
-if __name__ == "__main__":
-	con = sqlite3.connect('../../data/crawl.sqlite')
-	cur = con.cursor()
-
-	sql = "SELECT * FROM recommendations r"
-
-	recs = pd.read_sql_query(sql, con)
-	for search_id in recs.search_id.unique():
-		search_id = 1
-		df = recs.query("search_id == @search_id")
-		
-		sql = '''
-		SELECT * FROM searches
-		WHERE search_id = {}
-		'''.format(search_id)
-
-		_, _, n_splits, depth, _, _, const_depth = cur.execute(sql).fetchone()
-		res = complete_tree(df, search_id, n_splits=n_splits, max_depth=depth, const_depth=const_depth)
-		res.to_sql('recommendations_full', con, if_exists='append', index=False)
-
-	con.commit()
+
+# set up in each worker process by init_worker
+worker = {}
+
+
+def init_worker(db_path, seed):
+	worker['con'] = sqlite3.connect(db_path, timeout=30)
+	worker['seed'] = seed
+
+
+def complete_search(search_id):
+	"""
+	Fills in the tree of one search in a worker process
+	
+	INPUT:
+		search_id: (int)
+	
+	OUTPUT:
+		search_id: (int)
+		rows: (list) (video_id, vertex_id, search_id, recommendation, depth)
+			  tuples for recommendations_full
+	
+	"""
+	con = worker['con']
+	sql = "SELECT n_splits, depth, const_depth FROM searches WHERE search_id = ?"
+	n_splits, depth, const_depth = con.execute(sql, (search_id,)).fetchone()
+	# in insertion order, like the crawler wrote them
+	sql = """
+	SELECT video_id, recommendation, depth FROM recommendations
+	WHERE search_id = ?
+	ORDER BY rec_id
+	"""
+	df = pd.read_sql_query(sql, con, params=(search_id,))
+	# seeded per search, so results don't depend on which worker runs it
+	seed = worker['seed']
+	rng = np.random.RandomState(None if seed is None else [seed, search_id])
+	res = complete_tree(df, search_id, n_splits=n_splits, max_depth=depth,
+						const_depth=const_depth, rng=rng)
+	recs = res.recommendation.astype(object)
+	res = res.assign(recommendation=recs.where(recs.notna(), None))
+	rows = list(res[['video_id', 'vertex_id', 'search_id', 'recommendation', 'depth']]
+				.itertuples(index=False, name=None))
+	return search_id, rows
+
+
+def pending_searches(con):
+	"""
+	Searches that have recommendations but no full tree yet. Searches that
+	are still being crawled (no searches.finished_at yet) are left for a
+	later run.
+	
+	"""
+	sql = """
+	SELECT search_id FROM searches s
+	WHERE finished_at IS NOT NULL
+	  AND EXISTS (SELECT 1 FROM recommendations r WHERE r.search_id = s.search_id)
+	  AND NOT EXISTS (SELECT 1 FROM recommendations_full f
+	                  WHERE f.search_id = CAST(s.search_id AS TEXT))
+	ORDER BY search_id
+	"""
+	return [search_id for search_id, in con.execute(sql)]
+
+
+def complete_trees(db_path, n_workers=4, seed=None):
+	"""
+	Fills in the trees of every search not yet in recommendations_full. Each
+	worker reads and completes one search at a time; the trees are inserted
+	here, one transaction per search, so a search is either all in
+	recommendations_full or not at all.
+	
+	INPUT:
+		db_path: (str) where the sqlite database lives
+		n_workers: (int) number of processes
+		seed: (int) seed for the sampling; None for a random one
+	
+	OUTPUT:
+		(int) number of searches completed
+	
+	"""
+	con = sqlite3.connect(db_path, timeout=30)
+	sql_path = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+							'create_recommendations_full.sql')
+	if not con.execute("SELECT 1 FROM sqlite_master WHERE name = 'recommendations_full'").fetchone():
+		with open(sql_path) as f:
+			con.executescript(f.read())
+	con.execute("""CREATE INDEX IF NOT EXISTS recommendations_full_search_id
+				   ON recommendations_full(search_id)""")
+	search_ids = pending_searches(con)
+	print("{} searches to complete".format(len(search_ids)))
+	
+	sql = """
+	INSERT INTO recommendations_full (video_id, vertex_id, search_id, recommendation, depth)
+	VALUES (?, ?, ?, ?, ?)
+	"""
+	start = time.time()
+	with multiprocessing.Pool(n_workers, initializer=init_worker,
+							  initargs=(db_path, seed)) as pool:
+		for i, (search_id, rows) in enumerate(pool.imap_unordered(complete_search, search_ids)):
+			with con:
+				con.executemany(sql, rows)
+			print("[{}/{}] search {}: {} rows ({:.0f}s)"
+				  .format(i + 1, len(search_ids), search_id, len(rows), time.time() - start))
 	con.close()
+	return len(search_ids)
 
 
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description='Fill in the truncated trees of new searches')
+	parser.add_argument('--db-path', default='../../data/crawl.sqlite')
+	parser.add_argument('--n-workers', type=int, default=4)
+	parser.add_argument('--seed', type=int, default=None, help='seed for the sampling')
+	args = parser.parse_args()
+	complete_trees(args.db_path, n_workers=args.n_workers, seed=args.seed)
@@ -5,4 +5,6 @@ CREATE TABLE recommendations_full (
   search_id text NOT NULL,
   recommendation text,
   depth integer
-);
\ No newline at end of file
+);
+
+CREATE INDEX recommendations_full_search_id ON recommendations_full(search_id);
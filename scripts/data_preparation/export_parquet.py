@@ -0,0 +1,22 @@
+import argparse
+import os
+import sqlite3
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '../..'))
+
+from youtube_follower.export import export
+
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description='Export the crawl tables to Parquet')
+	parser.add_argument('--db-path', default='../../data/crawl.sqlite')
+	parser.add_argument('--outdir', default='../../data/parquet')
+	parser.add_argument('--partition-by', choices=['search_id', 'date'], default='search_id')
+	args = parser.parse_args()
+
+	con = sqlite3.connect(args.db_path)
+	counts = export(con, args.outdir, partition_by=args.partition_by)
+	for table, n in counts.items():
+		print("{}: {} new searches".format(table, n))
+	con.close()
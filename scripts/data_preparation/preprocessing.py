@@ -1,83 +1,47 @@
-import json
-import re
+import argparse
 import os
-from datetime import date
-import time
+import shutil
 import sys
 import subprocess
 
 import pandas as pd
-import numpy as np
-import networkx as nx
 
-import sqlite3
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '../..'))
 
-# connect to the database
-db_path = '../../data/crawl.sqlite'
-conn = sqlite3.connect(db_path)
-
-outdir = '../../data/derived_data/'
-
-# get video_info
-print("Getting video info...")
-sql = "SELECT * FROM recommendations"
-recs_df = pd.read_sql_query(sql, conn)
-
-# aggregate all the out-edges for each video, drop videos that have no out-edges
-edges = (recs_df[['video_id', 'recommendation']]
-       .dropna()
-       .groupby('video_id')
-       .agg(lambda x: list(x))
-       .query('recommendation != 0')
-       .reset_index())
+from youtube_follower import db_utils
+from youtube_follower.graph import Graph, channel_edges, update_pagerank
 
-print("Building video adjacency...")
-# write as a text file
-f = open(os.path.join(outdir, 'video_adjacency.txt'), 'w')
-for parent, children in zip(edges.video_id.values, edges.recommendation.values):
-    if not children:
-        continue
-    line = '{} {}'.format(parent, " ".join(children))
-    f.write(line + "\n")
-f.close()
+parser = argparse.ArgumentParser(description='Build the derived data from the crawl database')
+parser.add_argument('--incremental', action='store_true',
+                    help='only add the searches finished since the last run to the video graph')
+args = parser.parse_args()
 
-print("Building channel adjacency...")
-# channel adjacency
-sql = '''
-SELECT v1.channel_id AS parent_channel, v2.channel_id as child_channel
-FROM recommendations r
-LEFT JOIN videos v1
-  ON r.video_id = v1.video_id
-LEFT JOIN videos v2
-  ON r.recommendation = v2.video_id
-'''
-
-channel_recs = pd.read_sql_query(sql, conn)
-
-edges = (channel_recs
-        .dropna()
-        .groupby('parent_channel')
-        .agg(lambda x: list(x))
-        .reset_index())
-
-f = open(os.path.join(outdir, 'channel_adjacency.txt'), 'w')
-for parent, children in zip(edges.parent_channel.values, edges.child_channel.values):
-    if not children:
-        continue
-    line = '{} {}'.format(parent, " ".join(children))
-    f.write(line + "\n")
-f.close()
+# connect to the database (WAL, so crawls can keep writing meanwhile; brings
+# older databases up to the current schema)
+db_path = '../../data/crawl.sqlite'
+conn = db_utils.create_connection(db_path)
 
-print("Getting video pageranks...")
-# import the graph from adjacency list
-G = nx.read_adjlist(create_using=nx.DiGraph(), 
-                    path=os.path.join(outdir, "video_adjacency.txt"))
+outdir = '../../data/derived_data/'
 
-# load pageranks into a dataframe
-pr = nx.pagerank(G)
-pr_df = pd.DataFrame.from_dict(pr, orient="index").reset_index()\
-                 .rename(index=str, columns={'index': 'video_id', 0: 'pagerank'})
-    
+print("Building video graph and pageranks...")
+# integer-indexed adjacency matrix and its pageranks over the finished
+# searches, saved as a memory-mappable snapshot that --incremental runs update
+graph_path = os.path.join(outdir, 'video_graph')
+if not args.incremental:
+    shutil.rmtree(graph_path, ignore_errors=True)
+G, pr = update_pagerank(conn, graph_path)
+# text version for the analysis notebooks
+G.write_adjlist(os.path.join(outdir, 'video_adjacency.txt'))
+
+print("Building channel graph...")
+# (parent_channel, child_channel, weight, search_count), aggregated in sqlite
+channel_edges_df = channel_edges(conn)
+channel_edges_df.to_csv(os.path.join(outdir, 'channel_edges.csv'), index=False)
+Graph.from_edges(channel_edges_df.parent_channel, channel_edges_df.child_channel,
+                 channel_edges_df.weight).save(os.path.join(outdir, 'channel_graph'))
+
+print("Writing video pageranks...")
+pr_df = pd.DataFrame({'video_id': G.ids, 'pagerank': pr})
 pr_df.to_csv(os.path.join(outdir, 'video_pageranks.csv'), index=False)
 
 print("Running the channel classification R script...")
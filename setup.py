@@ -1,9 +1,12 @@
 import os
+import sys
 import fnmatch
 
 import sqlite3
 from sqlite3 import Error
 
+from youtube_follower import db_utils
+
 
 def credentials():
 	"""
@@ -11,7 +14,9 @@ def credentials():
 	"""
 	if not os.path.exists('credentials'):
 		os.mkdir('credentials')
-	open('credentials/api_key.txt', 'w').close()
+	# keep the key if setup is rerun to upgrade the database
+	if not os.path.exists('credentials/api_key.txt'):
+		open('credentials/api_key.txt', 'w').close()
 
 
 def execute_sql_script(cur, path):
@@ -28,10 +33,32 @@ def execute_sql_script(cur, path):
 		cur.execute(sql)
 
 
-def database():
+def reset_database(con):
+	"""
+	Drops every view and table and resets the schema version
+	"""
+	cur = con.cursor()
+	# views first: migrations recreate the tables they read from
+	views = cur.execute("SELECT name FROM sqlite_master WHERE type = 'view'").fetchall()
+	for (view,) in views:
+		cur.execute('DROP VIEW IF EXISTS "{}"'.format(view))
+	tables = cur.execute("SELECT name FROM sqlite_master WHERE type = 'table' "
+						 "AND name NOT LIKE 'sqlite_%'").fetchall()
+	for (table,) in tables:
+		cur.execute('DROP TABLE IF EXISTS "{}"'.format(table))
+	cur.execute('PRAGMA user_version = 0')
+	con.commit()
+
+
+def database(reset=False):
 	"""
-	set up the data directory
+	set up the data directory and the database. The crawl tables are created,
+	or upgraded in place if the database already exists (see db_utils.migrate).
+	The other tables (scripts/data_preparation/*.sql) are only created for a
+	new database.
 
+	INPUT:
+		reset: (bool) whether to drop everything and start from scratch
 	"""
 	if not os.path.exists('data'):
 		os.mkdir('data')
@@ -40,18 +67,25 @@ def database():
 	except Error as e:
 		print(e)
 	else:
+		if reset:
+			reset_database(con)
 		cur = con.cursor()
-		for file in os.listdir('scripts/data_preparation'):
-			if fnmatch.fnmatch(file, '*.sql'):
-				path = os.path.join('scripts/data_preparation', file)
-				execute_sql_script(cur, path)
+		fresh = cur.execute('PRAGMA user_version').fetchone()[0] == 0 and not \
+			cur.execute("SELECT count(*) FROM sqlite_master WHERE type = 'table'").fetchone()[0]
+		version = db_utils.migrate(con)
+		print("Crawl tables at schema version {}".format(version))
+		if fresh:
+			for file in os.listdir('scripts/data_preparation'):
+				if fnmatch.fnmatch(file, '*.sql'):
+					path = os.path.join('scripts/data_preparation', file)
+					execute_sql_script(cur, path)
 	finally:
 		con.commit()
 		con.close()
 
 
 if __name__ == "__main__":
-	database()
+	database(reset='--reset' in sys.argv[1:])
 	credentials()
 	print("Done.\n")
 	print("Copy your YouTube API key into `credentials/api_key.txt`")
@@ -0,0 +1,109 @@
+import os
+import sqlite3
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from youtube_follower import db_utils
+
+SEARCHES = [(1, 'a', 2, 2, '2019-01-01', 'False', 2),
+            (2, 'a', 2, 2, '2019-01-02', 'False', 2),
+            (3, 'b', 2, 2, '2019-01-02', 'False', 2)]
+
+# video_id, search_id, title, channel_id, postdate, views, likes, dislikes,
+# n_comments, description, category
+VIDEOS = [('a', 1, 'Title', 'c1', '2019-01-01', 10, 1, 0, 2, 'About', 25),
+          ('b', 1, 'Other', 'c2', '2018-05-01', 5, None, None, 0, 'More', 10),
+          ('a', 2, 'Title', 'c1', '2019-01-01', 12, 1, 0, 3, 'About', 25),
+          ('b', 2, 'Renamed', 'c2', '2018-05-01', 6, None, None, 0, 'More', 10)]
+
+# channel_id, search_id, name, country, date_created, n_subscribers,
+# n_videos, n_views
+CHANNELS = [('c1', 1, 'One', 'US', '2010-01-01', 100, 5, 1000),
+            ('c2', 1, 'Two', None, '2011-01-01', 7, 1, 50),
+            ('c1', 2, 'One', 'US', '2010-01-01', 101, 5, 1100)]
+
+CATEGORIES = [('c1', 1, 'Politics'), ('c1', 1, 'Society'), ('c2', 1, None),
+              ('c1', 2, 'Politics')]
+
+RECOMMENDATIONS = [('a', 1, 'b', 0), ('b', 1, None, 1), ('a', 2, 'b', 0), ('b', 2, 'a', 1)]
+
+
+def baseline_database(path):
+    """
+    A database as the original setup.py left it: the first crawl tables and
+    no schema version
+    """
+    conn = sqlite3.connect(path)
+    with open(db_utils.migrations()[0][1]) as f:
+        conn.executescript(f.read())
+    for table, rows in [('searches', SEARCHES), ('videos', VIDEOS), ('channels', CHANNELS),
+                        ('channel_categories', CATEGORIES),
+                        ('recommendations', RECOMMENDATIONS)]:
+        conn.executemany('INSERT INTO {} VALUES ({})'.format(table, ','.join('?' * len(rows[0]))),
+                         rows)
+    conn.commit()
+    return conn
+
+
+def test_migrate_baseline_database(tmp_path):
+    path = str(tmp_path / 'crawl.sqlite')
+    baseline_database(path).close()
+
+    conn = db_utils.create_connection(path)
+    assert conn.execute('PRAGMA user_version').fetchone()[0] == db_utils.migrations()[-1][0]
+    assert conn.execute('SELECT search_id, root_video, n_splits, depth, date, sample, '
+                        'const_depth FROM searches').fetchall() == SEARCHES
+    # the views give back the rows of the old tables
+    assert conn.execute('SELECT * FROM videos ORDER BY search_id, video_id').fetchall() == VIDEOS
+    assert (conn.execute('SELECT * FROM channels ORDER BY search_id, channel_id').fetchall()
+            == CHANNELS)
+    assert conn.execute('SELECT channel_id, search_id, category FROM channel_categories '
+                        'ORDER BY category_row_id').fetchall() == CATEGORIES
+    assert conn.execute('SELECT video_id, search_id, recommendation, depth FROM recommendations '
+                        'ORDER BY rec_id').fetchall() == RECOMMENDATIONS
+    # unchanged static fields are stored once
+    assert conn.execute('SELECT count(*) FROM video_snapshots').fetchone()[0] == 3
+    assert conn.execute('SELECT count(*) FROM channel_snapshots').fetchone()[0] == 2
+    # searches with rows count as finished
+    assert conn.execute('SELECT search_id FROM searches WHERE finished_at IS NOT NULL '
+                        'ORDER BY search_id').fetchall() == [(1,), (2,)]
+
+    # new rows go through the views as before
+    db_utils.create_record(conn, 'videos', [['c', 3, 'New', '2019-01-02', 'Text', 24, 'c2',
+                                             '0', '0', '1', '0']])
+    conn.commit()
+    assert conn.execute('SELECT count(*) FROM videos').fetchone()[0] == len(VIDEOS) + 1
+    conn.close()
+
+
+def test_writer_isolates_failed_writes(tmp_path):
+    path = str(tmp_path / 'crawl.sqlite')
+    db_utils.create_connection(path).close()
+    writer = db_utils.DatabaseWriter(path, batch_size=100)
+    a, b = writer.client(1), writer.client(2)
+    search_a = writer.create_search(['a', 2, 2, '2019-01-01', False, 2])
+    search_b = writer.create_search(['b', 2, 2, '2019-01-01', False, 2])
+    # a's second row breaks the NOT NULL on video_id, in the same batch as b's rows
+    b.add('recommendations', [['x', search_b, 'y', 0]] * 10)
+    a.add('recommendations', [['x', search_a, 'y', 0], [None, search_a, 'z', 0]])
+    b.add('recommendations', [['y', search_b, 'z', 1]])
+    b.flush()
+    with pytest.raises(sqlite3.IntegrityError):
+        a.flush()
+    # a's calls fail too, so a failed crawl is never marked finished
+    with pytest.raises(sqlite3.IntegrityError):
+        a.call(db_utils.finish_search, search_a)
+    b.call(db_utils.finish_search, search_b)
+    writer.close()
+    assert list(writer.errors) == [1]
+
+    # the failed message loses its own rows only
+    conn = db_utils.create_connection(path)
+    assert conn.execute('SELECT search_id, count(*) FROM recommendations '
+                        'GROUP BY search_id').fetchall() == [(search_b, 11)]
+    assert conn.execute('SELECT search_id FROM searches WHERE finished_at IS NOT NULL'
+                        ).fetchall() == [(search_b,)]
+    conn.close()
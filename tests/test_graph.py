@@ -0,0 +1,83 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from youtube_follower import db_utils
+from youtube_follower.graph import Graph, pagerank, update_pagerank
+
+
+def add_search(conn, search_id, edges, finished=True):
+    """
+    Adds a search with the recommendations edges, [(video_id, recommendation)]
+    """
+    conn.execute("INSERT OR IGNORE INTO searches (search_id, root_video, n_splits, depth, date, "
+                 "sample, const_depth) VALUES (?, 'a', 2, 2, '2019-01-01', 'False', 0)",
+                 (search_id,))
+    add_rows(conn, search_id, edges)
+    if finished:
+        db_utils.finish_search(conn, search_id)
+
+
+def add_rows(conn, search_id, edges):
+    conn.executemany("INSERT INTO recommendations (video_id, search_id, recommendation, depth) "
+                     "VALUES (?, ?, ?, 0)", [(a, search_id, b) for a, b in edges])
+    conn.commit()
+
+
+def edges(graph):
+    coo = graph.matrix.tocoo()
+    return sorted(zip(graph.ids[coo.row], graph.ids[coo.col]))
+
+
+@pytest.fixture
+def conn(tmp_path):
+    conn = db_utils.create_connection(str(tmp_path / 'crawl.sqlite'))
+    yield conn
+    conn.close()
+
+
+def test_update_merges_searches_finished_out_of_order(conn):
+    # run_batch allocates search ids up front, so search 1 can still be
+    # crawling when search 2 is done
+    add_search(conn, 1, [('a', 'b')], finished=False)
+    add_search(conn, 2, [('b', 'c')])
+    graph = Graph.from_db(conn, finished=True)
+    assert edges(graph) == [('b', 'c')]
+    assert graph.meta['merged_search_ids'] == [2]
+
+    add_rows(conn, 1, [('c', 'd')])
+    db_utils.finish_search(conn, 1)
+    graph = graph.update(conn)
+    assert edges(graph) == [('a', 'b'), ('b', 'c'), ('c', 'd')]
+    assert graph.meta['merged_search_ids'] == [1, 2]
+    assert graph.update(conn) is graph
+
+
+def test_update_counts_each_search_once(conn):
+    add_search(conn, 1, [('a', 'b'), ('a', 'b')])
+    graph = Graph.from_db(conn, weighted=True, finished=True)
+    add_search(conn, 2, [('a', 'b')])
+    graph = graph.update(conn)
+    assert graph.matrix.toarray().tolist() == [[0, 3], [0, 0]]
+
+
+def test_update_needs_finished_graph(conn):
+    add_search(conn, 1, [('a', 'b')])
+    with pytest.raises(ValueError):
+        Graph.from_db(conn).update(conn)
+
+
+def test_update_pagerank(conn, tmp_path):
+    path = str(tmp_path / 'video_graph')
+    add_search(conn, 2, [('a', 'b'), ('b', 'c')])
+    add_search(conn, 1, [('c', 'a')], finished=False)
+    update_pagerank(conn, path)
+    db_utils.finish_search(conn, 1)
+    graph, pr = update_pagerank(conn, path)
+    assert edges(graph) == [('a', 'b'), ('b', 'c'), ('c', 'a')]
+    assert np.allclose(pr, pagerank(Graph.from_db(conn)), atol=1e-5)
+    assert Graph.load(path).meta['merged_search_ids'] == [1, 2]
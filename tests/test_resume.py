@@ -0,0 +1,97 @@
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'scripts', 'benchmarks'))
+
+from fake_youtube import FakeClient, FakeGraph, serve
+from youtube_follower import db_utils, utils
+from youtube_follower.scheduler import Scheduler
+from youtube_follower.youtube_follower import YoutubeFollower
+
+COLUMNS = {'videos': 'video_id, title, channel_id, postdate, views, likes, dislikes, '
+                     'n_comments, description, category',
+           'channels': 'channel_id, name, country, date_created, n_subscribers, n_videos, n_views',
+           'channel_categories': 'channel_id, category',
+           'recommendations': 'video_id, recommendation, depth'}
+
+
+class Interrupted(Exception):
+    pass
+
+
+@pytest.fixture(scope='module')
+def graph():
+    graph = FakeGraph(n_videos=5000, n_related=10, n_channels=50)
+    server = serve(graph, script_kb=1, comments=2)
+    graph.watch_url = server.watch_url
+    yield graph
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def db_path(graph, tmp_path, monkeypatch):
+    # crawls log to ./logs
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(utils, '_injected_client', FakeClient(graph))
+    monkeypatch.setattr(utils, 'scheduler', Scheduler(api_rate=1e6, fetch_rate=1e6))
+    db_path = str(tmp_path / 'crawl.sqlite')
+    db_utils.create_connection(db_path).close()
+    return db_path
+
+
+def rows(db_path, search_id):
+    conn = db_utils.create_connection(db_path)
+    result = {table: sorted(conn.execute('SELECT {} FROM {} WHERE search_id = ?'
+                                         .format(columns, table), (search_id,)).fetchall(),
+                            key=repr)
+              for table, columns in COLUMNS.items()}
+    finished = conn.execute('SELECT finished_at FROM searches WHERE search_id = ?',
+                            (search_id,)).fetchone()[0]
+    conn.close()
+    return result, finished is not None
+
+
+@pytest.mark.parametrize('pipeline,stream', [(False, False), (False, True), (True, False)])
+@pytest.mark.parametrize('method,n_calls', [
+    # mid-level: the level at depth 3 is recorded in chunks of 32
+    ('record_recommendations', 60),
+    # populate_info, with the video metadata stored but not the channels'
+    # (pipelined: during the crawl)
+    ('store_metadata', 2),
+    ('save_results', 1)])
+def test_resume(graph, db_path, monkeypatch, pipeline, stream, method, n_calls):
+    kwargs = dict(n_splits=4, depth=4, const_depth=4, sample=True, seed=7, verbose=0,
+                  n_workers=2, pipeline=pipeline, stream=stream, batch_size=50,
+                  db_path=db_path, watch_url=graph.watch_url)
+    root_id = graph.video_id(1)
+    expected = YoutubeFollower(root_id, checkpoint_interval=None, **kwargs)
+    expected.run()
+
+    original = getattr(YoutubeFollower, method)
+    calls = []
+    def failing(self, *args):
+        calls.append(args)
+        if len(calls) == n_calls:
+            raise Interrupted()
+        return original(self, *args)
+    monkeypatch.setattr(YoutubeFollower, method, failing)
+    # no periodic checkpoints: resume relies on the one taken on failure
+    yf = YoutubeFollower(root_id, checkpoint_interval=3600, **kwargs)
+    with pytest.raises(Interrupted):
+        yf.run()
+    yf.db.close()
+    assert not rows(db_path, yf.search_id)[1]
+    monkeypatch.setattr(YoutubeFollower, method, original)
+
+    resumed = YoutubeFollower.resume(yf.search_id, db_path=db_path, n_workers=2,
+                                     pipeline=pipeline, watch_url=graph.watch_url,
+                                     verbose=0)
+    got, finished = rows(db_path, resumed.search_id)
+    assert finished
+    assert got == rows(db_path, expected.search_id)[0]
+    assert len(got['recommendations']) > 100
@@ -0,0 +1,24 @@
+import os
+import sqlite3
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import setup
+from youtube_follower import db_utils
+
+
+def test_reset_migrated_database(tmp_path):
+    conn = db_utils.create_connection(str(tmp_path / 'crawl.sqlite'))
+    search_id = db_utils.create_record(conn, 'searches', ['a', 2, 2, '2019-01-01', False, 2])
+    db_utils.create_record(conn, 'videos', [['a', search_id, 'title', '2019-01-01', 'about',
+                                             '25', 'c', '1', '0', '10', '2']])
+    conn.commit()
+    latest = db_utils.migrations()[-1][0]
+
+    setup.reset_database(conn)
+    assert conn.execute("SELECT count(*) FROM sqlite_master "
+                        "WHERE name NOT LIKE 'sqlite_%'").fetchone()[0] == 0
+    assert db_utils.migrate(conn) == latest
+    assert conn.execute("SELECT count(*) FROM videos").fetchone()[0] == 0
+    conn.close()
@@ -0,0 +1,254 @@
+import json
+import logging
+import sqlite3
+import threading
+import time
+
+from . import db_utils
+from . import metrics
+
+logger = logging.getLogger('youtube-follower')
+
+
+def connect(db_path):
+    """
+    Opens a cache database, tuned like the crawl database (WAL, busy timeout,
+    see db_utils.PRAGMAS) so that the crawls of a batch can share it
+    """
+    conn = sqlite3.connect(db_path, check_same_thread=False)
+    for pragma in db_utils.PRAGMAS:
+        conn.execute(pragma)
+    return conn
+
+
+class RecommendationCache():
+    def __init__(self, db_path='data/cache.sqlite', ttl=24*60*60):
+        """
+        Persistent cache of scraped watch-page recommendations, keyed by
+        video_id and shared across searches (and crawler runs). Safe to use
+        from the crawler's fetch threads. A list that can't be written (e.g.
+        the database stays locked) is logged and just not cached.
+
+        INPUT:
+            db_path: (str) where the sqlite cache lives
+            ttl: (float) seconds a cached recommendation list stays valid
+        """
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.conn = connect(db_path)
+        self.conn.execute('''
+        CREATE TABLE IF NOT EXISTS recommendation_cache (
+          video_id text PRIMARY KEY,
+          n_splits integer NOT NULL,
+          recommendations text NOT NULL,
+          fetched_at real NOT NULL
+        )''')
+        self.conn.commit()
+
+
+    def get(self, video_id, n_splits):
+        """
+        Looks up the recommendations for video_id
+
+        INPUT:
+            video_id: (str)
+            n_splits: (int) number of recommendations needed
+
+        OUTPUT:
+            (recs, age) where age is the seconds since the list was scraped,
+            or None if there is no fresh list with at least n_splits entries
+        """
+        sql = '''
+        SELECT n_splits, recommendations, fetched_at FROM recommendation_cache
+        WHERE video_id = ?'''
+        with self.lock:
+            row = self.conn.execute(sql, (video_id,)).fetchone()
+        if row is None:
+            metrics.active.inc('cache_misses', cache='recommendations')
+            return None
+        cached_splits, recs, fetched_at = row
+        age = time.time() - fetched_at
+        if age > self.ttl or cached_splits < n_splits:
+            metrics.active.inc('cache_misses', cache='recommendations')
+            return None
+        metrics.active.inc('cache_hits', cache='recommendations')
+        return json.loads(recs)[:n_splits], age
+
+
+    def put(self, video_id, n_splits, recs):
+        """
+        Stores the recommendations scraped for video_id with n_splits
+        """
+        sql = '''
+        INSERT OR REPLACE INTO recommendation_cache
+        (video_id, n_splits, recommendations, fetched_at)
+        VALUES (?,?,?,?)'''
+        with self.lock:
+            try:
+                self.conn.execute(sql, (video_id, n_splits, json.dumps(list(recs)), time.time()))
+                self.conn.commit()
+            except sqlite3.Error as e:
+                self.conn.rollback()
+                metrics.active.inc('cache_write_errors', cache='recommendations')
+                logger.warning("Could not cache the recommendations for {}: {!r}"
+                               .format(video_id, e))
+
+
+    def purge(self):
+        """
+        Deletes expired entries
+
+        OUTPUT:
+            (int) number of entries deleted
+        """
+        sql = 'DELETE FROM recommendation_cache WHERE fetched_at < ?'
+        with self.lock:
+            n_deleted = self.conn.execute(sql, (time.time() - self.ttl,)).rowcount
+            self.conn.commit()
+        return n_deleted
+
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+
+# seconds each metadata field may be served from the cache: descriptive fields
+# rarely change, counters change constantly
+VIDEO_TTLS = {'title': 30*24*60*60,
+              'postdate': 30*24*60*60,
+              'description': 30*24*60*60,
+              'category': 30*24*60*60,
+              'channel_id': 30*24*60*60,
+              'likes': 6*60*60,
+              'dislikes': 6*60*60,
+              'views': 6*60*60,
+              'n_comments': 6*60*60}
+
+CHANNEL_TTLS = {'name': 30*24*60*60,
+                'country': 30*24*60*60,
+                'date_created': 30*24*60*60,
+                'categories': 7*24*60*60,
+                'n_subscribers': 6*60*60,
+                'n_videos': 6*60*60,
+                'n_views': 6*60*60}
+
+
+class MetadataCache():
+    def __init__(self, db_path='data/cache.sqlite', kind='video', ttls=None):
+        """
+        Persistent cache of Data API metadata with per-field staleness: every
+        field is timestamped separately and expires after its own TTL. Entries
+        that can't be written are logged and just not cached.
+
+        INPUT:
+            db_path: (str) where the sqlite cache lives
+            kind: (str) 'video' or 'channel'; selects the table and default TTLs
+            ttls: (dict) seconds each field stays valid, e.g. VIDEO_TTLS
+        """
+        if ttls is None:
+            ttls = VIDEO_TTLS if kind == 'video' else CHANNEL_TTLS
+        self.ttls = ttls
+        self.kind = kind
+        self.table = '{}_metadata_cache'.format(kind)
+        self.lock = threading.Lock()
+        self.conn = connect(db_path)
+        self.conn.execute('''
+        CREATE TABLE IF NOT EXISTS {} (
+          id text PRIMARY KEY,
+          data text NOT NULL,
+          fetched_at text NOT NULL
+        )'''.format(self.table))
+        self.conn.commit()
+
+
+    def _load(self, ids):
+        """
+        Returns {id: (data, fetched_at)} for the ids in the cache. Caller holds the lock.
+        """
+        entries = {}
+        batch_size = 500  # stay under sqlite's bound parameter limit
+        for ix in range(0, len(ids), batch_size):
+            batch = ids[ix: ix + batch_size]
+            sql = ('SELECT id, data, fetched_at FROM {} WHERE id IN ({})'
+                   .format(self.table, ','.join('?' * len(batch))))
+            for id_, data, fetched_at in self.conn.execute(sql, batch):
+                entries[id_] = (json.loads(data), json.loads(fetched_at))
+        return entries
+
+
+    def get(self, ids):
+        """
+        Looks up the metadata for ids
+
+        INPUT:
+            ids: (list) video or channel ids
+
+        OUTPUT:
+            fresh: (dict) metadata for the ids with no stale fields: fresh[id] = {}
+            stale: (dict) set of fields to refetch for every other id: stale[id] = set()
+        """
+        ids = list(ids)
+        with self.lock:
+            entries = self._load(ids)
+        now = time.time()
+        fresh = {}
+        stale = {}
+        for id_ in ids:
+            if id_ not in entries:
+                stale[id_] = set(self.ttls)
+                continue
+            data, fetched_at = entries[id_]
+            stale_fields = set(field for field, ttl in self.ttls.items()
+                               if now - fetched_at.get(field, 0) > ttl)
+            if stale_fields:
+                stale[id_] = stale_fields
+            else:
+                fresh[id_] = data
+        metrics.active.inc('cache_hits', len(fresh), cache=self.kind)
+        metrics.active.inc('cache_misses', len(stale), cache=self.kind)
+        return fresh, stale
+
+
+    def put(self, metadata):
+        """
+        Stores freshly fetched fields, keeping any cached fields not in metadata
+
+        INPUT:
+            metadata: (dict) fields fetched for each id: metadata[id] = {}
+
+        OUTPUT:
+            result: (dict) the merged cache entry for each id in metadata
+        """
+        sql = ('INSERT OR REPLACE INTO {} (id, data, fetched_at) VALUES (?,?,?)'
+               .format(self.table))
+        now = time.time()
+        result = {}
+        rows = []
+        with self.lock:
+            try:
+                entries = self._load(list(metadata))
+            except sqlite3.Error as e:
+                # the result then only has the fields just fetched
+                logger.warning("Could not read the {} metadata cache: {!r}".format(self.kind, e))
+                entries = {}
+            for id_, fields in metadata.items():
+                data, fetched_at = entries.get(id_, ({}, {}))
+                data.update(fields)
+                fetched_at.update({field: now for field in fields})
+                result[id_] = data
+                rows.append([id_, json.dumps(data), json.dumps(fetched_at)])
+            try:
+                self.conn.executemany(sql, rows)
+                self.conn.commit()
+            except sqlite3.Error as e:
+                self.conn.rollback()
+                metrics.active.inc('cache_write_errors', cache=self.kind)
+                logger.warning("Could not cache the metadata of {} {}s: {!r}"
+                               .format(len(rows), self.kind, e))
+        return result
+
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
@@ -0,0 +1,242 @@
+from array import array
+from collections.abc import Mapping
+
+from .utils import CHANNEL_PARTS, VIDEO_PARTS
+
+
+class VideoIds():
+    def __init__(self):
+        """
+        Interning table of video_ids: each video_id is stored once and
+        referred to by its integer node, in order of first appearance
+        """
+        self.index = {}
+        self.ids = []
+
+
+    def __len__(self):
+        return len(self.ids)
+
+
+    def __getitem__(self, node):
+        return self.ids[node]
+
+
+    def __iter__(self):
+        return iter(self.ids)
+
+
+    def get(self, video_id):
+        """
+        Node of video_id, -1 if it has not been interned
+        """
+        return self.index.get(video_id, -1)
+
+
+    def intern(self, video_id):
+        """
+        Node of video_id, adding it if needed
+        """
+        node = self.index.get(video_id)
+        if node is None:
+            # e.g. numpy strings from sampling
+            video_id = str(video_id)
+            node = len(self.ids)
+            self.index[video_id] = node
+            self.ids.append(video_id)
+        return node
+
+
+class SearchInfo(Mapping):
+    def __init__(self, search_id=None, ids=None, recommendations=True):
+        """
+        The videos visited by a crawl, with their depth and recommendations.
+        Reads like the dict of dicts the crawler used to keep,
+        search_info[video_id] = {'search_id', 'recommendations', 'depth'},
+        but video_ids are interned (see VideoIds) and the depths and
+        recommendations live in flat arrays of nodes: the recommendations of
+        the i-th visited video are indices[indptr[i]:indptr[i + 1]].
+
+        INPUT:
+            search_id: (int) reported in every entry
+            ids: (VideoIds) interning table, e.g. shared with a MetadataTable
+            recommendations: (bool) whether to keep the recommendations; if
+                             not (a streaming crawl writes them as it goes),
+                             entries are just {'depth': depth}
+        """
+        self.search_id = search_id
+        self.ids = ids if ids is not None else VideoIds()
+        self.keep_recommendations = recommendations
+        # visit order of each node, -1 if not visited
+        self.order = array('i')
+        self.nodes = array('i')
+        self.depths = array('i')
+        self.indptr = array('q', [0])
+        self.indices = array('i')
+
+
+    def __len__(self):
+        return len(self.nodes)
+
+
+    def __iter__(self):
+        ids = self.ids
+        return (ids[node] for node in self.nodes)
+
+
+    def __contains__(self, video_id):
+        node = self.ids.get(video_id)
+        return 0 <= node < len(self.order) and self.order[node] >= 0
+
+
+    def __getitem__(self, video_id):
+        node = self.ids.get(video_id)
+        if node < 0 or node >= len(self.order) or self.order[node] < 0:
+            raise KeyError(video_id)
+        i = self.order[node]
+        if not self.keep_recommendations:
+            return {'depth': self.depths[i]}
+        recs = [self.ids[rec] for rec in self.indices[self.indptr[i]:self.indptr[i + 1]]]
+        return {'search_id': self.search_id, 'recommendations': recs, 'depth': self.depths[i]}
+
+
+    def add(self, video_id, recommendations, depth):
+        """
+        Records a visited video
+
+        INPUT:
+            video_id: (str)
+            recommendations: (list) video_ids it recommends
+            depth: (int)
+        """
+        node = self.ids.intern(video_id)
+        if node < len(self.order) and self.order[node] >= 0:
+            raise ValueError("{} has already been visited".format(video_id))
+        if self.keep_recommendations:
+            self.indices.extend([self.ids.intern(rec) for rec in recommendations])
+        if len(self.order) < len(self.ids):
+            self.order.extend(array('i', [-1]) * (len(self.ids) - len(self.order)))
+        self.order[node] = len(self.nodes)
+        self.nodes.append(node)
+        self.depths.append(depth)
+        self.indptr.append(len(self.indices))
+
+
+    def update(self, search_info):
+        """
+        Adds the videos of a dict like search_info[video_id] = {'depth': ...,
+        'recommendations': [...]} (recommendations optional), e.g. from a
+        checkpoint taken before the state was compact
+        """
+        for video_id, data in search_info.items():
+            self.add(video_id, data.get('recommendations', []), data['depth'])
+
+
+    def to_dict(self):
+        """
+        JSON-serializable snapshot (see load)
+        """
+        return {'ids': list(self.ids),
+                'nodes': self.nodes.tolist(),
+                'depths': self.depths.tolist(),
+                'indptr': self.indptr.tolist(),
+                'indices': self.indices.tolist()}
+
+
+    def load(self, state):
+        """
+        Adds the videos of a to_dict snapshot
+        """
+        ids, indptr, indices = state['ids'], state['indptr'], state['indices']
+        for i, (node, depth) in enumerate(zip(state['nodes'], state['depths'])):
+            recs = [ids[rec] for rec in indices[indptr[i]:indptr[i + 1]]]
+            self.add(ids[node], recs, depth)
+
+
+class Record():
+    # fields, set by subclasses
+    __slots__ = ()
+
+    def __init__(self, data):
+        """
+        Metadata of a video or channel as a fixed set of fields (None when
+        missing) instead of a dict. Fields are read like dict entries,
+        record['channel_id'].
+
+        INPUT:
+            data: (dict) e.g. from utils.get_metadata; other keys are dropped
+        """
+        for field in self.__slots__:
+            setattr(self, field, data.get(field))
+
+
+    def __getitem__(self, field):
+        if field not in self.__slots__:
+            raise KeyError(field)
+        return getattr(self, field)
+
+
+    def to_dict(self):
+        """
+        The fields that are set
+        """
+        return {field: getattr(self, field) for field in self.__slots__
+                if getattr(self, field) is not None}
+
+
+class VideoRecord(Record):
+    __slots__ = [field for fields in VIDEO_PARTS.values() for field in fields]
+
+
+class ChannelRecord(Record):
+    __slots__ = [field for fields in CHANNEL_PARTS.values() for field in fields]
+
+
+class MetadataTable(Mapping):
+    def __init__(self, record, ids=None):
+        """
+        Video or channel metadata of a crawl, metadata[id] = record
+
+        INPUT:
+            record: (type) VideoRecord or ChannelRecord
+            ids: (VideoIds) if given, keys are replaced by the interned video_id
+                 so they are not stored twice
+        """
+        self.record = record
+        self.ids = ids
+        self.records = {}
+
+
+    def __len__(self):
+        return len(self.records)
+
+
+    def __iter__(self):
+        return iter(self.records)
+
+
+    def __contains__(self, id_):
+        return id_ in self.records
+
+
+    def __getitem__(self, id_):
+        return self.records[id_]
+
+
+    def update(self, metadata):
+        """
+        Adds (or replaces) the metadata of a dict: metadata[id] = {}
+        """
+        for id_, data in metadata.items():
+            if self.ids is not None:
+                id_ = self.ids[self.ids.intern(id_)]
+            if not isinstance(data, self.record):
+                data = self.record(data)
+            self.records[id_] = data
+
+
+    def to_dict(self):
+        """
+        JSON-serializable snapshot, in the format update takes
+        """
+        return {id_: record.to_dict() for id_, record in self.records.items()}
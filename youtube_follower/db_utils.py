@@ -1,9 +1,32 @@
+import hashlib
+import json
+import os
+import queue
+import re
 import sqlite3
+import threading
+import time
+from concurrent.futures import Future
 from sqlite3 import Error
 
+from . import metrics
+
+MIGRATIONS_DIR = os.path.join(os.path.dirname(__file__), 'migrations')
+
+# set on every connection. WAL lets readers (analysis, other crawls) run
+# alongside the writer, and with WAL synchronous=NORMAL is still crash-safe
+PRAGMAS = ['PRAGMA journal_mode = WAL',
+		   'PRAGMA synchronous = NORMAL',
+		   'PRAGMA busy_timeout = 30000',
+		   'PRAGMA cache_size = -65536',
+		   'PRAGMA temp_store = MEMORY',
+		   'PRAGMA mmap_size = 268435456']
+
+
 def create_connection(db_path):
 	"""
-	Creates the sqlite3 connection
+	Creates the sqlite3 connection, tunes it and brings the database schema
+	up to date (see migrate)
 
 	INTPUT:
 		db_path: (str) relative path to sqlite db
@@ -15,8 +38,89 @@ def create_connection(db_path):
 		conn = sqlite3.connect(db_path)
 	except Error as e:
 		print(e)
+	for pragma in PRAGMAS:
+		conn.execute(pragma)
+	migrate(conn)
 	return conn
 
+
+def migrations():
+	"""
+	Returns the migration scripts as a list of (version, path), in order.
+	Migrations are the files NNNN_description.sql in youtube_follower/migrations.
+	"""
+	result = []
+	for file in os.listdir(MIGRATIONS_DIR):
+		match = re.match(r'(\d+)_.*\.sql$', file)
+		if match:
+			result.append((int(match.group(1)), os.path.join(MIGRATIONS_DIR, file)))
+	return sorted(result)
+
+
+def split_statements(sql):
+	"""
+	Splits a script into its statements (semicolons in comments and strings
+	are fine)
+	"""
+	statements = []
+	statement = ''
+	for line in sql.splitlines(True):
+		statement += line
+		if sqlite3.complete_statement(statement):
+			statements.append(statement)
+			statement = ''
+	if statement.strip():
+		statements.append(statement)
+	return statements
+
+
+def migrate(conn):
+	"""
+	Applies the migrations the database has not had yet, each in its own
+	transaction, so existing databases are upgraded in place. The schema
+	version is kept in PRAGMA user_version. Safe to call from several
+	processes at once: the version is rechecked under the write lock.
+
+	INPUT:
+		conn: sqlite3 connection
+
+	OUTPUT:
+		version: (int) schema version of the database
+	"""
+	conn.create_function('content_hash', -1, content_hash)
+	available = migrations()
+	latest = available[-1][0] if available else 0
+	cur = conn.cursor()
+	version = cur.execute('PRAGMA user_version').fetchone()[0]
+	if version >= latest:
+		return version
+	conn.commit()
+	for number, path in available:
+		cur.execute('BEGIN IMMEDIATE')
+		try:
+			version = cur.execute('PRAGMA user_version').fetchone()[0]
+			if number <= version:
+				conn.rollback()
+				continue
+			with open(path, 'r') as f:
+				for statement in split_statements(f.read()):
+					cur.execute(statement)
+			cur.execute('PRAGMA user_version = {}'.format(number))
+			conn.commit()
+		except:
+			conn.rollback()
+			raise
+	return cur.execute('PRAGMA user_version').fetchone()[0]
+
+def content_hash(*values):
+	"""
+	Identifies a video / channel snapshot by its static fields. Connections
+	that have been through migrate can also call it in SQL.
+	"""
+	values = [None if value is None else str(value) for value in values]
+	return hashlib.sha1(json.dumps(values).encode('utf-8')).hexdigest()
+
+
 def create_record(conn, table, data):
 	"""
 	Inserts "data" into "table"
@@ -36,23 +140,41 @@ def create_record(conn, table, data):
 		(root_video, n_splits, depth, date, sample, const_depth)
 		VALUES (?,?,?,?,?,?)'''
 		cur.execute(sql, data)
-		# return the id of the newly created record
-		sql = 'SELECT max(search_id) FROM searches'
-		search_id = cur.execute(sql).fetchone()[0]
-		return search_id
+		# return the id of the newly created record (max(search_id) could be
+		# another crawl's)
+		return cur.lastrowid
 	elif table == "videos":
+		# data rows: video_id, search_id, title, postdate, description, category,
+		# channel_id, likes, dislikes, views, n_comments. The static fields go
+		# to a snapshot shared by every search that saw the same version.
+		data = [(row, content_hash(row[0], row[2], row[6], row[3], row[4], row[5]))
+				for row in data]
 		sql = '''
-		INSERT INTO videos 
-		(video_id, search_id, title, postdate, description, category, 
-		channel_id, likes, dislikes, views, n_comments)
-		VALUES (?,?,?,?,?,?,?,?,?,?,?)'''
+		INSERT OR IGNORE INTO video_snapshots
+		(video_id, content_hash, title, channel_id, postdate, description, category)
+		VALUES (?,?,?,?,?,?,?)'''
+		cur.executemany(sql, [(row[0], key, row[2], row[6], row[3], row[4], row[5])
+							  for row, key in data])
+		sql = '''
+		INSERT INTO video_stats
+		(video_id, search_id, snapshot_id, likes, dislikes, views, n_comments)
+		VALUES (?,?,(SELECT snapshot_id FROM video_snapshots WHERE content_hash = ?),?,?,?,?)'''
+		data = [(row[0], row[1], key, row[7], row[8], row[9], row[10]) for row, key in data]
 	elif table == "channels":
+		# data rows: channel_id, search_id, name, country, date_created,
+		# n_subscribers, n_videos, n_views
+		data = [(row, content_hash(row[0], row[2], row[3], row[4])) for row in data]
+		sql = '''
+		INSERT OR IGNORE INTO channel_snapshots
+		(channel_id, content_hash, name, country, date_created)
+		VALUES (?,?,?,?,?)'''
+		cur.executemany(sql, [(row[0], key, row[2], row[3], row[4]) for row, key in data])
 		sql = '''
-		INSERT INTO channels
-		(channel_id, search_id, name, country, date_created, 
-		n_subscribers, n_videos, n_views)
-		VALUES (?,?,?,?,?,?,?,?)
+		INSERT INTO channel_stats
+		(channel_id, search_id, snapshot_id, n_subscribers, n_videos, n_views)
+		VALUES (?,?,(SELECT snapshot_id FROM channel_snapshots WHERE content_hash = ?),?,?,?)
 		'''
+		data = [(row[0], row[1], key, row[5], row[6], row[7]) for row, key in data]
 	elif table == "recommendations":
 		sql = '''
 		INSERT INTO recommendations
@@ -86,3 +208,411 @@ def record_exists(conn, table, col, val):
 	cur = conn.cursor()
 	return bool(cur.execute(sql).fetchall())
 
+
+
+class BatchWriter():
+	def __init__(self, conn, batch_size=1000):
+		"""
+		Buffers rows per table and writes them with create_record, committing
+		a transaction every batch_size rows so memory stays bounded
+
+		INPUT:
+			conn: sqlite3 connection
+			batch_size: (int) max rows buffered per table
+		"""
+		self.conn = conn
+		self.batch_size = batch_size
+		self.buffers = {}
+
+	def add(self, table, rows):
+		"""
+		Queues rows (iterable of lists) for insertion into table
+		"""
+		buffer = self.buffers.setdefault(table, [])
+		buffer.extend(rows)
+		if len(buffer) >= self.batch_size:
+			self.flush(table)
+
+	def flush(self, table=None):
+		"""
+		Writes out the rows buffered for table (all tables if None)
+		"""
+		tables = [table] if table is not None else list(self.buffers)
+		for name in tables:
+			rows = self.buffers.pop(name, [])
+			if rows:
+				with metrics.active.timer('db_insert', table=name):
+					create_record(self.conn, name, rows)
+				metrics.active.inc('rows_written', len(rows), table=name)
+		with metrics.active.timer('db_commit'):
+			self.conn.commit()
+
+
+class QueueWriter():
+	def __init__(self, queue, batch_size=1000, sender=None):
+		"""
+		Client of a DatabaseWriter running in another process: buffers rows
+		per table like BatchWriter and sends full batches to the writer.
+		Sending does not wait for the rows to be written: if they fail, the
+		writer records the error under sender and refuses the sender's later
+		calls (e.g. finish_search), see DatabaseWriter.
+
+		INPUT:
+			queue: (multiprocessing.Queue) a DatabaseWriter listens to
+			batch_size: (int) max rows buffered per table
+			sender: (hashable) tags the messages, e.g. the search_id of the
+					crawl using this writer
+		"""
+		self.queue = queue
+		self.batch_size = batch_size
+		self.sender = sender
+		self.buffers = {}
+
+	def add(self, table, rows):
+		buffer = self.buffers.setdefault(table, [])
+		buffer.extend(rows)
+		if len(buffer) >= self.batch_size:
+			self.flush(table)
+
+	def flush(self, table=None):
+		"""
+		Sends the rows buffered for table (all tables if None) to the writer
+		"""
+		tables = [table] if table is not None else list(self.buffers)
+		for name in tables:
+			rows = self.buffers.pop(name, [])
+			if rows:
+				self.queue.put(('rows', name, rows, self.sender))
+
+	def call(self, fn, *args):
+		"""
+		Has the writer run fn(conn, *args) (fn must be picklable, e.g.
+		finish_search) after the rows sent so far. Its result is not returned.
+		"""
+		self.flush()
+		self.queue.put(('call', None, fn, args, self.sender))
+
+
+class WriterClient():
+	def __init__(self, writer, sender):
+		"""
+		A DatabaseWriter as seen by one crawl (see DatabaseWriter.client):
+		its rows and calls are tagged with sender, so that a failed write is
+		reported to this crawl only
+
+		INPUT:
+			writer: (DatabaseWriter)
+			sender: (hashable) e.g. the search_id of the crawl
+		"""
+		self.writer = writer
+		self.sender = sender
+
+	def add(self, table, rows):
+		self.writer.add(table, rows, sender=self.sender)
+
+	def flush(self, table=None):
+		self.writer.flush(sender=self.sender)
+
+	def call(self, fn, *args):
+		return self.writer.call(fn, *args, sender=self.sender)
+
+
+class DatabaseWriter():
+	def __init__(self, db_path, batch_size=10000, max_delay=1.0):
+		"""
+		Writer service: a thread that owns the only connection writing to the
+		database. Crawls hand it rows through add (threads of this process)
+		or a QueueWriter (other processes, see listen), and it writes
+		them in large transactions, committing every batch_size rows or
+		max_delay seconds, whichever comes first. With a single writer
+		there is no lock contention between crawls.
+
+		Rows are tagged with their sender (e.g. a search_id). When a batch
+		fails, its messages are retried one by one, so a bad message only
+		loses its own rows. The error is recorded under its sender (see
+		errors): the sender's next flush or call raises it instead of
+		running, and nothing else is dropped.
+
+		INPUT:
+			db_path: (str) where the sqlite database lives
+			batch_size: (int) rows per transaction
+			max_delay: (float) max seconds rows wait before being committed
+		"""
+		self.db_path = db_path
+		self.batch_size = batch_size
+		self.max_delay = max_delay
+		self.inbox = queue.Queue()
+		self.remotes = []
+		# first failed write of each sender; failed writes of untagged rows
+		# are raised on close
+		self.errors = {}
+		self.error = None
+		# its writes record to the metrics of the thread creating it
+		self.thread = threading.Thread(target=metrics.bind(self.run), daemon=True)
+		self.thread.start()
+
+	def listen(self, remote):
+		"""
+		Takes messages from QueueWriters in other processes
+
+		INPUT:
+			remote: (multiprocessing.Queue) the QueueWriters' queue. Fork the
+					processes before creating the writer: forking while its
+					thread holds sqlite's locks can deadlock the children.
+		"""
+		forwarder = threading.Thread(target=self.forward, args=(remote,), daemon=True)
+		forwarder.start()
+		self.remotes.append((remote, forwarder))
+
+	def forward(self, remote):
+		while True:
+			message = remote.get()
+			if message is None:
+				break
+			self.inbox.put(message)
+
+	def client(self, sender):
+		"""
+		WriterClient tagging everything it sends with sender
+		"""
+		return WriterClient(self, sender)
+
+	def add(self, table, rows, sender=None):
+		"""
+		Queues rows (list of lists) for insertion into table
+		"""
+		self.inbox.put(('rows', table, list(rows), sender))
+
+	def request(self, kind, *args):
+		future = Future()
+		self.inbox.put((kind, future) + args)
+		return future.result()
+
+	def flush(self, table=None, sender=None):
+		"""
+		Blocks until every row queued so far is committed. Raises the error
+		of sender's rows if any of them could not be written.
+		"""
+		self.request('flush', sender)
+
+	def create_search(self, data):
+		"""
+		Inserts a row into searches
+
+		INPUT:
+			data: (list) root_video, n_splits, depth, date, sample, const_depth
+
+		OUTPUT:
+			search_id: (int) id of the new search
+		"""
+		return self.request('call', create_record, ("searches", data), None)
+
+	def call(self, fn, *args, sender=None):
+		"""
+		Runs fn(conn, *args) on the writer's connection, after the rows queued
+		so far are committed, and returns its result (e.g. save_checkpoint).
+		Raises the error of sender's rows instead if any of them failed.
+		"""
+		return self.request('call', fn, args, sender)
+
+	def close(self):
+		"""
+		Commits what is left and stops the writer (and its forwarders)
+		"""
+		for remote, forwarder in self.remotes:
+			remote.put(None)
+			forwarder.join()
+		self.inbox.put(None)
+		self.thread.join()
+		if self.error is not None:
+			raise self.error
+
+	def fail(self, sender, error):
+		if sender is None:
+			# nobody is waiting for these rows; report it on close
+			self.error = self.error or error
+		else:
+			self.errors.setdefault(sender, error)
+
+	def insert(self, conn, table, rows):
+		"""
+		Inserts rows into table in a savepoint, so that a failure leaves the
+		rest of the transaction as it was
+		"""
+		if not conn.in_transaction:
+			conn.execute('BEGIN')
+		conn.execute('SAVEPOINT write')
+		try:
+			with metrics.active.timer('db_insert', table=table):
+				create_record(conn, table, rows)
+		except Exception:
+			conn.execute('ROLLBACK TO write')
+			raise
+		finally:
+			conn.execute('RELEASE write')
+		metrics.active.inc('rows_written', len(rows), table=table)
+
+	def write(self, conn, messages):
+		"""
+		Writes and commits the rows of messages, [(table, rows, sender)].
+		The rows of each table are inserted at once; if that fails, the
+		table's messages are inserted one by one and the failing ones are
+		recorded under their sender (see fail). If the commit fails, every
+		message is retried in a transaction of its own.
+		"""
+		tables = {}
+		for message in messages:
+			tables.setdefault(message[0], []).append(message)
+		try:
+			for table, batch in tables.items():
+				try:
+					self.insert(conn, table, [row for _, rows, _ in batch for row in rows])
+				except Exception:
+					for _, rows, sender in batch:
+						try:
+							self.insert(conn, table, rows)
+						except Exception as e:
+							self.fail(sender, e)
+			with metrics.active.timer('db_commit'):
+				conn.commit()
+		except Exception:
+			conn.rollback()
+			for table, rows, sender in messages:
+				try:
+					self.insert(conn, table, rows)
+					conn.commit()
+				except Exception as e:
+					conn.rollback()
+					self.fail(sender, e)
+
+	def run(self):
+		conn = create_connection(self.db_path)
+		pending = []
+		n_pending = 0
+		deadline = None
+		while True:
+			timeout = None if deadline is None else max(0, deadline - time.time())
+			try:
+				message = self.inbox.get(timeout=timeout)
+			except queue.Empty:
+				message = ('flush', None, None)
+			if message is None:
+				break
+			if message[0] == 'rows':
+				# commit all tables at once, every batch_size rows
+				table, rows, sender = message[1:]
+				pending.append((table, rows, sender))
+				n_pending += len(rows)
+				if deadline is None:
+					deadline = time.time() + self.max_delay
+				if n_pending < self.batch_size:
+					continue
+			self.write(conn, pending)
+			pending = []
+			n_pending = 0
+			deadline = None
+			if message[0] == 'rows':
+				continue
+
+			future, sender = message[1], message[-1]
+			error = self.errors.get(sender)
+			result = None
+			if message[0] == 'call' and error is None:
+				fn, args = message[2:4]
+				try:
+					result = fn(conn, *args)
+					conn.commit()
+				except Exception as e:
+					conn.rollback()
+					error = e
+					if future is None:
+						self.fail(sender, e)
+			if future is None:
+				continue
+			if error is None:
+				future.set_result(result)
+			else:
+				future.set_exception(error)
+		self.write(conn, pending)
+		conn.close()
+
+
+def save_checkpoint(conn, search_id, depth, state):
+	"""
+	Stores (replacing any previous one) the checkpoint of a running crawl
+
+	INPUT:
+		conn: sqlite3 connection
+		search_id: (int)
+		depth: (int) depth the crawl is at
+		state: (dict) JSON-serializable crawl state
+	"""
+	cur = conn.cursor()
+	sql = '''
+	INSERT OR REPLACE INTO checkpoints
+	(search_id, depth, state, updated_at)
+	VALUES (?,?,?,datetime('now'))'''
+	cur.execute(sql, (search_id, depth, json.dumps(state)))
+	conn.commit()
+
+
+def load_checkpoint(conn, search_id):
+	"""
+	Returns the state stored by save_checkpoint for search_id, None if there is none
+	"""
+	cur = conn.cursor()
+	sql = 'SELECT state FROM checkpoints WHERE search_id = ?'
+	row = cur.execute(sql, (search_id,)).fetchone()
+	return json.loads(row[0]) if row else None
+
+
+def finish_search(conn, search_id):
+	"""
+	Marks search_id as finished (searches.finished_at): every row of the
+	crawl has been written
+	"""
+	cur = conn.cursor()
+	cur.execute("UPDATE searches SET finished_at = datetime('now') WHERE search_id = ?",
+				(search_id,))
+	conn.commit()
+
+
+def delete_checkpoint(conn, search_id):
+	"""
+	Drops the checkpoint of a finished crawl
+	"""
+	cur = conn.cursor()
+	cur.execute('DELETE FROM checkpoints WHERE search_id = ?', (search_id,))
+	conn.commit()
+
+
+# table holding the per-search rows of each crawl table (the videos /
+# channels views live in their stats tables), and its integer primary key.
+# Unlike implicit rowids the keys survive VACUUM, so they can be saved in
+# checkpoints.
+ROW_TABLES = {'videos': ('video_stats', 'stats_id'),
+			  'channels': ('channel_stats', 'stats_id'),
+			  'channel_categories': ('channel_categories', 'category_row_id'),
+			  'recommendations': ('recommendations', 'rec_id')}
+
+
+def max_rowids(conn, search_id, tables):
+	"""
+	Returns the largest primary key each table holds for search_id (0 if none)
+	"""
+	cur = conn.cursor()
+	sql = 'SELECT coalesce(max({1}), 0) FROM {0} WHERE search_id = ?'
+	return {table: cur.execute(sql.format(*ROW_TABLES[table]), (search_id,)).fetchone()[0]
+			for table in tables}
+
+
+def delete_after(conn, search_id, rowids):
+	"""
+	Deletes the rows of search_id written after max_rowids returned rowids
+	"""
+	cur = conn.cursor()
+	sql = 'DELETE FROM {0} WHERE search_id = ? AND {1} > ?'
+	for table, rowid in rowids.items():
+		# snapshots the deleted rows pointed to are left: other searches may share them
+		cur.execute(sql.format(*ROW_TABLES[table]), (search_id, rowid))
+	conn.commit()
@@ -0,0 +1,176 @@
+import json
+import os
+import shutil
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+
+# tables exported by default, all keyed by search_id
+TABLES = ['searches', 'videos', 'channels', 'channel_categories',
+          'recommendations', 'recommendations_full']
+
+# arrow types of the declared sqlite column types
+ARROW_TYPES = {'INTEGER': pa.int64(), 'REAL': pa.float64(), 'TEXT': pa.string()}
+
+STATE_FILE = '_export_state.json'
+
+
+def table_schema(conn, table):
+    """
+    Arrow schema of a table (or view) from its declared column types.
+    search_id is always an integer.
+    """
+    fields = []
+    for _, name, decl_type, _, _, _ in conn.execute("PRAGMA table_info({})".format(table)):
+        if name == 'search_id':
+            fields.append(pa.field(name, pa.int64()))
+        else:
+            fields.append(pa.field(name, ARROW_TYPES.get(decl_type.upper(), pa.string())))
+    return pa.schema(fields)
+
+
+def finished_searches(conn):
+    """
+    Searches with recommendations whose crawl has finished
+    (searches.finished_at is set once all of its rows are written)
+    """
+    sql = '''
+    SELECT search_id FROM searches s
+    WHERE finished_at IS NOT NULL
+      AND EXISTS (SELECT 1 FROM recommendations r WHERE r.search_id = s.search_id)
+    ORDER BY search_id'''
+    return [search_id for search_id, in conn.execute(sql)]
+
+
+def load_state(outdir, partition_by):
+    path = os.path.join(outdir, STATE_FILE)
+    if not os.path.exists(path):
+        return {'partition_by': partition_by, 'exported': {}}
+    with open(path) as f:
+        state = json.load(f)
+    if state['partition_by'] != partition_by:
+        raise ValueError("{} is partitioned by {}, not {}"
+                         .format(outdir, state['partition_by'], partition_by))
+    return state
+
+
+def save_state(outdir, state):
+    path = os.path.join(outdir, STATE_FILE)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(state, f)
+    os.replace(path + '.tmp', path)
+
+
+def export_table(conn, table, search_ids, outdir, partition_by='search_id', chunk_size=500000):
+    """
+    Writes the rows of search_ids in table to Parquet files under
+    outdir/table. Files are only ever added: each call writes new ones,
+    named after the first and last search they hold.
+
+    INPUT:
+        conn: (sqlite3.Connection) to the crawl database
+        table: (str)
+        search_ids: (list) searches to export
+        outdir: (str) root of the export
+        partition_by: (str) 'search_id' or 'date' (the date of the search,
+                      as column search_date); searches is never partitioned
+        chunk_size: (int) rows read from sqlite (and written) at a time
+    """
+    schema = table_schema(conn, table)
+    columns = ', '.join('CAST(t.search_id AS INTEGER) AS search_id' if name == 'search_id'
+                        else 't.' + name for name in schema.names)
+    partition_cols = []
+    if table != 'searches':
+        partition_cols = ['search_id'] if partition_by == 'search_id' else ['search_date']
+    if partition_cols == ['search_date']:
+        schema = schema.append(pa.field('search_date', pa.string()))
+        columns += ', s.date AS search_date'
+
+    # write next to the export and move the files in when done
+    tmp_dir = os.path.join(outdir, '_tmp', table)
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    sql = '''
+    SELECT {} FROM {} t
+    JOIN searches s
+      ON s.search_id = t.search_id
+    WHERE t.search_id IN ({})'''
+    basename = 'part-{}-{}'.format(min(search_ids), max(search_ids))
+    # keep the number of sqlite parameters small
+    for first in range(0, len(search_ids), 500):
+        ids = search_ids[first:first + 500]
+        query = sql.format(columns, table, ', '.join('?' * len(ids)))
+        chunks = pd.read_sql_query(query, conn, params=ids, chunksize=chunk_size)
+        for i, df in enumerate(chunks):
+            name = '{}-{}-{}.parquet'.format(basename, first, i)
+            if not partition_cols:
+                os.makedirs(tmp_dir, exist_ok=True)
+                data = pa.Table.from_pandas(df, schema=schema, preserve_index=False)
+                pq.write_table(data, os.path.join(tmp_dir, name))
+                continue
+            # hive-style directories, <column>=<value>, without the column
+            # in the files (pq.write_to_dataset's naming options vary
+            # across pyarrow versions)
+            column = partition_cols[0]
+            part_schema = schema.remove(schema.get_field_index(column))
+            for value, part in df.groupby(column, sort=True):
+                part_dir = os.path.join(tmp_dir, '{}={}'.format(column, value))
+                os.makedirs(part_dir, exist_ok=True)
+                data = pa.Table.from_pandas(part.drop(columns=[column]), schema=part_schema,
+                                            preserve_index=False)
+                pq.write_table(data, os.path.join(part_dir, name))
+
+    for root, _, files in os.walk(tmp_dir):
+        target = os.path.join(outdir, table, os.path.relpath(root, tmp_dir))
+        os.makedirs(target, exist_ok=True)
+        for file in files:
+            os.replace(os.path.join(root, file), os.path.join(target, file))
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+def export(conn, outdir, partition_by='search_id', tables=TABLES, chunk_size=500000):
+    """
+    Exports the crawl tables to Parquet, partitioned by search_id or by the
+    date of the search (see export_table), e.g. for pd.read_parquet or
+    pyarrow.dataset, which read only the columns and partitions asked for.
+    Only searches not exported before are written, so running this after
+    new crawls appends just those. Searches still being crawled (no
+    finished_at yet) are left for a later run, and a search's
+    recommendations_full rows are exported once complete_tree has added
+    them.
+
+    INPUT:
+        conn: (sqlite3.Connection) to the crawl database
+        outdir: (str) root of the export; one directory per table, plus a
+                state file listing the searches exported
+        partition_by: (str) 'search_id' or 'date'; must be the same for
+                      every run into outdir
+        tables: (list) tables to export; missing tables are skipped
+        chunk_size: (int) rows read from sqlite at a time
+
+    OUTPUT:
+        (dict) number of searches exported, by table
+    """
+    if partition_by not in ['search_id', 'date']:
+        raise ValueError("partition_by must be 'search_id' or 'date'")
+    os.makedirs(outdir, exist_ok=True)
+    state = load_state(outdir, partition_by)
+    finished = finished_searches(conn)
+    counts = {}
+    for table in tables:
+        if not conn.execute("SELECT 1 FROM sqlite_master WHERE name = ?", (table,)).fetchone():
+            continue
+        exported = set(state['exported'].get(table, []))
+        search_ids = [search_id for search_id in finished if search_id not in exported]
+        if table == 'recommendations_full':
+            sql = "SELECT 1 FROM recommendations_full WHERE search_id = CAST(? AS TEXT) LIMIT 1"
+            search_ids = [search_id for search_id in search_ids
+                          if conn.execute(sql, (search_id,)).fetchone()]
+        if search_ids:
+            export_table(conn, table, search_ids, outdir, partition_by, chunk_size)
+            state['exported'][table] = sorted(exported.union(search_ids))
+            save_state(outdir, state)
+        counts[table] = len(search_ids)
+    shutil.rmtree(os.path.join(outdir, '_tmp'), ignore_errors=True)
+    return counts
@@ -0,0 +1,73 @@
+import re
+
+
+# opening tag of a related video (parse_soup matches the same class)
+RELATED_ITEM = re.compile(rb'<li\s[^>]*class\s*=\s*["\'][^"\']*related-list-item')
+# first link of a related video
+LINK = re.compile(rb'<a\s[^>]*?href\s*=\s*["\']([^"\']*)["\']')
+ITEM_END = b'</li>'
+
+
+def scan_recommendations(html, n, pos=0, final=True):
+	"""
+	Single pass over raw watch-page bytes for the video_ids linked from
+	related-list-item elements, stopping after n matches.
+
+	INPUT:
+		html: (bytes) page, or as much of it as has been downloaded
+		n: (int) number of recommendations wanted
+		pos: (int) offset to resume scanning from
+		final: (bool) whether html is the complete page. If not, scanning stops
+			   at an item that may be cut off, so it can be rescanned once
+			   more bytes arrive
+
+	OUTPUT:
+		recs: (list) recommended video_ids, in page order
+		pos: (int) offset to resume scanning from
+	"""
+	recs = []
+	while len(recs) < n:
+		item = RELATED_ITEM.search(html, pos)
+		if item is None:
+			if not final:
+				# keep the tail in case it holds the start of an item
+				pos = max(pos, len(html) - 512)
+			break
+		end = html.find(ITEM_END, item.end())
+		if end == -1 and not final:
+			pos = item.start()
+			break
+		link = LINK.search(html, item.end(), end if end != -1 else len(html))
+		if link is not None:
+			href = link.group(1).decode('utf-8', 'replace')
+			recs.append(href.replace('/watch?v=', '').split('&')[0])
+		pos = item.end() if end == -1 else end
+	return recs, pos
+
+
+def read_recommendations(response, n, chunk_size=1 << 16):
+	"""
+	Reads a watch page chunk by chunk, extracting recommendations as the bytes
+	arrive, and stops downloading once n have been found.
+
+	INPUT:
+		response: file-like object, e.g. what urlopen returns
+		n: (int) number of recommendations wanted
+		chunk_size: (int) bytes per read
+
+	OUTPUT:
+		recs: (list) recommended video_ids, at most n
+		html: (bytes) what was read. This is the whole page whenever fewer than
+			  n recommendations were found, so it can be handed to a full parser
+	"""
+	html = bytearray()
+	recs = []
+	pos = 0
+	while len(recs) < n:
+		chunk = response.read(chunk_size)
+		html += chunk
+		new_recs, pos = scan_recommendations(html, n - len(recs), pos, final=not chunk)
+		recs.extend(new_recs)
+		if not chunk:
+			break
+	return recs, bytes(html)
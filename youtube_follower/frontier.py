@@ -0,0 +1,122 @@
+from collections import deque
+
+
+class Frontier():
+    def __init__(self, root_id, seen=None):
+        """
+        BFS frontier for the crawler. Dequeues and membership checks are O(1):
+        levels are deques and dedup uses hashed lookups only.
+
+        INPUT:
+            root_id: (str) video_id at depth 0
+            seen: (container) videos that have already been visited. Shared with
+                  the crawler (e.g. YoutubeFollower.search_info) so recording a
+                  video there marks it as seen; only needs to support `in`
+        """
+        self.seen = seen if seen is not None else set()
+        self.depth = 0
+        self.current = deque([root_id])
+        self.next = deque()
+        # everything in the current level (popped or not) and the next level
+        self.queued = {root_id}
+
+
+    def __len__(self):
+        return len(self.current) + len(self.next)
+
+
+    def __bool__(self):
+        return bool(self.current or self.next)
+
+
+    def advance(self):
+        """
+        Moves on to the next level. Anything left in the current level is dropped.
+        """
+        self.current = self.next
+        self.next = deque()
+        self.queued = set(self.current)
+        self.depth += 1
+
+
+    def pop(self):
+        """
+        Node-by-node expansion: returns the next video to visit, moving on to
+        the next level once the current one is exhausted.
+
+        OUTPUT:
+            depth: (int) depth of the video
+            video_id: (str)
+        """
+        if not self.current:
+            self.advance()
+        return self.depth, self.current.popleft()
+
+
+    def pop_level(self, limit=None):
+        """
+        Level-by-level expansion: returns the remaining videos at the current
+        depth, moving on to the next level first if the current one is exhausted.
+
+        INPUT:
+            limit: (int) return at most this many videos; the rest of the level
+                         is returned by subsequent calls
+
+        OUTPUT:
+            depth: (int) depth of the videos
+            level: (list) video_ids
+        """
+        if not self.current:
+            self.advance()
+        if limit is None or limit >= len(self.current):
+            level = list(self.current)
+            self.current.clear()
+        else:
+            level = [self.current.popleft() for _ in range(limit)]
+        return self.depth, level
+
+
+    def push(self, video_id):
+        """
+        Queues video_id for the next level unless it has been visited or is
+        already queued.
+
+        OUTPUT:
+            bool for whether video_id was queued
+        """
+        if video_id in self.queued or video_id in self.seen:
+            return False
+        self.queued.add(video_id)
+        self.next.append(video_id)
+        return True
+
+
+    def extend(self, video_ids):
+        """
+        Pushes each of video_ids, in order.
+        """
+        for video_id in video_ids:
+            self.push(video_id)
+
+
+    def to_dict(self):
+        """
+        JSON-serializable snapshot of the frontier (see from_dict)
+        """
+        return {'depth': self.depth,
+                'current': list(self.current),
+                'next': list(self.next)}
+
+
+    @classmethod
+    def from_dict(cls, state, seen=None):
+        """
+        Rebuilds a frontier from to_dict output. Videos of the current level that
+        had already been popped must be in seen.
+        """
+        frontier = cls(None, seen=seen)
+        frontier.depth = state['depth']
+        frontier.current = deque(state['current'])
+        frontier.next = deque(state['next'])
+        frontier.queued = set(frontier.current).union(frontier.next)
+        return frontier
@@ -0,0 +1,466 @@
+import json
+import os
+import shutil
+
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+
+
+class ConvergenceError(Exception):
+    """
+    Raised when a power iteration does not converge within its iterations
+    """
+    pass
+
+
+def search_filter(search_ids, column='search_id', finished=False):
+    """
+    SQL condition (and its parameters) restricting column to search_ids
+    (None for every search) and, if finished, to searches whose crawl has
+    finished (searches.finished_at is set)
+    """
+    where, params = ['1'], []
+    if search_ids is not None:
+        search_ids = [int(search_id) for search_id in search_ids]
+        where.append('{} IN ({})'.format(column, ', '.join('?' * len(search_ids))))
+        params += search_ids
+    if finished:
+        where.append('{} IN (SELECT search_id FROM searches WHERE finished_at IS NOT NULL)'
+                     .format(column))
+    return ' AND '.join(where), params
+
+
+def channel_edges(conn, search_ids=None, start_date=None, end_date=None):
+    """
+    Channel recommendation graph, aggregated in SQLite: how often videos of
+    parent_channel recommended videos of child_channel. A video's channel is
+    the one recorded in the search that made the recommendation.
+
+    INPUT:
+        conn: (sqlite3.Connection) to the crawl database
+        search_ids: (list) searches to include; None for all of them
+        start_date, end_date: (str) 'YYYY-MM-DD', only include searches run
+                              on or after / on or before this date
+
+    OUTPUT:
+        (pd.DataFrame) one row per channel pair: parent_channel,
+        child_channel, weight (number of recommendations) and search_count
+        (number of searches with at least one)
+    """
+    where, params = search_filter(search_ids, 's.search_id')
+    if start_date is not None:
+        where += ' AND s.date >= ?'
+        params.append(str(start_date))
+    if end_date is not None:
+        where += ' AND s.date <= ?'
+        params.append(str(end_date))
+    # joining the snapshot tables directly (not the videos view) lets sqlite
+    # look each video up by its (video_id, search_id) key
+    sql = '''
+    SELECT pv.channel_id AS parent_channel, cv.channel_id AS child_channel,
+      count(*) AS weight, count(DISTINCT r.search_id) AS search_count
+    FROM searches s
+    JOIN recommendations r
+      ON r.search_id = s.search_id
+    JOIN video_stats pst
+      ON pst.video_id = r.video_id AND pst.search_id = r.search_id
+    JOIN video_snapshots pv
+      ON pv.snapshot_id = pst.snapshot_id
+    JOIN video_stats cst
+      ON cst.video_id = r.recommendation AND cst.search_id = r.search_id
+    JOIN video_snapshots cv
+      ON cv.snapshot_id = cst.snapshot_id
+    WHERE pv.channel_id IS NOT NULL AND cv.channel_id IS NOT NULL AND {}
+    GROUP BY pv.channel_id, cv.channel_id
+    ORDER BY pv.channel_id, cv.channel_id'''.format(where)
+    return pd.read_sql_query(sql, conn, params=params)
+
+
+# video -> group queries for video_groups
+GROUP_QUERIES = {
+    'leaning': '''
+    SELECT DISTINCT sn.video_id, l.leaning AS grp
+    FROM video_snapshots sn
+    JOIN channel_leanings l
+      ON l.channel_id = sn.channel_id
+    WHERE l.leaning IS NOT NULL''',
+    'category': '''
+    SELECT DISTINCT sn.video_id, cc.category AS grp
+    FROM video_snapshots sn
+    JOIN channel_categories cc
+      ON cc.channel_id = sn.channel_id
+    WHERE cc.category IS NOT NULL'''}
+
+
+def video_groups(conn, graph, by='leaning'):
+    """
+    Which group (leaning or category of its channel) each video of graph is
+    in. Channels can have several categories, so a video can be in several
+    groups, or in none.
+
+    INPUT:
+        conn: (sqlite3.Connection) to the crawl database (with the
+              channel_leanings table for by='leaning')
+        graph: (Graph) of videos
+        by: (str) 'leaning' or 'category'
+
+    OUTPUT:
+        groups: (np.array) group names, sorted
+        membership: (scipy.sparse.csr_matrix) len(graph) x len(groups), 1
+                    where a video is in a group
+    """
+    df = pd.read_sql_query(GROUP_QUERIES[by], conn)
+    rows = graph.index(df.video_id.values)
+    df = df[rows >= 0]
+    rows = rows[rows >= 0]
+    cols, groups = pd.factorize(df.grp.values, sort=True)
+    # the query returns each (video, group) pair once
+    membership = sp.csr_matrix((np.ones(len(rows)), (rows, cols)),
+                               shape=(len(graph), len(groups)))
+    return np.asarray(groups, dtype=str), membership
+
+
+def fetch_pairs(cursor, chunk_size=1000000):
+    """
+    Reads the (int, int) rows of cursor into two int32 arrays, chunk by chunk
+    """
+    chunks = []
+    while True:
+        rows = cursor.fetchmany(chunk_size)
+        if not rows:
+            break
+        chunks.append(np.array(rows, dtype=np.int32).reshape(-1, 2))
+    pairs = np.concatenate(chunks) if chunks else np.empty((0, 2), dtype=np.int32)
+    return pairs[:, 0], pairs[:, 1]
+
+
+class Graph():
+    def __init__(self, matrix, ids, meta=None):
+        """
+        Recommendation graph as a sparse adjacency matrix: matrix[i, j] is
+        the weight of the edge from ids[i] to ids[j], e.g. the number of
+        times video ids[i] recommended ids[j]. Build it with from_db (videos)
+        or from_edges, and save / load snapshots with save and load.
+
+        INPUT:
+            matrix: (scipy.sparse.csr_matrix) n x n adjacency matrix
+            ids: (np.array) video (or channel) id of each row / column, sorted
+            meta: (dict) anything to keep with the snapshot, e.g. the
+                  searches it was built from
+        """
+        self.matrix = matrix
+        self.ids = ids
+        self.meta = meta or {}
+
+
+    def __len__(self):
+        return len(self.ids)
+
+
+    @classmethod
+    def from_db(cls, conn, search_ids=None, weighted=False, finished=False):
+        """
+        Builds the video graph from the recommendations table. Video ids are
+        mapped to integers in SQLite, so only integer pairs reach Python.
+
+        INPUT:
+            conn: (sqlite3.Connection) to the crawl database
+            search_ids: (list) searches to include; None for all of them
+            weighted: (bool) count repeated recommendations; otherwise every
+                      edge has weight 1, as in a networkx DiGraph
+            finished: (bool) only include searches whose crawl has finished,
+                      so that the graph can be updated (see update)
+
+        OUTPUT:
+            (Graph) of every video with an out- or in-edge. Its meta records
+            the options and, if finished, the searches included
+            (merged_search_ids).
+        """
+        where, params = search_filter(search_ids, finished=finished)
+        conn.execute("DROP TABLE IF EXISTS temp.graph_ids")
+        conn.execute('''
+        CREATE TEMP TABLE graph_ids (
+          idx integer PRIMARY KEY,
+          video_id text UNIQUE NOT NULL
+        )''')
+        # (a UNION would make sqlite read the recommendations in order of
+        # recommendation, scanning the whole table)
+        sql = '''
+        INSERT INTO temp.graph_ids (video_id)
+        SELECT video_id FROM (
+          SELECT video_id FROM recommendations
+          WHERE recommendation IS NOT NULL AND {0}
+          UNION ALL
+          SELECT recommendation FROM recommendations
+          WHERE recommendation IS NOT NULL AND {0})
+        GROUP BY video_id
+        ORDER BY video_id'''.format(where)
+        conn.execute(sql, params + params)
+        ids = [video_id for video_id, in
+               conn.execute("SELECT video_id FROM temp.graph_ids ORDER BY idx")]
+        ids = np.array(ids, dtype='U{}'.format(max(map(len, ids), default=1)))
+
+        sql = '''
+        SELECT a.idx - 1, b.idx - 1 FROM recommendations r
+        JOIN temp.graph_ids a ON a.video_id = r.video_id
+        JOIN temp.graph_ids b ON b.video_id = r.recommendation
+        WHERE {}'''.format(search_filter(search_ids, 'r.search_id', finished)[0])
+        src, dst = fetch_pairs(conn.execute(sql, params))
+        conn.execute("DROP TABLE temp.graph_ids")
+
+        merged_search_ids = None
+        if finished:
+            sql = "SELECT search_id FROM searches WHERE {} ORDER BY search_id".format(where)
+            merged_search_ids = [search_id for search_id, in conn.execute(sql, params)]
+        meta = {'search_ids': sorted(search_ids) if search_ids is not None else None,
+                'weighted': weighted,
+                'merged_search_ids': merged_search_ids}
+        return cls(adjacency(src, dst, len(ids), weighted), ids, meta)
+
+
+    @classmethod
+    def from_edges(cls, parents, children, weights=None, meta=None):
+        """
+        Builds a graph from an edge list, e.g. the result of channel_edges
+
+        INPUT:
+            parents, children: (array-like) node ids of the edges' endpoints
+            weights: (array-like) weight of each edge (summed over repeated
+                     edges); None for unweighted
+            meta: (dict) see Graph
+
+        OUTPUT:
+            (Graph) of every node in an edge
+        """
+        codes, ids = pd.factorize(np.concatenate([np.asarray(parents, dtype=object),
+                                                  np.asarray(children, dtype=object)]),
+                                  sort=True)
+        ids = np.array(ids, dtype='U{}'.format(max(map(len, ids), default=1)))
+        n_edges = len(codes) // 2
+        if weights is None:
+            matrix = adjacency(codes[:n_edges], codes[n_edges:], len(ids))
+        else:
+            matrix = sp.csr_matrix((np.asarray(weights, dtype=np.float64),
+                                    (codes[:n_edges], codes[n_edges:])),
+                                   shape=(len(ids), len(ids)))
+            matrix.sum_duplicates()
+        return cls(matrix, ids, meta)
+
+
+    def union(self, other):
+        """
+        Graph with the nodes and edges of both self and other. Repeated edges
+        are summed if the graphs are weighted and kept at 1 otherwise.
+        """
+        weighted = self.meta.get('weighted', False)
+        ids = np.union1d(self.ids, other.ids)
+        src, dst = [], []
+        for graph in [self, other]:
+            # positions of the graph's nodes in the union
+            pos = np.searchsorted(ids, graph.ids)
+            coo = graph.matrix.tocoo()
+            src.append(pos[coo.row])
+            dst.append(pos[coo.col])
+        matrix = sp.csr_matrix((np.concatenate([self.matrix.data, other.matrix.data]),
+                                (np.concatenate(src), np.concatenate(dst))),
+                               shape=(len(ids), len(ids)))
+        matrix.sum_duplicates()
+        if not weighted:
+            matrix.data[:] = 1
+        merged = [graph.meta.get('merged_search_ids') for graph in [self, other]]
+        if merged[0] is not None and merged[1] is not None:
+            merged = sorted(set(merged[0]).union(merged[1]))
+        else:
+            merged = None
+        meta = dict(self.meta, merged_search_ids=merged)
+        return Graph(matrix, ids, meta)
+
+
+    def update(self, conn):
+        """
+        Adds the recommendations of the searches that finished since the
+        graph was built (those not in meta['merged_search_ids']) from the
+        database. Crawls run in parallel finish out of order, so a search
+        is merged once it has finished, whatever its search_id.
+
+        OUTPUT:
+            (Graph) the updated graph, or self if no new search has finished
+        """
+        merged = self.meta.get('merged_search_ids')
+        if self.meta.get('search_ids') is not None or merged is None:
+            raise ValueError("only graphs of every finished search "
+                             "(from_db(conn, finished=True)) can be updated")
+        merged = set(merged)
+        sql = "SELECT search_id FROM searches WHERE finished_at IS NOT NULL ORDER BY search_id"
+        search_ids = [search_id for search_id, in conn.execute(sql) if search_id not in merged]
+        if not search_ids:
+            return self
+        new = Graph.from_db(conn, search_ids, weighted=self.meta.get('weighted', False),
+                            finished=True)
+        return self.union(new)
+
+
+    def index(self, video_ids):
+        """
+        Row / column of each of video_ids; -1 for videos not in the graph
+        """
+        video_ids = np.asarray(video_ids, dtype=str)
+        if len(self.ids) == 0:
+            return np.full(video_ids.shape, -1)
+        pos = np.searchsorted(self.ids, video_ids)
+        pos[pos == len(self.ids)] = 0
+        return np.where(self.ids[pos] == video_ids, pos, -1)
+
+
+    def save(self, path):
+        """
+        Saves the graph as a directory of .npy files (indptr, indices, data,
+        ids) plus meta.json, which load can memory-map
+        """
+        os.makedirs(path, exist_ok=True)
+        np.save(os.path.join(path, 'indptr.npy'), self.matrix.indptr)
+        np.save(os.path.join(path, 'indices.npy'), self.matrix.indices)
+        np.save(os.path.join(path, 'data.npy'), self.matrix.data)
+        np.save(os.path.join(path, 'ids.npy'), self.ids)
+        with open(os.path.join(path, 'meta.json'), 'w') as f:
+            json.dump(self.meta, f)
+
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        """
+        Loads a graph saved with save
+
+        INPUT:
+            path: (str) snapshot directory
+            mmap: (bool) memory-map the arrays instead of reading them
+
+        OUTPUT:
+            (Graph)
+        """
+        mode = 'r' if mmap else None
+        arrays = {name: np.load(os.path.join(path, name + '.npy'), mmap_mode=mode)
+                  for name in ['indptr', 'indices', 'data', 'ids']}
+        n = len(arrays['ids'])
+        matrix = sp.csr_matrix((arrays['data'], arrays['indices'], arrays['indptr']),
+                               shape=(n, n), copy=False)
+        with open(os.path.join(path, 'meta.json')) as f:
+            meta = json.load(f)
+        return cls(matrix, arrays['ids'], meta)
+
+
+    def write_adjlist(self, path):
+        """
+        Writes the graph as a text adjacency list (one line per video with
+        out-edges: the video_id followed by its recommendations), readable by
+        networkx.read_adjlist
+        """
+        indptr, indices = self.matrix.indptr, self.matrix.indices
+        with open(path, 'w') as f:
+            for i in np.flatnonzero(np.diff(indptr)):
+                children = self.ids[indices[indptr[i]:indptr[i + 1]]]
+                f.write('{} {}\n'.format(self.ids[i], ' '.join(children)))
+
+
+def adjacency(src, dst, n, weighted=False):
+    """
+    n x n CSR matrix with an entry for each (src[k], dst[k]) edge, summing
+    repeated edges if weighted and setting them to 1 otherwise. Column
+    indices are sorted within rows.
+    """
+    matrix = sp.csr_matrix((np.ones(len(src), dtype=np.float64), (src, dst)), shape=(n, n))
+    matrix.sum_duplicates()
+    if not weighted:
+        matrix.data[:] = 1
+    return matrix
+
+
+def transition_matrix(matrix):
+    """
+    Row-stochastic version of an adjacency matrix, and a mask of its dangling
+    rows (no out-edges), which stay all zero
+    """
+    out_weight = np.asarray(matrix.sum(axis=1)).ravel()
+    dangling = out_weight == 0
+    scale = np.divide(1, out_weight, out=np.zeros_like(out_weight), where=~dangling)
+    return sp.diags(scale).dot(matrix).tocsr(), dangling
+
+
+def pagerank(graph, alpha=0.85, tol=1e-6, max_iter=100, x0=None):
+    """
+    PageRank by power iteration over the sparse transition matrix. Same model
+    and stopping rule as networkx.pagerank: dangling videos link to every
+    video, and iteration stops when the L1 change is below len(graph) * tol.
+
+    INPUT:
+        graph: (Graph)
+        alpha: (float) damping factor
+        tol: (float) convergence tolerance per video
+        max_iter: (int) raises ConvergenceError if not converged by then
+        x0: (np.array) starting vector (normalized here); None for uniform
+
+    OUTPUT:
+        (np.array) PageRank of each video, in the order of graph.ids
+    """
+    n = len(graph)
+    if n == 0:
+        return np.zeros(0)
+    P, dangling = transition_matrix(graph.matrix)
+    # x P as P^T x, with P^T in CSR for a fast product
+    PT = P.T.tocsr()
+    x = np.full(n, 1.0 / n) if x0 is None else np.asarray(x0, dtype=np.float64) / np.sum(x0)
+    for _ in range(max_iter):
+        x_last = x
+        x = alpha * (PT.dot(x_last) + x_last[dangling].sum() / n) + (1 - alpha) / n
+        if np.abs(x - x_last).sum() < n * tol:
+            return x
+    raise ConvergenceError("PageRank did not converge in {} iterations".format(max_iter))
+
+
+def update_pagerank(conn, path, alpha=0.85, tol=1e-6, max_iter=100):
+    """
+    Keeps the video graph snapshot at path (see Graph.save) and its PageRank
+    vector (pagerank.npy) up to date. The first call builds both from every
+    finished search. Later calls only read the searches that finished since,
+    merge them into the saved graph and restart the power iteration from the
+    saved PageRank, which is usually a few iterations from the new one.
+
+    INPUT:
+        conn: (sqlite3.Connection) to the crawl database
+        path: (str) snapshot directory
+        alpha, tol, max_iter: see pagerank
+
+    OUTPUT:
+        graph: (Graph) the updated graph
+        pr: (np.array) its PageRank, in the order of graph.ids
+    """
+    pr_path = os.path.join(path, 'pagerank.npy')
+    if not os.path.exists(pr_path):
+        graph = Graph.from_db(conn, finished=True)
+        pr = pagerank(graph, alpha=alpha, tol=tol, max_iter=max_iter)
+    else:
+        old = Graph.load(path, mmap=False)
+        graph = old.update(conn)
+        if graph is old:
+            return old, np.load(pr_path)
+        # old videos start from their old rank, new ones from 1 / n
+        x0 = np.full(len(graph), 1.0 / len(graph))
+        x0[graph.index(old.ids)] = np.load(pr_path)
+        pr = pagerank(graph, alpha=alpha, tol=tol, max_iter=max_iter, x0=x0)
+
+    # write the new snapshot next to the old one and swap them, so an
+    # interrupted update leaves the old snapshot in place
+    tmp_path = path.rstrip(os.sep) + '.tmp'
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    graph.save(tmp_path)
+    np.save(os.path.join(tmp_path, 'pagerank.npy'), pr)
+    if os.path.exists(path):
+        old_path = path.rstrip(os.sep) + '.old'
+        shutil.rmtree(old_path, ignore_errors=True)
+        os.rename(path, old_path)
+        os.rename(tmp_path, path)
+        shutil.rmtree(old_path)
+    else:
+        os.rename(tmp_path, path)
+    return graph, pr
@@ -0,0 +1,354 @@
+import bisect
+import json
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+
+# upper bounds (seconds) of the latency histogram buckets; the last bucket
+# holds everything slower
+BUCKETS = [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60]
+
+# prefix of the metric names in the Prometheus exposition
+PREFIX = 'youtube_follower'
+
+
+def metric_key(name, labels):
+    """
+    Key of a metric in summaries, e.g. 'api_calls{method=videos.list}'
+    """
+    if not labels:
+        return name
+    return '{}{{{}}}'.format(name, ','.join('{}={}'.format(k, v) for k, v in labels))
+
+
+def parse_key(key):
+    """
+    (name, labels) of a key made by metric_key
+    """
+    if '{' not in key:
+        return key, ()
+    name, labels = key[:-1].split('{', 1)
+    return name, tuple(tuple(label.split('=', 1)) for label in labels.split(','))
+
+
+class Histogram():
+    def __init__(self, buckets=BUCKETS):
+        """
+        Latency histogram over fixed buckets, with the count, sum and max
+        """
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+
+    def observe(self, seconds):
+        self.counts[bisect.bisect_left(self.buckets, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+        self.max = max(self.max, seconds)
+
+
+    def quantile(self, q):
+        """
+        Upper bound of the bucket holding the q-th quantile (the max for the
+        last bucket)
+        """
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank and seen > 0:
+                return min(bound, self.max)
+        return self.max
+
+
+    def to_dict(self):
+        return {'count': self.count,
+                'sum': self.sum,
+                'mean': self.sum / self.count if self.count else None,
+                'max': self.max,
+                'p50': self.quantile(0.5),
+                'p90': self.quantile(0.9),
+                'p99': self.quantile(0.99),
+                'counts': list(self.counts)}
+
+
+    def merge(self, data):
+        """
+        Adds the observations of a to_dict summary over the same buckets
+        """
+        self.counts = [a + b for a, b in zip(self.counts, data['counts'])]
+        self.count += data['count']
+        self.sum += data['sum']
+        self.max = max(self.max, data['max'])
+
+
+class Timer():
+    __slots__ = ['metrics', 'name', 'labels', 'start']
+
+    def __init__(self, metrics, name, labels):
+        self.metrics = metrics
+        self.name = name
+        self.labels = labels
+
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+
+    def __exit__(self, *exc):
+        self.metrics.observe(self.name, time.perf_counter() - self.start, **self.labels)
+        return False
+
+
+class Metrics():
+    def __init__(self, buckets=BUCKETS):
+        """
+        Counters and latency histograms of a crawl (or of a batch of crawls,
+        see merge), safe to update from the crawler's fetch threads.
+        Metrics are identified by a name and optional labels, e.g.
+        inc('cache_hits', cache='recommendations').
+
+        INPUT:
+            buckets: (list) upper bounds of the latency buckets, in seconds
+        """
+        self.buckets = buckets
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+
+
+    def inc(self, name, n=1, **labels):
+        """
+        Adds n to a counter
+        """
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + n
+
+
+    def observe(self, name, seconds, **labels):
+        """
+        Records a latency
+        """
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram(self.buckets)
+            histogram.observe(seconds)
+
+
+    def timer(self, name, **labels):
+        """
+        Context manager recording the latency of its block
+        """
+        return Timer(self, name, labels)
+
+
+    def summary(self):
+        """
+        JSON-serializable summary: counters, and the count, sum, mean, max,
+        approximate quantiles and bucket counts of each latency
+        """
+        with self.lock:
+            return {'buckets': list(self.buckets),
+                    'counters': {metric_key(*key): value
+                                 for key, value in sorted(self.counters.items())},
+                    'latency': {metric_key(*key): histogram.to_dict()
+                                for key, histogram in sorted(self.histograms.items())}}
+
+
+    def merge(self, summary):
+        """
+        Adds the metrics of a summary, e.g. one per crawl of a batch
+        """
+        with self.lock:
+            for key, value in summary['counters'].items():
+                key = parse_key(key)
+                self.counters[key] = self.counters.get(key, 0) + value
+            for key, data in summary['latency'].items():
+                key = parse_key(key)
+                if key not in self.histograms:
+                    self.histograms[key] = Histogram(self.buckets)
+                self.histograms[key].merge(data)
+
+
+    def prometheus(self):
+        """
+        Metrics in the Prometheus text exposition format
+        """
+        def labels_text(labels, extra=()):
+            labels = list(labels) + list(extra)
+            if not labels:
+                return ''
+            return '{{{}}}'.format(','.join('{}="{}"'.format(k, v) for k, v in labels))
+
+        lines = []
+        with self.lock:
+            typed = set()
+            for (name, labels), value in sorted(self.counters.items()):
+                metric = '{}_{}_total'.format(PREFIX, name)
+                if metric not in typed:
+                    typed.add(metric)
+                    lines.append('# TYPE {} counter'.format(metric))
+                lines.append('{}{} {}'.format(metric, labels_text(labels), value))
+            for (name, labels), histogram in sorted(self.histograms.items()):
+                metric = '{}_{}_seconds'.format(PREFIX, name)
+                if metric not in typed:
+                    typed.add(metric)
+                    lines.append('# TYPE {} histogram'.format(metric))
+                cumulative = 0
+                for bound, count in zip(list(self.buckets) + ['+Inf'], histogram.counts):
+                    cumulative += count
+                    lines.append('{}_bucket{} {}'.format(
+                        metric, labels_text(labels, [('le', bound)]), cumulative))
+                lines.append('{}_sum{} {}'.format(metric, labels_text(labels), histogram.sum))
+                lines.append('{}_count{} {}'.format(metric, labels_text(labels), histogram.count))
+        return '\n'.join(lines) + '\n'
+
+
+    def write(self, path, **info):
+        """
+        Writes the summary to path as JSON, along with info (e.g. search_id)
+        """
+        with open(path, 'w') as f:
+            json.dump(dict(info, **self.summary()), f, indent=1)
+
+
+class NullTimer():
+    __slots__ = []
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *exc):
+        return False
+
+
+NULL_TIMER = NullTimer()
+
+
+class NullMetrics():
+    """
+    Stands in for Metrics when nothing is being recorded: every call is a
+    no-op
+    """
+    def inc(self, name, n=1, **labels):
+        pass
+
+
+    def observe(self, name, seconds, **labels):
+        pass
+
+
+    def timer(self, name, **labels):
+        return NULL_TIMER
+
+
+class ActiveMetrics():
+    """
+    metrics.active, where the scheduler, utils, caches and db_utils record to:
+    forwards every call to the metrics of the calling thread (see recording
+    and bind), so crawls running in threads of one process each record to
+    their own
+    """
+    def __init__(self):
+        self.local = threading.local()
+
+
+    def get(self):
+        return getattr(self.local, 'metrics', NULL_METRICS)
+
+
+    def set(self, metrics):
+        self.local.metrics = metrics
+
+
+    def inc(self, name, n=1, **labels):
+        self.get().inc(name, n, **labels)
+
+
+    def observe(self, name, seconds, **labels):
+        self.get().observe(name, seconds, **labels)
+
+
+    def timer(self, name, **labels):
+        return self.get().timer(name, **labels)
+
+
+NULL_METRICS = NullMetrics()
+
+active = ActiveMetrics()
+
+
+@contextmanager
+def recording(metrics):
+    """
+    Makes metrics the active metrics of the calling thread for the duration
+    of the with block. Threads started meanwhile record nothing unless their
+    functions are wrapped with bind.
+
+    INPUT:
+        metrics: (Metrics) None to record nothing
+    """
+    previous = active.get()
+    active.set(metrics if metrics is not None else NULL_METRICS)
+    try:
+        yield active.get()
+    finally:
+        active.set(previous)
+
+
+def bind(fn):
+    """
+    Wraps fn so that, whichever thread calls it (e.g. a pool's), it records
+    to the metrics active in the thread calling bind
+    """
+    metrics = active.get()
+    def bound(*args, **kwargs):
+        with recording(metrics):
+            return fn(*args, **kwargs)
+    return bound
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    # http.server has this from Python 3.7 only
+    daemon_threads = True
+
+
+def serve(metrics, port=9100, host=''):
+    """
+    Serves metrics.prometheus() over HTTP (any path, e.g. /metrics) from a
+    daemon thread, for Prometheus to scrape
+
+    INPUT:
+        metrics: (Metrics)
+        port: (int)
+        host: (str) interface to listen on; '' for all
+
+    OUTPUT:
+        server: (ThreadingHTTPServer) call shutdown() to stop it
+    """
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            body = metrics.prometheus().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
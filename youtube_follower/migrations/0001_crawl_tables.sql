@@ -1,6 +1,8 @@
+-- the crawl tables as first released (IF NOT EXISTS, so databases created
+-- by the old setup.py are left as they are)
+
 -- main search information table
-DROP TABLE IF EXISTS searches;
-CREATE TABLE searches (
+CREATE TABLE IF NOT EXISTS searches (
   search_id integer PRIMARY KEY,
   root_video text NOT NULL,
   n_splits integer NOT NULL,
@@ -11,8 +13,7 @@ CREATE TABLE searches (
 );
 
 -- video info table
-DROP TABLE IF EXISTS videos;
-CREATE TABLE videos (
+CREATE TABLE IF NOT EXISTS videos (
   video_id text NOT NULL,
   search_id integer NOT NULL,
   title text,
@@ -30,8 +31,7 @@ CREATE TABLE videos (
 );
 
 -- channels table
-DROP TABLE IF EXISTS channels;
-CREATE TABLE channels (
+CREATE TABLE IF NOT EXISTS channels (
   channel_id text NOT NULL,
   search_id integer NOT NULL,
   name text,
@@ -46,8 +46,7 @@ CREATE TABLE channels (
 );
 
 -- channel categories table
-DROP TABLE IF EXISTS channel_categories;
-CREATE TABLE channel_categories (
+CREATE TABLE IF NOT EXISTS channel_categories (
   channel_id text NOT NULL,
   search_id integer NOT NULL,
   category text,
@@ -58,8 +57,7 @@ CREATE TABLE channel_categories (
 );
 
 -- recommendations table
-DROP TABLE IF EXISTS recommendations;
-CREATE TABLE recommendations (
+CREATE TABLE IF NOT EXISTS recommendations (
   video_id text NOT NULL,
   search_id integer NOT NULL,
   recommendation text,
@@ -69,3 +67,13 @@ CREATE TABLE recommendations (
   FOREIGN KEY (search_id)
     REFERENCES searches (search_id)
 );
+
+-- checkpoints of in-progress crawls
+CREATE TABLE IF NOT EXISTS checkpoints (
+  search_id integer PRIMARY KEY,
+  depth integer NOT NULL,
+  state text NOT NULL,
+  updated_at text NOT NULL,
+  FOREIGN KEY (search_id)
+    REFERENCES searches (search_id)
+);
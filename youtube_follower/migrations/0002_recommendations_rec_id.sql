@@ -0,0 +1,22 @@
+-- give recommendations a primary key. rec_id aliases the rowid and keeps
+-- the existing values, so rowids saved in checkpoints stay valid, and unlike
+-- an implicit rowid it is never renumbered by VACUUM
+CREATE TABLE recommendations_new (
+  rec_id integer PRIMARY KEY,
+  video_id text NOT NULL,
+  search_id integer NOT NULL,
+  recommendation text,
+  depth integer,
+  FOREIGN KEY (video_id, recommendation)
+    REFERENCES videos (video_id, video_id),
+  FOREIGN KEY (search_id)
+    REFERENCES searches (search_id)
+);
+
+INSERT INTO recommendations_new (rec_id, video_id, search_id, recommendation, depth)
+SELECT rowid, video_id, search_id, recommendation, depth
+FROM recommendations;
+
+DROP TABLE recommendations;
+
+ALTER TABLE recommendations_new RENAME TO recommendations;
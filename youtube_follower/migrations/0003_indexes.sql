@@ -0,0 +1,27 @@
+-- indexes for the access paths of the crawler, preprocessing and analysis.
+-- videos(video_id) and channels(channel_id) lookups are already served by
+-- their (id, search_id) primary keys
+
+-- per-search reads (analysis, complete_tree, resuming a crawl) and
+-- grouping a search's edges by parent
+CREATE INDEX IF NOT EXISTS recommendations_search_video
+  ON recommendations (search_id, video_id);
+
+-- in-degrees and joins from a recommendation to its video
+CREATE INDEX IF NOT EXISTS recommendations_recommendation
+  ON recommendations (recommendation);
+
+-- per-search reads and deletes of metadata
+CREATE INDEX IF NOT EXISTS videos_search
+  ON videos (search_id);
+
+CREATE INDEX IF NOT EXISTS channels_search
+  ON channels (search_id);
+
+CREATE INDEX IF NOT EXISTS channel_categories_channel
+  ON channel_categories (channel_id, search_id);
+
+CREATE INDEX IF NOT EXISTS channel_categories_search
+  ON channel_categories (search_id);
+
+ANALYZE;
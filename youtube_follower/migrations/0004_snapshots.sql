@@ -0,0 +1,110 @@
+-- store the static fields of each video / channel once per version
+-- (snapshot), keyed by content_hash(...) of those fields, and only the
+-- counters per search. videos and channels become views with the columns
+-- of the old tables. Stats rows keep the rowids of the rows they replace.
+
+CREATE TABLE video_snapshots (
+  snapshot_id integer PRIMARY KEY,
+  video_id text NOT NULL,
+  content_hash text NOT NULL UNIQUE,
+  title text,
+  channel_id text,
+  postdate text,
+  description text,
+  category integer
+);
+
+INSERT OR IGNORE INTO video_snapshots
+(video_id, content_hash, title, channel_id, postdate, description, category)
+SELECT video_id, content_hash(video_id, title, channel_id, postdate, description, category),
+  title, channel_id, postdate, description, category
+FROM videos
+ORDER BY search_id;
+
+CREATE INDEX video_snapshots_video ON video_snapshots (video_id);
+
+CREATE TABLE video_stats (
+  video_id text NOT NULL,
+  search_id integer NOT NULL,
+  snapshot_id integer NOT NULL,
+  views integer,
+  likes integer,
+  dislikes integer,
+  n_comments integer,
+  PRIMARY KEY (video_id, search_id),
+  FOREIGN KEY (snapshot_id)
+    REFERENCES video_snapshots (snapshot_id),
+  FOREIGN KEY (search_id)
+    REFERENCES searches (search_id)
+);
+
+INSERT INTO video_stats
+(rowid, video_id, search_id, snapshot_id, views, likes, dislikes, n_comments)
+SELECT v.rowid, v.video_id, v.search_id, s.snapshot_id, v.views, v.likes, v.dislikes, v.n_comments
+FROM videos v
+JOIN video_snapshots s
+  ON s.content_hash = content_hash(v.video_id, v.title, v.channel_id, v.postdate,
+                                   v.description, v.category);
+
+CREATE INDEX video_stats_search ON video_stats (search_id);
+
+DROP TABLE videos;
+
+CREATE VIEW videos AS
+SELECT st.video_id, st.search_id, sn.title, sn.channel_id, sn.postdate,
+  st.views, st.likes, st.dislikes, st.n_comments, sn.description, sn.category
+FROM video_stats st
+JOIN video_snapshots sn
+  ON st.snapshot_id = sn.snapshot_id;
+
+CREATE TABLE channel_snapshots (
+  snapshot_id integer PRIMARY KEY,
+  channel_id text NOT NULL,
+  content_hash text NOT NULL UNIQUE,
+  name text,
+  country text,
+  date_created text
+);
+
+INSERT OR IGNORE INTO channel_snapshots
+(channel_id, content_hash, name, country, date_created)
+SELECT channel_id, content_hash(channel_id, name, country, date_created),
+  name, country, date_created
+FROM channels
+ORDER BY search_id;
+
+CREATE INDEX channel_snapshots_channel ON channel_snapshots (channel_id);
+
+CREATE TABLE channel_stats (
+  channel_id text NOT NULL,
+  search_id integer NOT NULL,
+  snapshot_id integer NOT NULL,
+  n_subscribers integer,
+  n_videos integer,
+  n_views integer,
+  PRIMARY KEY (channel_id, search_id),
+  FOREIGN KEY (snapshot_id)
+    REFERENCES channel_snapshots (snapshot_id),
+  FOREIGN KEY (search_id)
+    REFERENCES searches (search_id)
+);
+
+INSERT INTO channel_stats
+(rowid, channel_id, search_id, snapshot_id, n_subscribers, n_videos, n_views)
+SELECT c.rowid, c.channel_id, c.search_id, s.snapshot_id, c.n_subscribers, c.n_videos, c.n_views
+FROM channels c
+JOIN channel_snapshots s
+  ON s.content_hash = content_hash(c.channel_id, c.name, c.country, c.date_created);
+
+CREATE INDEX channel_stats_search ON channel_stats (search_id);
+
+DROP TABLE channels;
+
+CREATE VIEW channels AS
+SELECT st.channel_id, st.search_id, sn.name, sn.country, sn.date_created,
+  st.n_subscribers, st.n_videos, st.n_views
+FROM channel_stats st
+JOIN channel_snapshots sn
+  ON st.snapshot_id = sn.snapshot_id;
+
+ANALYZE;
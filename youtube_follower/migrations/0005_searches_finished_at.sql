@@ -0,0 +1,10 @@
+-- completion marker: set once a crawl has written all of its rows, so that
+-- readers of the crawl tables (export, complete_tree, graph updates) can
+-- tell finished searches from ones still being crawled
+ALTER TABLE searches ADD COLUMN finished_at text;
+
+-- searches crawled before the marker existed count as finished unless they
+-- have a checkpoint
+UPDATE searches SET finished_at = datetime('now')
+WHERE NOT EXISTS (SELECT 1 FROM checkpoints c WHERE c.search_id = searches.search_id)
+  AND EXISTS (SELECT 1 FROM recommendations r WHERE r.search_id = searches.search_id);
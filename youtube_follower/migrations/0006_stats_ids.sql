@@ -0,0 +1,104 @@
+-- give video_stats, channel_stats and channel_categories an integer primary
+-- key, last so that positional reads of the tables are unchanged. Like
+-- recommendations.rec_id it aliases the rowid and keeps the existing
+-- values, so the ids saved in checkpoints stay valid, and it is never
+-- renumbered by VACUUM
+
+-- the views are rebuilt on top of the new tables
+DROP VIEW videos;
+
+DROP VIEW channels;
+
+CREATE TABLE video_stats_new (
+  video_id text NOT NULL,
+  search_id integer NOT NULL,
+  snapshot_id integer NOT NULL,
+  views integer,
+  likes integer,
+  dislikes integer,
+  n_comments integer,
+  stats_id integer PRIMARY KEY,
+  UNIQUE (video_id, search_id),
+  FOREIGN KEY (snapshot_id)
+    REFERENCES video_snapshots (snapshot_id),
+  FOREIGN KEY (search_id)
+    REFERENCES searches (search_id)
+);
+
+INSERT INTO video_stats_new
+(stats_id, video_id, search_id, snapshot_id, views, likes, dislikes, n_comments)
+SELECT rowid, video_id, search_id, snapshot_id, views, likes, dislikes, n_comments
+FROM video_stats;
+
+DROP TABLE video_stats;
+
+ALTER TABLE video_stats_new RENAME TO video_stats;
+
+CREATE INDEX video_stats_search ON video_stats (search_id);
+
+CREATE TABLE channel_stats_new (
+  channel_id text NOT NULL,
+  search_id integer NOT NULL,
+  snapshot_id integer NOT NULL,
+  n_subscribers integer,
+  n_videos integer,
+  n_views integer,
+  stats_id integer PRIMARY KEY,
+  UNIQUE (channel_id, search_id),
+  FOREIGN KEY (snapshot_id)
+    REFERENCES channel_snapshots (snapshot_id),
+  FOREIGN KEY (search_id)
+    REFERENCES searches (search_id)
+);
+
+INSERT INTO channel_stats_new
+(stats_id, channel_id, search_id, snapshot_id, n_subscribers, n_videos, n_views)
+SELECT rowid, channel_id, search_id, snapshot_id, n_subscribers, n_videos, n_views
+FROM channel_stats;
+
+DROP TABLE channel_stats;
+
+ALTER TABLE channel_stats_new RENAME TO channel_stats;
+
+CREATE INDEX channel_stats_search ON channel_stats (search_id);
+
+CREATE TABLE channel_categories_new (
+  channel_id text NOT NULL,
+  search_id integer NOT NULL,
+  category text,
+  category_row_id integer PRIMARY KEY,
+  FOREIGN KEY (channel_id)
+    REFERENCES channels (channel_id),
+  FOREIGN KEY (search_id)
+    REFERENCES searches (search_id)
+);
+
+INSERT INTO channel_categories_new (category_row_id, channel_id, search_id, category)
+SELECT rowid, channel_id, search_id, category
+FROM channel_categories;
+
+DROP TABLE channel_categories;
+
+ALTER TABLE channel_categories_new RENAME TO channel_categories;
+
+CREATE INDEX channel_categories_channel
+  ON channel_categories (channel_id, search_id);
+
+CREATE INDEX channel_categories_search
+  ON channel_categories (search_id);
+
+CREATE VIEW videos AS
+SELECT st.video_id, st.search_id, sn.title, sn.channel_id, sn.postdate,
+  st.views, st.likes, st.dislikes, st.n_comments, sn.description, sn.category
+FROM video_stats st
+JOIN video_snapshots sn
+  ON st.snapshot_id = sn.snapshot_id;
+
+CREATE VIEW channels AS
+SELECT st.channel_id, st.search_id, sn.name, sn.country, sn.date_created,
+  st.n_subscribers, st.n_videos, st.n_views
+FROM channel_stats st
+JOIN channel_snapshots sn
+  ON st.snapshot_id = sn.snapshot_id;
+
+ANALYZE;
@@ -0,0 +1,283 @@
+import numpy as np
+import pandas as pd
+
+from .graph import ConvergenceError, Graph, pagerank, transition_matrix, video_groups
+
+
+class RandomWalk():
+    def __init__(self, graph, alpha=1.0):
+        """
+        Random walk on a recommendation graph: at each step the walker follows
+        one of the current video's recommendations (in proportion to the
+        edge weights) with probability alpha, and otherwise, or if the video
+        has no recommendations, jumps to a video chosen uniformly at random.
+        By default it only jumps from videos without recommendations (e.g.
+        the leaves of the crawl), so it measures how the recommendations
+        themselves mix; with alpha < 1 its stationary distribution is the
+        graph's PageRank.
+
+        INPUT:
+            graph: (Graph) e.g. Graph.from_db(conn, weighted=True), so that
+                   recommendations made more often are followed more often
+            alpha: (float) probability of following a recommendation
+        """
+        self.graph = graph
+        self.alpha = alpha
+        P, dangling = transition_matrix(graph.matrix)
+        self.dangling = dangling.astype(np.float64)
+        # distributions are columns, so a step is P^T X
+        self.PT = P.T.tocsr()
+
+
+    def __len__(self):
+        return len(self.graph)
+
+
+    def step(self, X):
+        """
+        Distributions after one step from each column of X (n x k)
+        """
+        n = len(self)
+        mass = X.sum(axis=0)
+        jump = (1 - self.alpha) * mass + self.alpha * self.dangling.dot(X)
+        return self.alpha * self.PT.dot(X) + jump / n
+
+
+    def stationary_distribution(self, tol=1e-10, max_iter=1000):
+        """
+        Stationary distribution of the walk, in the order of graph.ids
+        """
+        if self.alpha < 1:
+            return pagerank(self.graph, alpha=self.alpha, tol=tol, max_iter=max_iter)
+        # without jumps the walk can be periodic (e.g. two videos recommending
+        # each other), and power iteration would cycle; the lazy walk, which
+        # stays put half the time, has the same stationary distribution
+        n = len(self)
+        x = np.full((n, 1), 1.0 / n)
+        for _ in range(max_iter):
+            x_last = x
+            x = 0.5 * (x_last + self.step(x_last))
+            if np.abs(x - x_last).sum() < n * tol:
+                return x[:, 0]
+        raise ConvergenceError("Random walk did not converge in {} iterations".format(max_iter))
+
+
+    def distances(self, starts, n_steps=20, pi=None, membership=None, batch_size=64):
+        """
+        Total variation distance to the stationary distribution after each
+        step of walks started from each of starts. The walks are run
+        batch_size at a time, as the columns of one dense matrix, so each
+        step is a single sparse-dense product.
+
+        INPUT:
+            starts: (list) row of the starting video of each walk
+            n_steps: (int) number of steps
+            pi: (np.array) stationary distribution; computed if None
+            membership: (scipy.sparse matrix) videos x groups (see
+                        graph.video_groups); if given, also compare the
+                        distributions of the groups walkers are in,
+                        among videos in any group
+            batch_size: (int) walks per batch; memory is
+                        8 * len(graph) * batch_size bytes per distribution
+
+        OUTPUT:
+            tv: (np.array) len(starts) x (n_steps + 1) distances, column t
+                after t steps
+            group_tv: (np.array) same, over groups (only if membership)
+        """
+        if pi is None:
+            pi = self.stationary_distribution()
+        starts = np.asarray(starts, dtype=np.int64)
+        tv = np.empty((len(starts), n_steps + 1))
+        if membership is not None:
+            MT = membership.T.tocsr()
+            group_pi = MT.dot(pi)
+            group_pi = group_pi / group_pi.sum()
+            group_tv = np.empty((len(starts), n_steps + 1))
+
+        for first in range(0, len(starts), batch_size):
+            batch = starts[first:first + batch_size]
+            X = np.zeros((len(self), len(batch)))
+            X[batch, np.arange(len(batch))] = 1
+            for t in range(n_steps + 1):
+                if t > 0:
+                    X = self.step(X)
+                tv[first:first + len(batch), t] = 0.5 * np.abs(X - pi[:, None]).sum(axis=0)
+                if membership is not None:
+                    G = MT.dot(X)
+                    # walkers on videos in no group are left out
+                    G = G / np.where(G.sum(axis=0) > 0, G.sum(axis=0), 1)
+                    group_tv[first:first + len(batch), t] = (
+                        0.5 * np.abs(G - group_pi[:, None]).sum(axis=0))
+        if membership is not None:
+            return tv, group_tv
+        return tv
+
+
+def root_mixing_curves(conn, graph=None, n_steps=20, alpha=1.0, by='leaning', batch_size=64):
+    """
+    Mixing curves of walks started from the root video of every search
+
+    INPUT:
+        conn: (sqlite3.Connection) to the crawl database
+        graph: (Graph) to walk on; the weighted graph of every search if None
+        n_steps: (int) number of steps
+        alpha: (float) see RandomWalk; below 1 to teleport
+        by: (str) group videos by 'leaning' or 'category' of their channel
+            (see graph.video_groups); None to skip the group distances
+        batch_size: (int) see RandomWalk.distances
+
+    OUTPUT:
+        (pd.DataFrame) one row per root and step: root_video, root_group
+        (the root's group if it is in exactly one), step, tv (distance to
+        the stationary distribution) and group_tv (same for the groups the
+        walkers are in)
+    """
+    if graph is None:
+        graph = Graph.from_db(conn, weighted=True)
+    walk = RandomWalk(graph, alpha=alpha)
+    roots = pd.read_sql_query("SELECT DISTINCT root_video FROM searches ORDER BY root_video",
+                              conn).root_video.values
+    starts = graph.index(roots)
+    roots, starts = roots[starts >= 0], starts[starts >= 0]
+
+    membership = None
+    if by is not None:
+        groups, membership = video_groups(conn, graph, by=by)
+    result = walk.distances(starts, n_steps=n_steps, membership=membership,
+                            batch_size=batch_size)
+
+    steps = np.arange(n_steps + 1)
+    df = pd.DataFrame({'root_video': np.repeat(roots, len(steps)),
+                       'step': np.tile(steps, len(roots))})
+    if by is None:
+        df['tv'] = result.ravel()
+        return df
+    tv, group_tv = result
+    root_group = [groups[row[0]] if len(row) == 1 else None
+                  for row in membership[starts].tolil().rows]
+    df.insert(1, 'root_group', np.repeat(np.array(root_group, dtype=object), len(steps)))
+    df['tv'] = tv.ravel()
+    df['group_tv'] = group_tv.ravel()
+    return df
+
+
+def simulate_walks(graph, starts, n_walkers=10000, n_steps=20, restart=0.0,
+    membership=None, seed=None):
+    """
+    Monte Carlo simulation of random walks on graph: n_walkers walkers start
+    from each of starts and, at every step, follow one of the current
+    video's recommendations at random (in proportion to the edge weights).
+    With probability restart, and whenever they reach a video without
+    recommendations, walkers go back to where they started instead. All
+    walkers move at once, as an array of row indices into graph.matrix.
+
+    INPUT:
+        graph: (Graph)
+        starts: (list) row of each starting video
+        n_walkers: (int) walkers per start
+        n_steps: (int) number of steps
+        restart: (float) probability of going back to the start at a step
+        membership: (scipy.sparse matrix) videos x groups (see
+                    graph.video_groups) to count walkers by group
+        seed: (int) seed of the RandomState that drives the walks
+
+    OUTPUT:
+        if membership is None, positions: (np.array) len(starts) x n_walkers
+        rows of the videos the walkers are on after n_steps. Otherwise
+        shares: (np.array) len(starts) x (n_steps + 1) x groups, the
+        fraction of each start's walkers on a video of each group after each
+        step (0 = at the start).
+    """
+    rng = np.random.RandomState(seed)
+    indptr, indices, data = graph.matrix.indptr, graph.matrix.indices, graph.matrix.data
+    # edges are picked by inverting the cumulative weights within a row, or
+    # directly in rows where every edge has the same weight
+    cum_weights = np.cumsum(data, dtype=np.float64)
+    nonempty = np.flatnonzero(np.diff(indptr))
+    uniform = np.ones(len(graph), dtype=bool)
+    if len(nonempty):
+        uniform[nonempty] = (np.maximum.reduceat(data, indptr[nonempty])
+                             == np.minimum.reduceat(data, indptr[nonempty]))
+    home = np.repeat(np.asarray(starts, dtype=np.int64), n_walkers)
+    pos = home.copy()
+    if membership is not None:
+        membership = membership.tocsr()
+        shares = np.empty((len(starts), n_steps + 1, membership.shape[1]))
+        shares[:, 0] = walker_shares(pos, membership, len(starts), n_walkers)
+
+    for t in range(1, n_steps + 1):
+        first, last = indptr[pos], indptr[pos + 1]
+        move = first < last
+        if restart > 0:
+            move &= rng.random_sample(len(pos)) >= restart
+        first, last = first[move], last[move]
+        u = rng.random_sample(len(first))
+        edge = first + (u * (last - first)).astype(np.int64)
+        weighted = ~uniform[pos[move]]
+        if weighted.any():
+            row_first, row_last = first[weighted], last[weighted]
+            low = np.where(row_first > 0, cum_weights[row_first - 1], 0)
+            high = cum_weights[row_last - 1]
+            edge[weighted] = np.searchsorted(cum_weights, low + u[weighted] * (high - low),
+                                             side='right')
+        # in case of rounding at the end of a row
+        edge = np.minimum(edge, last - 1)
+        pos = np.where(move, 0, home)
+        pos[move] = indices[edge]
+        if membership is not None:
+            shares[:, t] = walker_shares(pos, membership, len(starts), n_walkers)
+
+    if membership is not None:
+        return shares
+    return pos.reshape(len(starts), n_walkers)
+
+
+def walker_shares(pos, membership, n_starts, n_walkers):
+    """
+    Fraction of each start's walkers (pos holds n_walkers per start, in
+    order of start) on a video of each group
+    """
+    n_groups = membership.shape[1]
+    in_groups = membership[pos].tocoo()
+    start = in_groups.row // n_walkers
+    counts = np.bincount(start * n_groups + in_groups.col, weights=in_groups.data,
+                         minlength=n_starts * n_groups)
+    return counts.reshape(n_starts, n_groups) / n_walkers
+
+
+def root_walk_shares(conn, roots=None, graph=None, n_walkers=10000, n_steps=20,
+    restart=0.0, by='leaning', seed=None):
+    """
+    Where random walks from search roots end up, by group: simulate_walks
+    from each root, counting walkers by the leaning or category of their
+    video's channel
+
+    INPUT:
+        conn: (sqlite3.Connection) to the crawl database
+        roots: (list) root video_ids; the roots of every search if None
+        graph: (Graph) to walk on; the weighted graph of every search if None
+        n_walkers, n_steps, restart, seed: see simulate_walks
+        by: (str) 'leaning' or 'category', see graph.video_groups
+
+    OUTPUT:
+        (pd.DataFrame) one row per root, step and group: root_video, step,
+        group and share (fraction of the root's walkers on a video of the
+        group after step steps)
+    """
+    if graph is None:
+        graph = Graph.from_db(conn, weighted=True)
+    if roots is None:
+        roots = pd.read_sql_query("SELECT DISTINCT root_video FROM searches ORDER BY root_video",
+                                  conn).root_video.values
+    roots = np.asarray(roots, dtype=object)
+    starts = graph.index(roots)
+    roots, starts = roots[starts >= 0], starts[starts >= 0]
+    groups, membership = video_groups(conn, graph, by=by)
+    shares = simulate_walks(graph, starts, n_walkers=n_walkers, n_steps=n_steps,
+                            restart=restart, membership=membership, seed=seed)
+    n_roots, n_points, n_groups = shares.shape
+    return pd.DataFrame({'root_video': np.repeat(roots, n_points * n_groups),
+                         'step': np.tile(np.repeat(np.arange(n_points), n_groups), n_roots),
+                         'group': np.tile(groups, n_roots * n_points),
+                         'share': shares.ravel()})
@@ -0,0 +1,269 @@
+import logging
+import multiprocessing
+import threading
+import time
+from datetime import date
+
+from . import db_utils
+from . import utils
+from .cache import RecommendationCache, MetadataCache
+from .metrics import Metrics, serve
+from .scheduler import Scheduler, DAILY_QUOTA
+from .youtube_follower import (YoutubeFollower, DEFAULT_N_SPLITS, DEFAULT_DEPTH,
+                               DEFAULT_CONST_DEPTH)
+
+
+# set up in each worker process by init_worker
+worker = {}
+
+# seconds between the snapshots of a running crawl's metrics sent for the
+# metrics_port endpoint of run_batch
+METRICS_INTERVAL = 5
+
+
+class BatchMetrics():
+    def __init__(self):
+        """
+        Metrics of a batch of crawls, as served on run_batch's metrics_port:
+        the sum over the finished crawls plus the latest snapshot of each
+        running one
+        """
+        self.finished = Metrics()
+        self.running = {}
+        self.done = set()
+        self.lock = threading.Lock()
+
+
+    def update(self, search_id, summary):
+        """
+        Replaces the snapshot of a running crawl
+        """
+        with self.lock:
+            # a late snapshot must not count a finished crawl twice
+            if search_id not in self.done:
+                self.running[search_id] = summary
+
+
+    def finish(self, search_id, summary):
+        """
+        Adds the final metrics summary of a crawl (None if it recorded none)
+        """
+        with self.lock:
+            self.done.add(search_id)
+            self.running.pop(search_id, None)
+            if summary is not None:
+                self.finished.merge(summary)
+
+
+    def listen(self, queue):
+        """
+        Takes (search_id, summary) snapshots from the workers until None
+        """
+        while True:
+            message = queue.get()
+            if message is None:
+                break
+            self.update(*message)
+
+
+    def prometheus(self):
+        total = Metrics()
+        with self.lock:
+            total.merge(self.finished.summary())
+            for summary in self.running.values():
+                total.merge(summary)
+        return total.prometheus()
+
+
+def init_worker(scheduler, queue, db_path, cache_path, batch_size, min_quota, metrics,
+                metrics_queue):
+    # API calls in utils go through the module-level scheduler
+    utils.scheduler = scheduler
+    worker['scheduler'] = scheduler
+    worker['min_quota'] = min_quota
+    worker['queue'] = queue
+    worker['batch_size'] = batch_size
+    worker['db_path'] = db_path
+    worker['metrics'] = metrics
+    worker['metrics_queue'] = metrics_queue
+    worker['caches'] = {}
+    if cache_path is not None:
+        worker['caches'] = {'rec_cache': RecommendationCache(cache_path),
+                            'video_cache': MetadataCache(cache_path, kind='video'),
+                            'channel_cache': MetadataCache(cache_path, kind='channel')}
+
+
+def report_metrics(metrics, search_id, stop):
+    """
+    Sends a snapshot of a running crawl's metrics to run_batch every
+    METRICS_INTERVAL seconds, until stop is set
+    """
+    while not stop.wait(METRICS_INTERVAL):
+        worker['metrics_queue'].put((search_id, metrics.summary()))
+
+
+def crawl(task):
+    """
+    Runs one crawl in a worker process
+
+    INPUT:
+        task: (tuple) root_id, search_id, keyword arguments for YoutubeFollower
+
+    OUTPUT:
+        (dict) summary of the crawl, with the error if it failed (and its
+        metrics summary if recording metrics)
+    """
+    root_id, search_id, crawl_kwargs = task
+    start = time.time()
+    summary = {'root_id': root_id, 'search_id': search_id, 'n_videos': 0, 'error': None}
+    scheduler = worker['scheduler']
+    quota_start = scheduler.remaining_quota()
+    if quota_start < worker['min_quota']:
+        summary.update(error="skipped: {:.0f} quota units left".format(quota_start),
+                       seconds=0, quota=0)
+        return summary
+    metrics = Metrics() if worker['metrics'] else None
+    # tagged with the search, so the writer can tell which crawl a failed
+    # write came from
+    writer = db_utils.QueueWriter(worker['queue'], worker['batch_size'], sender=search_id)
+    stop = threading.Event()
+    if metrics is not None and worker['metrics_queue'] is not None:
+        threading.Thread(target=report_metrics, args=(metrics, search_id, stop),
+                         daemon=True).start()
+    try:
+        kwargs = dict(worker['caches'], **crawl_kwargs)
+        yf = YoutubeFollower(root_id, db_path=worker['db_path'], search_id=search_id,
+                             scheduler=scheduler, writer=writer,
+                             checkpoint_interval=None, metrics=metrics, **kwargs)
+        yf.run()
+        summary['n_videos'] = len(yf.search_info)
+    except Exception as e:
+        summary['error'] = repr(e)
+    finally:
+        stop.set()
+        writer.flush()
+    if metrics is not None:
+        summary['metrics'] = metrics.summary()
+    summary['seconds'] = time.time() - start
+    # approximate when crawls overlap: includes the others' calls meanwhile
+    summary['quota'] = quota_start - scheduler.remaining_quota()
+    return summary
+
+
+def run_batch(roots, n_workers=4, db_path='data/crawl.sqlite', fetch_rate=10,
+    api_rate=5, daily_quota=DAILY_QUOTA, min_quota=0, cache_path=None,
+    batch_size=1000, crawl_kwargs=None, verbose=1, metrics=False, metrics_port=None):
+    """
+    Crawls from each of roots in a pool of worker processes. All workers share
+    one scheduler (watch-page and API rate limits, daily API quota) and send
+    their rows to a db_utils.DatabaseWriter in this process, so there is no
+    lock contention on the database. Search ids are allocated here before the
+    crawls start. A crawl whose rows could not all be written is not marked
+    finished, and its summary reports the error.
+
+    INPUT:
+        roots: (list) root video_ids
+        n_workers: (int) number of crawls running at once
+        db_path: (str) where the sqlite database lives
+        fetch_rate: (float) max watch-page fetches per second, across all workers
+        api_rate: (float) max Data API calls per second, across all workers
+        daily_quota: (int) Data API quota units left for today
+        min_quota: (int) roots still waiting when less quota than this is left
+                   are skipped rather than crawled without their metadata;
+                   set it to the expected cost of one crawl
+        cache_path: (str) sqlite file for the recommendation / metadata caches
+                    shared by the workers; None for no caching
+        batch_size: (int) rows per table per message to the writer; the
+                    writer commits every 10 * batch_size rows
+        crawl_kwargs: (dict) other YoutubeFollower arguments, e.g. n_splits, depth
+        verbose: (int) level of console progress logging: 0 = error, 1 = info
+        metrics: (bool) record the per-phase metrics of each crawl (see
+                 YoutubeFollower)
+        metrics_port: (int) if given, serve the metrics of the batch, summed
+                      over its crawls, in the Prometheus text format on this
+                      port while the batch runs: finished crawls count in
+                      full, running ones as of their last snapshot (sent
+                      every METRICS_INTERVAL seconds); implies metrics
+
+    OUTPUT:
+        summaries: (list) one dict per root: root_id, search_id, n_videos,
+                   seconds, quota (units spent), error (None if the crawl
+                   succeeded) and, if recording, metrics (metrics.Metrics
+                   summary)
+    """
+    crawl_kwargs = dict(crawl_kwargs or {})
+    crawl_kwargs.pop('stream', None)
+    logger = logging.getLogger('youtube-follower.orchestrator')
+    logger.setLevel([logging.ERROR, logging.INFO][min(verbose, 1)])
+    if not logger.handlers:
+        ch = logging.StreamHandler()
+        ch.setFormatter(logging.Formatter("%(asctime)s [%(levelname)s] %(message)s"))
+        logger.addHandler(ch)
+        # the crawls' own handlers live on the parent logger
+        logger.propagate = False
+
+    queue = multiprocessing.Queue()
+    metrics_queue = multiprocessing.Queue() if metrics_port is not None else None
+    scheduler = Scheduler(api_rate=api_rate, fetch_rate=fetch_rate, daily_quota=daily_quota)
+    pool = multiprocessing.Pool(n_workers, initializer=init_worker,
+                                initargs=(scheduler, queue, db_path, cache_path,
+                                          batch_size, min_quota,
+                                          metrics or metrics_port is not None,
+                                          metrics_queue))
+    batch_metrics = BatchMetrics()
+    server = None
+    if metrics_port is not None:
+        listener = threading.Thread(target=batch_metrics.listen, args=(metrics_queue,),
+                                    daemon=True)
+        listener.start()
+        server = serve(batch_metrics, metrics_port)
+    # start the writer after the workers have been forked
+    writer = db_utils.DatabaseWriter(db_path, batch_size=10 * batch_size)
+    writer.listen(queue)
+
+    # allocate the search ids before any crawl starts
+    tasks = []
+    for root_id in roots:
+        searches_arr = [root_id, crawl_kwargs.get('n_splits', DEFAULT_N_SPLITS),
+                        crawl_kwargs.get('depth', DEFAULT_DEPTH), str(date.today()),
+                        crawl_kwargs.get('sample', False),
+                        crawl_kwargs.get('const_depth', DEFAULT_CONST_DEPTH)]
+        tasks.append((root_id, writer.create_search(searches_arr), crawl_kwargs))
+
+    summaries = []
+    start = time.time()
+    try:
+        for summary in pool.imap_unordered(crawl, tasks):
+            summaries.append(summary)
+            batch_metrics.finish(summary['search_id'], summary.get('metrics'))
+            if summary['error'] is None:
+                logger.info("[{}/{}] root {} (search {}): {} videos in {:.0f}s, "
+                            "{:.0f} quota units ({:.0f} left)"
+                            .format(len(summaries), len(tasks), summary['root_id'],
+                                    summary['search_id'], summary['n_videos'],
+                                    summary['seconds'], summary['quota'],
+                                    scheduler.remaining_quota()))
+            else:
+                logger.error("[{}/{}] root {} (search {}) failed: {}"
+                             .format(len(summaries), len(tasks), summary['root_id'],
+                                     summary['search_id'], summary['error']))
+        pool.close()
+        pool.join()
+    finally:
+        pool.terminate()
+        writer.close()
+        if server is not None:
+            server.shutdown()
+            server.server_close()
+            metrics_queue.put(None)
+            listener.join()
+    # the writer only knows once it has written a crawl's last rows
+    for summary in summaries:
+        error = writer.errors.get(summary['search_id'])
+        if error is not None and summary['error'] is None:
+            summary['error'] = "write failed: {!r}".format(error)
+            logger.error("root {} (search {}): {}".format(summary['root_id'],
+                                                          summary['search_id'],
+                                                          summary['error']))
+    logger.info("Finished {} crawls in {:.0f}s".format(len(tasks), time.time() - start))
+    return summaries
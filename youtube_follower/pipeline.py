@@ -0,0 +1,143 @@
+import logging
+from concurrent.futures import ThreadPoolExecutor, wait
+
+from . import utils
+from .metrics import bind
+
+logger = logging.getLogger('youtube-follower')
+
+
+class MetadataPipeline():
+    def __init__(self, video_cache=None, channel_cache=None, video_batch_size=45,
+        channel_batch_size=50):
+        """
+        Fetches Data API metadata in the background while the crawl runs. Every
+        video_batch_size newly discovered videos are sent off as a video batch,
+        and the channels of finished video batches are sent off in batches of
+        channel_batch_size. Requests run on a single background thread (the API
+        client is not thread-safe); results are only handed back to the thread
+        calling poll / finish. A batch whose request fails (e.g. the daily
+        quota is used up) is logged and left without metadata, as in the
+        synchronous crawl, rather than aborting the crawl.
+
+        INPUT:
+            video_cache: (cache.MetadataCache) passed through to utils.get_metadata
+            channel_cache: (cache.MetadataCache) passed through to utils.get_channel_metadata
+            video_batch_size: (int) videos per videos.list request
+            channel_batch_size: (int) channels per channels.list request
+        """
+        self.video_cache = video_cache
+        self.channel_cache = channel_cache
+        self.video_batch_size = video_batch_size
+        self.channel_batch_size = channel_batch_size
+        self.executor = ThreadPoolExecutor(max_workers=1)
+
+        self.pending_videos = []
+        self.pending_channels = []
+        self.seen_videos = set()
+        self.seen_channels = set()
+        self.video_futures = []
+        self.channel_futures = []
+
+
+    def add_videos(self, video_ids):
+        """
+        Queues newly discovered videos, sending off full batches
+
+        OUTPUT:
+            (videos, channels) metadata of any batches that have finished, see poll
+        """
+        for video_id in video_ids:
+            if video_id in self.seen_videos:
+                continue
+            self.seen_videos.add(video_id)
+            self.pending_videos.append(video_id)
+        self._submit_videos()
+        return self.poll()
+
+
+    def add_channels(self, channel_ids):
+        """
+        Queues channels directly, e.g. those of videos whose metadata was fetched
+        before a crawl was resumed
+        """
+        for channel_id in channel_ids:
+            if channel_id is None or channel_id in self.seen_channels:
+                continue
+            self.seen_channels.add(channel_id)
+            self.pending_channels.append(channel_id)
+        self._submit_channels()
+
+
+    def _submit_videos(self, flush=False):
+        while (len(self.pending_videos) >= self.video_batch_size
+               or (flush and self.pending_videos)):
+            batch = self.pending_videos[:self.video_batch_size]
+            self.pending_videos = self.pending_videos[self.video_batch_size:]
+            self.video_futures.append(self.executor.submit(
+                bind(utils.get_metadata), batch, cache=self.video_cache))
+
+
+    def _submit_channels(self, flush=False):
+        while (len(self.pending_channels) >= self.channel_batch_size
+               or (flush and self.pending_channels)):
+            batch = self.pending_channels[:self.channel_batch_size]
+            self.pending_channels = self.pending_channels[self.channel_batch_size:]
+            self.channel_futures.append(self.executor.submit(
+                bind(utils.get_channel_metadata), batch, cache=self.channel_cache))
+
+
+    def poll(self):
+        """
+        Collects the batches that have finished and queues the channels of
+        finished video batches
+
+        OUTPUT:
+            videos: (dict) video metadata from the finished video batches
+            channels: (dict) channel metadata from the finished channel batches
+        """
+        videos = {}
+        for future in [f for f in self.video_futures if f.done()]:
+            self.video_futures.remove(future)
+            videos.update(self._result(future, 'video'))
+        self.add_channels([data.get('channel_id') for data in videos.values()])
+
+        channels = {}
+        for future in [f for f in self.channel_futures if f.done()]:
+            self.channel_futures.remove(future)
+            channels.update(self._result(future, 'channel'))
+        return videos, channels
+
+
+    def _result(self, future, kind):
+        """
+        Metadata of a finished batch; empty if its request failed
+        """
+        try:
+            return future.result()
+        except Exception as e:
+            logger.error("Could not get a batch of {} metadata: {!r}".format(kind, e))
+            return {}
+
+
+    def finish(self):
+        """
+        Sends off the partial batches and waits for everything to finish
+
+        OUTPUT:
+            (videos, channels) metadata of the batches not yet returned by poll
+        """
+        videos = {}
+        channels = {}
+        self._submit_videos(flush=True)
+        while self.video_futures:
+            wait(self.video_futures[:1])
+            new_videos, new_channels = self.poll()
+            videos.update(new_videos)
+            channels.update(new_channels)
+        self._submit_channels(flush=True)
+        for future in self.channel_futures:
+            channels.update(self._result(future, 'channel'))
+        self.channel_futures = []
+        self.executor.shutdown()
+        return videos, channels
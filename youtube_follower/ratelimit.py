@@ -0,0 +1,37 @@
+import multiprocessing
+import time
+
+
+class RateLimiter():
+    def __init__(self, rate, burst=1):
+        """
+        Token bucket shared by every thread and process it is handed to (its
+        state lives in shared memory), so a batch of crawls can be held to a
+        global request rate.
+
+        INPUT:
+            rate: (float) tokens added per second, i.e. the sustained request rate
+            burst: (float) bucket capacity, i.e. how many requests can go out at once
+        """
+        self.rate = rate
+        self.burst = burst
+        self.lock = multiprocessing.Lock()
+        self.tokens = multiprocessing.RawValue('d', burst)
+        self.updated = multiprocessing.RawValue('d', time.time())
+
+
+    def acquire(self, n=1):
+        """
+        Blocks until n tokens are available and takes them
+        """
+        while True:
+            with self.lock:
+                now = time.time()
+                self.tokens.value = min(self.burst, self.tokens.value
+                                        + (now - self.updated.value) * self.rate)
+                self.updated.value = now
+                if self.tokens.value >= n:
+                    self.tokens.value -= n
+                    return
+                wait = (n - self.tokens.value) / self.rate
+            time.sleep(wait)
@@ -0,0 +1,221 @@
+import json
+import multiprocessing
+import random
+import socket
+import time
+from http.client import HTTPException
+from urllib.error import HTTPError, URLError
+from urllib.request import urlopen
+
+import httplib2
+from googleapiclient.errors import HttpError
+
+from . import metrics
+from .ratelimit import RateLimiter
+
+
+# Data API quota units charged per call, by method
+QUOTA_COSTS = {'search.list': 100,
+               'videos.list': 1,
+               'channels.list': 1,
+               'playlistItems.list': 1,
+               'commentThreads.list': 1}
+
+# default daily allowance of a Data API project
+DAILY_QUOTA = 10000
+
+# base delay (seconds) of the exponential backoff, by type of error
+BACKOFF_BASE = {'rate': 5, 'server': 1, 'network': 1}
+
+
+class QuotaExceeded(Exception):
+    """
+    Raised when a call would exceed the daily Data API quota
+    """
+    pass
+
+
+def api_error_type(error):
+    """
+    Classifies a googleapiclient HttpError as 'quota', 'rate', 'server' or
+    'fatal' (not worth retrying)
+    """
+    status = error.resp.status
+    try:
+        reason = json.loads(error.content.decode('utf-8'))['error']['errors'][0]['reason']
+    except (ValueError, KeyError, IndexError, AttributeError):
+        reason = None
+    if reason in ['quotaExceeded', 'dailyLimitExceeded']:
+        return 'quota'
+    if status == 429 or reason in ['rateLimitExceeded', 'userRateLimitExceeded']:
+        return 'rate'
+    if status >= 500:
+        return 'server'
+    return 'fatal'
+
+
+def fetch_error_type(error):
+    """
+    Classifies an exception raised while downloading a page, or by the
+    transport of an API call, as 'rate', 'server', 'network' or 'fatal' (not
+    worth retrying)
+    """
+    if isinstance(error, HTTPError):
+        if error.code == 429:
+            return 'rate'
+        if error.code >= 500:
+            return 'server'
+        return 'fatal'
+    if isinstance(error, (URLError, HTTPException, socket.timeout, ConnectionError,
+                          httplib2.HttpLib2Error)):
+        return 'network'
+    return 'fatal'
+
+
+def quota_day():
+    """
+    Current day of the quota period. Quotas reset at midnight Pacific time; we
+    use UTC-8 year-round, so during daylight time we roll over an hour late.
+    """
+    return int((time.time() - 8*60*60) // (24*60*60))
+
+
+class Scheduler():
+    def __init__(self, api_rate=5, fetch_rate=10, daily_quota=DAILY_QUOTA,
+        max_tries=8, max_delay=300):
+        """
+        Single gateway for every request to YouTube: Data API calls go through
+        execute and watch-page downloads through fetch. Both are paced by token
+        buckets and retried with exponential backoff (full jitter) keyed on the
+        type of error, and API calls are charged against the daily quota. Its
+        state lives in shared memory, so one scheduler can be handed to every
+        process of a batch.
+
+        INPUT:
+            api_rate: (float) max Data API calls per second
+            fetch_rate: (float) max watch-page downloads per second
+            daily_quota: (int) Data API quota units available per day
+            max_tries: (int) attempts per API call before giving up
+            max_delay: (float) cap on a single backoff, in seconds
+        """
+        self.api_limiter = RateLimiter(api_rate, burst=max(1, api_rate))
+        self.fetch_limiter = RateLimiter(fetch_rate, burst=max(1, fetch_rate))
+        self.daily_quota = daily_quota
+        self.max_tries = max_tries
+        self.max_delay = max_delay
+        self.lock = multiprocessing.Lock()
+        self.quota_used = multiprocessing.RawValue('d', 0)
+        self.day = multiprocessing.RawValue('i', quota_day())
+
+
+    def _roll_over(self):
+        # caller holds the lock
+        today = quota_day()
+        if self.day.value != today:
+            self.day.value = today
+            self.quota_used.value = 0
+
+
+    def remaining_quota(self):
+        """
+        Quota units left today
+        """
+        with self.lock:
+            self._roll_over()
+            return self.daily_quota - self.quota_used.value
+
+
+    def charge(self, cost):
+        """
+        Takes cost quota units, raising QuotaExceeded if there are not enough
+        """
+        with self.lock:
+            self._roll_over()
+            if self.quota_used.value + cost > self.daily_quota:
+                raise QuotaExceeded("{} of {} quota units used today"
+                                    .format(self.quota_used.value, self.daily_quota))
+            self.quota_used.value += cost
+
+
+    def backoff(self, attempt, error_type):
+        """
+        Sleeps before retry number attempt (0-based) after an error_type error
+        """
+        ceiling = min(self.max_delay, BACKOFF_BASE[error_type] * 2 ** attempt)
+        time.sleep(random.uniform(0, ceiling))
+
+
+    def execute(self, request, method):
+        """
+        Executes a googleapiclient request
+
+        INPUT:
+            request: the request object, e.g. youtube.videos().list(...)
+            method: (str) API method, e.g. 'videos.list', for quota accounting
+
+        OUTPUT:
+            the API response
+        """
+        cost = QUOTA_COSTS.get(method, 1)
+        for attempt in range(self.max_tries):
+            # failed calls are charged too
+            self.charge(cost)
+            metrics.active.inc('quota_units', cost, method=method)
+            with metrics.active.timer('rate_limit_wait', kind='api'):
+                self.api_limiter.acquire()
+            try:
+                with metrics.active.timer('api_call', method=method):
+                    return request.execute()
+            except Exception as e:
+                # HttpErrors are answers from the API; anything else failed
+                # on the way (timeouts, dropped connections, DNS)
+                if isinstance(e, HttpError):
+                    error_type = api_error_type(e)
+                else:
+                    error_type = fetch_error_type(e)
+                metrics.active.inc('api_errors', method=method, error=error_type)
+                if error_type == 'quota':
+                    with self.lock:
+                        self.quota_used.value = self.daily_quota
+                    raise QuotaExceeded("API reports the daily quota is used up") from e
+                if error_type == 'fatal' or attempt + 1 == self.max_tries:
+                    raise
+                metrics.active.inc('api_retries', method=method)
+                self.backoff(attempt, error_type)
+
+
+    def fetch(self, url, read, max_tries=None, on_retry=None):
+        """
+        Downloads url and hands the response to read, retrying both on errors
+
+        INPUT:
+            url: (str)
+            read: (function) called with the open response; its result is returned
+            max_tries: (int) attempts before giving up; None to keep trying
+            on_retry: (function) called with the exception before each retry
+
+        OUTPUT:
+            whatever read returns
+        """
+        attempt = 0
+        while True:
+            with metrics.active.timer('rate_limit_wait', kind='fetch'):
+                self.fetch_limiter.acquire()
+            try:
+                # connecting and headers, then the download (and whatever
+                # read does with it)
+                with metrics.active.timer('urlopen'):
+                    response = urlopen(url)
+                with response, metrics.active.timer('page_read'):
+                    return read(response)
+            except Exception as e:
+                error_type = fetch_error_type(e)
+                metrics.active.inc('fetch_errors', error=error_type)
+                attempt += 1
+                if error_type == 'fatal' or attempt == max_tries:
+                    raise
+                metrics.active.inc('fetch_retries')
+                if on_retry is not None:
+                    on_retry(e)
+                # keep retrying, but at most every max_delay seconds
+                self.backoff(min(attempt - 1, 16), error_type)
@@ -1,18 +1,108 @@
 import os
+import sys
+import threading
+import types
 
-from googleapiclient.discovery import build
 from googleapiclient.errors import HttpError
 
-KEY_LOC = os.path.join(os.path.dirname(__file__), '../credentials/api_key.txt')
-with open(KEY_LOC, 'r') as f:
-	DEVELOPER_KEY = f.read()
+from . import metrics
+from .scheduler import Scheduler
 
+KEY_LOC = os.path.join(os.path.dirname(__file__), '../credentials/api_key.txt')
 
 YOUTUBE_API_SERVICE_NAME = 'youtube'
 YOUTUBE_API_VERSION = 'v3'
 
-youtube = build(YOUTUBE_API_SERVICE_NAME, YOUTUBE_API_VERSION,
-	developerKey=DEVELOPER_KEY)
+# the API client is built on first use (see get_client), so importing this
+# module needs neither credentials nor googleapiclient.discovery
+_injected_client = None
+_local = threading.local()
+# the discovery document, fetched once and shared by every thread's client
+_discovery_document = None
+_discovery_lock = threading.Lock()
+
+
+def read_key():
+	"""
+	Reads the developer key from credentials/api_key.txt
+	"""
+	with open(KEY_LOC, 'r') as f:
+		return f.read().strip()
+
+
+def discovery_document():
+	"""
+	Returns the Data API discovery document (JSON text), downloading it on
+	the first call only
+	"""
+	global _discovery_document
+	with _discovery_lock:
+		if _discovery_document is None:
+			import httplib2
+			from googleapiclient.discovery import DISCOVERY_URI
+
+			uri = DISCOVERY_URI.format(api=YOUTUBE_API_SERVICE_NAME,
+				apiVersion=YOUTUBE_API_VERSION)
+			response, content = httplib2.Http(timeout=60).request(uri)
+			if response.status >= 400:
+				raise HttpError(response, content, uri=uri)
+			_discovery_document = content.decode('utf-8')
+		return _discovery_document
+
+
+def build_client():
+	"""
+	Builds a Data API client with its own HTTP transport, from the shared
+	discovery document (so no download per client). httplib2 keeps the
+	connection to the API open between calls, so one client per thread
+	reuses a single connection rather than opening one per request.
+	"""
+	import httplib2
+	from googleapiclient.discovery import build_from_document
+
+	return build_from_document(discovery_document(), developerKey=read_key(),
+		http=httplib2.Http(timeout=60))
+
+
+def get_client():
+	"""
+	Returns the client API calls should use: the injected one if set_client
+	was called, otherwise this thread's live client, built on first use
+	(httplib2 transports are not thread-safe)
+	"""
+	if _injected_client is not None:
+		return _injected_client
+	client = getattr(_local, 'client', None)
+	if client is None:
+		client = _local.client = build_client()
+	return client
+
+
+def set_client(client):
+	"""
+	Sends all API calls to client instead of the live API, e.g. a local
+	stand-in for offline runs. Pass None to go back to the live API.
+
+	INPUT:
+		client: object with the googleapiclient resource methods used here
+				(videos(), channels(), ...) whose requests have execute()
+	"""
+	global _injected_client
+	_injected_client = client
+
+
+class _Module(types.ModuleType):
+	# utils.youtube is still available, built on first access (a module
+	# __getattr__ would need Python 3.7)
+	@property
+	def youtube(self):
+		return get_client()
+
+sys.modules[__name__].__class__ = _Module
+
+# every API call and watch-page fetch goes through this; replace it (e.g. with
+# one shared by a batch of processes) to change the limits
+scheduler = Scheduler()
 
 def search(query, max_results=10):
 	"""
@@ -28,12 +118,12 @@ def search(query, max_results=10):
 	"""
 
 	# Call the search.list method to retrieve results matching the query
-	search_response = youtube.search().list(
+	search_response = scheduler.execute(get_client().search().list(
 	  q=query,
 	  part='id,snippet',
 	  maxResults=max_results,
 	  type='video'
-	).execute()
+	), 'search.list')
   
 	video_ids = []
 	for search_result in search_response.get('items', []):
@@ -55,11 +145,11 @@ def get_top_news_videos():
 
     for playlist_id in playlists:
         # get the videos in the Top Stories playlist
-        search_response = youtube.playlistItems().list(
+        search_response = scheduler.execute(get_client().playlistItems().list(
             playlistId=playlist_id,
             part='contentDetails',
             maxResults=50
-        ).execute()
+        ), 'playlistItems.list')
     
         for search_result in search_response.get('items', []):
             video_id = search_result.get('contentDetails')['videoId']
@@ -79,149 +169,200 @@ def video_exists(video_id):
     OUTPUT:
         boolean for whether video is available
     """
-    query = youtube.videos().list(id=video_id, part='id').execute()
+    query = scheduler.execute(get_client().videos().list(id=video_id, part='id'),
+                              'videos.list')
     return query.get('items')
 
 
-def get_metadata_batch(video_ids):
+# API parts requested for each metadata field
+VIDEO_PARTS = {'snippet': ['title', 'postdate', 'description', 'category', 'channel_id'],
+               'statistics': ['likes', 'dislikes', 'views', 'n_comments']}
+
+CHANNEL_PARTS = {'snippet': ['name', 'country', 'date_created'],
+                 'statistics': ['n_subscribers', 'n_videos', 'n_views'],
+                 'topicDetails': ['categories']}
+
+
+def stale_parts(stale, parts):
+    """
+    Groups ids by the API parts needed to refresh their stale fields
+
+    INPUT:
+        stale: (dict) stale fields for each id: stale[id] = set()
+        parts: (dict) fields returned by each part, e.g. VIDEO_PARTS
+
+    OUTPUT:
+        groups: (dict) ids keyed by the comma-joined parts to request
+    """
+    groups = {}
+    for id_, fields in stale.items():
+        needed = ','.join(part for part, part_fields in parts.items()
+                          if fields.intersection(part_fields))
+        groups.setdefault(needed, []).append(id_)
+    return groups
+
+
+def get_metadata_batch(video_ids, part='snippet,statistics'):
     """
     Helper for get_metadata. Gets metadata for batches of max length of 45
     video_ids
 
     INPUT:
-        video_id: (str)
+        video_ids: (list of str)
+        part: (str) comma-separated API parts to request (see VIDEO_PARTS)
 
     OUTPUT:
         result: (dict) video metadata for each video: result[video_id] = {}
     """
+    metrics.active.inc('videos_requested', len(video_ids))
     video_ids = ", ".join(video_ids)
 
-    video_response = youtube.videos().list(
-        id=video_ids,
-        part='snippet, statistics'
-        ).execute()
+    with metrics.active.timer('get_metadata_batch'):
+        video_response = scheduler.execute(get_client().videos().list(
+            id=video_ids,
+            part=part
+            ), 'videos.list')
 
     result = {}
 
     for video_result in video_response.get('items', []):
         # Get video title, publication date, description, category_id
         snippet = video_result.get('snippet')
-        contentDetails = video_result.get('contentDetails')
         statistics = video_result.get('statistics')
         video_id = video_result['id']
 
-        result[video_id] = {'title': snippet.get('title', None),
-                            'postdate': snippet.get('publishedAt', None),
-                            'description': snippet.get('description', None),
-                            'category': snippet.get('categoryId', None),
-                            'channel_id': snippet.get('channelId', None),
-                            'likes': statistics.get('likeCount', None),
-                            'dislikes': statistics.get('dislikeCount', None),
-                            'views': statistics.get('viewCount', None),
-                            'n_comments': statistics.get('commentCount', None)}
+        result[video_id] = {}
+        if snippet is not None:
+            result[video_id].update({'title': snippet.get('title', None),
+                                     'postdate': snippet.get('publishedAt', None),
+                                     'description': snippet.get('description', None),
+                                     'category': snippet.get('categoryId', None),
+                                     'channel_id': snippet.get('channelId', None)})
+        if statistics is not None:
+            result[video_id].update({'likes': statistics.get('likeCount', None),
+                                     'dislikes': statistics.get('dislikeCount', None),
+                                     'views': statistics.get('viewCount', None),
+                                     'n_comments': statistics.get('commentCount', None)})
 
     return result
 
-def get_metadata(video_ids):
+def get_metadata(video_ids, part='snippet,statistics', cache=None):
     """
     Returns the metadata for the videos in video_ids as a nested dictionary
 
     INPUT:
         video_ids: (str) list of video_ids
+        part: (str) comma-separated API parts to request (see VIDEO_PARTS)
+        cache: (cache.MetadataCache) if given, only videos with stale fields
+               are requested, and only for the parts holding those fields
 
     OUTPUT:
         result: nested dictionary of video_id metadata
 
     """
+    if cache is not None:
+        result, stale = cache.get(video_ids)
+        for needed, batch in stale_parts(stale, VIDEO_PARTS).items():
+            result.update(cache.put(get_metadata(batch, part=needed)))
+        return result
+
     result = {}
     batch_size = 45
 
     for ix in range(0, len(video_ids), batch_size):
         batch = video_ids[ix: ix + batch_size]
-        # try getting info in batch
-        for _ in range(10):
-            try:
-                result.update(get_metadata_batch(batch))
-                break
-            except HttpError:
-                pass
+        # try getting info in batch (the scheduler retries transient errors)
+        try:
+            result.update(get_metadata_batch(batch, part))
         # if can't get in batch, try getting individually 
-        else:
+        except HttpError:
             for video_id in batch:
                 try:
-                    result.update(get_metadata_batch(video_id))
+                    result.update(get_metadata_batch([video_id], part))
                 except HttpError as e:
                     continue
     return result
 
 
-def get_channel_metadata_batch(channel_ids):
+def get_channel_metadata_batch(channel_ids, part='snippet,statistics,topicDetails'):
 	"""
 	Helper for get_channel_metadata. Gets metadata for batches of max length of 45
 	video_ids
 
 	INPUT:
 		channel_ids: (list of str) channel_ids in a list
+		part: (str) comma-separated API parts to request (see CHANNEL_PARTS)
 
 	OUTPUT:
 		result: (list) nested dict of channel metadata
 	"""
+	metrics.active.inc('channels_requested', len(channel_ids))
 	id_str = ",".join(channel_ids)
 
-	response = youtube.channels().list(
-		id=id_str,
-		part='snippet,statistics,topicDetails'
-	).execute()
+	with metrics.active.timer('get_channel_metadata_batch'):
+		response = scheduler.execute(get_client().channels().list(
+			id=id_str,
+			part=part
+		), 'channels.list')
 
 	result = {}
 	for channel_result in response.get('items', []):
 		channel_id = channel_result['id']
 		statistics = channel_result.get('statistics')
 		snippet = channel_result.get('snippet')
-		if channel_result.get('topicDetails', []):
-			cat_urls = channel_result.get('topicDetails')['topicCategories']
-			categories = [url.split('/')[-1] for url in cat_urls]
-		else:
-			categories = None
 
 		# update the channels dict
-		result[channel_id] = {'name': snippet.get('title', None),
-							  'country': snippet.get('country', None),
-							  'date_created': snippet.get('publishedAt', None),
-							  'n_subscribers': statistics.get('subscriberCount'),
-							  'n_videos': statistics.get('videoCount', None),
-							  'n_views': statistics.get('viewCount', None),
-							  'categories': categories}
+		result[channel_id] = {}
+		if snippet is not None:
+			result[channel_id].update({'name': snippet.get('title', None),
+									   'country': snippet.get('country', None),
+									   'date_created': snippet.get('publishedAt', None)})
+		if statistics is not None:
+			result[channel_id].update({'n_subscribers': statistics.get('subscriberCount'),
+									   'n_videos': statistics.get('videoCount', None),
+									   'n_views': statistics.get('viewCount', None)})
+		if 'topicDetails' in part:
+			if channel_result.get('topicDetails', []):
+				cat_urls = channel_result.get('topicDetails')['topicCategories']
+				categories = [url.split('/')[-1] for url in cat_urls]
+			else:
+				categories = None
+			result[channel_id]['categories'] = categories
 	return result
 	
 
 
-def get_channel_metadata(channel_ids):
+def get_channel_metadata(channel_ids, part='snippet,statistics,topicDetails', cache=None):
 	"""
 	Returns the metadata for the channels in channel_ids as a nested list
 
 	INPUT:
 		channel_ids: (str) list of channel_ids
+		part: (str) comma-separated API parts to request (see CHANNEL_PARTS)
+		cache: (cache.MetadataCache) if given, only channels with stale fields
+			   are requested, and only for the parts holding those fields
 
 	OUTPUT:
 		result: nested list of channel_id metadata
 
 	"""
+	if cache is not None:
+		result, stale = cache.get(channel_ids)
+		for needed, batch in stale_parts(stale, CHANNEL_PARTS).items():
+			result.update(cache.put(get_channel_metadata(batch, part=needed)))
+		return result
+
 	batch_size = 50  # 50 seems to be the API limit per request
 	result = {}
 	for ix in range(0, len(channel_ids), batch_size):
 		batch = channel_ids[ix: ix+batch_size]
-		for _ in range(10):
-			try:
-				result.update(get_channel_metadata_batch(batch))
-				break
-			except HttpError:
-				pass
+		try:
+			result.update(get_channel_metadata_batch(batch, part))
 		# if can't get in batch, try getting individually 
-		else:
+		except HttpError:
 			for channel_id in batch:
 				try:
-					result.update(get_channel_metadata_batch(channel_id))
+					result.update(get_channel_metadata_batch([channel_id], part))
 				except HttpError:
 					continue
 	return result
@@ -240,7 +381,7 @@ def get_comments(video_id, max_results=5):
 		result: (str array) top n comments
 	"""
 
-	comment_request = youtube.commentThreads().list(
+	comment_request = get_client().commentThreads().list(
 		videoId=video_id,
 		maxResults=max_results,
 		textFormat='plainText',
@@ -248,7 +389,7 @@ def get_comments(video_id, max_results=5):
 		order='relevance')
 
 	try:
-		comment_response = comment_request.execute()
+		comment_response = scheduler.execute(comment_request, 'commentThreads.list')
 	except HttpError:
 		return -1
 
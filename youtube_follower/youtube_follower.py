@@ -1,23 +1,51 @@
 import logging
 import re
-import json
 import time
 from datetime import date
 import os
 import sys
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
-from urllib.request import urlopen
 
 from bs4 import BeautifulSoup
 
 from . import utils
 from . import db_utils
+from . import extract
+from .crawl_state import ChannelRecord, MetadataTable, SearchInfo, VideoRecord
+from .frontier import Frontier
+from .metrics import Metrics, NullMetrics, bind, recording
+from .pipeline import MetadataPipeline
+
+
+# tables a streaming crawl writes to as it goes
+STREAMED_TABLES = ['videos', 'channels', 'channel_categories', 'recommendations']
+
+WATCH_URL = "http://youtube.com/watch?v={}"
+
+# search parameters when not given (run_batch records them for its searches
+# before the crawls start)
+DEFAULT_N_SPLITS = 3
+DEFAULT_DEPTH = 5
+DEFAULT_CONST_DEPTH = 5
+
+
+class VideoUnavailable(Exception):
+    """
+    Raised when the root video of a crawl is not available
+    """
+    pass
 
 
 class YoutubeFollower():
-    def __init__(self, root_id, n_splits=3, depth=5, verbose=1, const_depth=5,
-        sample=False, db_path='data/crawl.sqlite'):
+    def __init__(self, root_id, n_splits=DEFAULT_N_SPLITS, depth=DEFAULT_DEPTH, verbose=1,
+        const_depth=DEFAULT_CONST_DEPTH, sample=False, db_path='data/crawl.sqlite',
+        n_workers=1, rec_cache=None,
+        video_cache=None, channel_cache=None, pipeline=False, stream=False,
+        batch_size=1000, seed=None, checkpoint_interval=300, search_id=None,
+        scheduler=None, writer=None, watch_url=WATCH_URL, metrics=None):
         """
         INPUT:
             root_id: (str) YouTube video_id of the root video
@@ -28,23 +56,90 @@ class YoutubeFollower():
                                from recommendations (toggled w/ sample parameter)
             sample: (bool) whether to sample from recommendations after const_depth splits
             db_path: (str) where the sqlite database lives
+            n_workers: (int) max number of watch pages fetched concurrently
+                             within a level of the tree
+            rec_cache: (cache.RecommendationCache) cache of watch-page recommendations
+                       shared across searches; None to always scrape
+            video_cache: (cache.MetadataCache) cache of video metadata shared across
+                         searches; None to always query the API
+            channel_cache: (cache.MetadataCache) same for channel metadata
+            pipeline: (bool) whether to fetch metadata in the background as videos
+                             are discovered, instead of after the crawl
+            stream: (bool) whether to write rows to the database as soon as they are
+                           available rather than in save_results. Keeps memory
+                           bounded and what has been crawled survives a crash
+            batch_size: (int) rows per table per transaction when streaming
+            seed: (int) seed for the sampling RNG
+            checkpoint_interval: (float) seconds between checkpoints of the crawl
+                                 state (see resume); None to never checkpoint
+            search_id: (int) id of an existing search to continue (see resume);
+                       None to create a new search
+            scheduler: (scheduler.Scheduler) paces and retries the watch-page
+                       fetches, e.g. one shared by a batch of crawls; defaults
+                       to utils.scheduler, which the API calls go through
+            writer: object with add(table, rows) / flush() (such as
+                    db_utils.BatchWriter) that receives all rows instead of the
+                    crawler's own connection; implies streaming. Given a
+                    db_utils.DatabaseWriter, the crawl's other writes (search,
+                    checkpoints) go through it too, and rows of the crawl that
+                    fail to be written make its next flush raise
+            watch_url: (str) watch-page url, formatted with the video_id; point
+                       it at a local stand-in to crawl offline
+            metrics: (metrics.Metrics) records latencies and counts of each
+                     phase of the crawl: page fetches and parsing, API
+                     batches, retries, cache hits, quota, database writes.
+                     Its summary is written next to the log, as
+                     <root_id>_<date>_<search_id>_metrics.json; None to
+                     record nothing
         """
 
         self.root_id = root_id
-        self.search_info = {}
-        self.video_info = {}
-        self.channel_info = {}
         self.n_splits = n_splits
         self.depth = depth
         self.const_depth = const_depth
         self.sample = sample
         self.verbose = verbose
-        self.db = db_utils.create_connection(db_path)
+        self.n_workers = n_workers
+        self.rec_cache = rec_cache
+        self.video_cache = video_cache
+        self.channel_cache = channel_cache
+        self.metadata_pipeline = None
+        if pipeline:
+            self.metadata_pipeline = MetadataPipeline(video_cache, channel_cache)
+        self.db_path = db_path
+        self._db = None
+        self.writer = writer
+        if writer is None and stream:
+            self.writer = db_utils.BatchWriter(self.db, batch_size)
+        self.scheduler = scheduler if scheduler is not None else utils.scheduler
+        self.watch_url = watch_url
+        self.metrics = metrics if metrics is not None else NullMetrics()
+        self.rng = np.random.RandomState(seed)
+        self.checkpoint_interval = checkpoint_interval
+        self.last_checkpoint = time.time()
+        self.frontier = None
+        # videos popped from the frontier but not yet recorded
+        self.in_flight = deque()
 
         # write search info to the database and get the serialized search_id
-        searches_arr = [self.root_id, self.n_splits, self.depth, str(date.today()),
-                        self.sample, self.const_depth]
-        self.search_id = db_utils.create_record(self.db, "searches", searches_arr)
+        if search_id is None:
+            searches_arr = [self.root_id, self.n_splits, self.depth, str(date.today()),
+                            self.sample, self.const_depth]
+            search_id = self.db_call(db_utils.create_record, "searches", searches_arr)
+            if self._db is not None:
+                # rather than with the first checkpoint or the results, so the
+                # search is never rolled back with a failed save_results
+                self._db.commit()
+        self.search_id = search_id
+        if isinstance(self.writer, db_utils.DatabaseWriter):
+            # so that the writer reports our failed writes to us
+            self.writer = self.writer.client(search_id)
+
+        # what has been crawled so far; a streaming crawl keeps only the
+        # depth of each video and the channel of its metadata
+        self.search_info = SearchInfo(search_id, recommendations=self.writer is None)
+        self.video_info = MetadataTable(VideoRecord, ids=self.search_info.ids)
+        self.channel_info = MetadataTable(ChannelRecord)
 
         # set up logger
         log_opts = [logging.ERROR, logging.INFO, logging.DEBUG]
@@ -59,70 +154,170 @@ class YoutubeFollower():
         self.logger.addHandler(ch)
 
 
-    def save_results(self):
+    @property
+    def db(self):
+        # opened on first use: a crawl writing through a writer may never need it
+        if self._db is None:
+            self._db = db_utils.create_connection(self.db_path)
+        return self._db
+
+
+    def db_call(self, fn, *args):
         """
-        Writes recs and video information to the database
+        Runs fn(conn, *args) on the writer's connection if the writer is a
+        db_utils.DatabaseWriter (or one of its WriterClients) or QueueWriter
+        (after the rows already sent to it; a QueueWriter does not return the
+        result), otherwise on our own connection
         """
-        videos_order = ['search_id', 'title', 'postdate', 'description', 'category',
+        if isinstance(self.writer, (db_utils.DatabaseWriter, db_utils.WriterClient,
+                                    db_utils.QueueWriter)):
+            return self.writer.call(fn, *args)
+        return fn(self.db, *args)
+
+
+    def metadata_rows(self, videos, channels):
+        """
+        Converts video / channel metadata into database rows
+
+        INPUT:
+            videos: (dict) video metadata, as in video_info: videos[video_id] = {}
+            channels: (dict) channel metadata, as in channel_info
+
+        OUTPUT:
+            rows: (dict) rows for the videos, channels and channel_categories tables
+        """
+        videos_order = ['title', 'postdate', 'description', 'category',
                         'channel_id', 'likes', 'dislikes', 'views', 'n_comments']
-        video_arr = utils.dict_to_array(self.video_info, videos_order)
+        video_arr = [[row[0], self.search_id] + row[1:]
+                     for row in utils.dict_to_array(videos, videos_order)]
 
-        channel_order = ['search_id', 'name', 'country', 'date_created', 'n_subscribers',
+        channel_order = ['name', 'country', 'date_created', 'n_subscribers',
                          'n_videos', 'n_views']
-        channel_arr = utils.dict_to_array(self.channel_info, channel_order)
+        channel_arr = [[row[0], self.search_id] + row[1:]
+                       for row in utils.dict_to_array(channels, channel_order)]
 
         channel_cats_arr = []
-        for channel_id, data in self.channel_info.items():
+        for channel_id, data in channels.items():
             if not data['categories']:
                 channel_cats_arr.append([channel_id, self.search_id, None])
                 continue
             for category in data['categories']:
                 channel_cats_arr.append([channel_id, self.search_id, category])
 
+        return {'videos': video_arr,
+                'channels': channel_arr,
+                'channel_categories': channel_cats_arr}
+
+
+    def recommendation_rows(self, search_info):
+        """
+        Converts search info (as in self.search_info:
+        search_info[video_id] = {'recommendations', 'depth'}) into
+        recommendations rows
+        """
         recs_arr = []
-        for video_id, data in self.search_info.items():
+        for video_id, data in search_info.items():
             if not data['recommendations']:
                 recs_arr.append([video_id, self.search_id, None, data['depth']])
                 continue
             for rec in data['recommendations']:
                 recs_arr.append([video_id, self.search_id, rec, data['depth']])
+        return recs_arr
 
-        db_utils.create_record(self.db, "videos", video_arr)
-        db_utils.create_record(self.db, "channels", channel_arr)
-        db_utils.create_record(self.db, "channel_categories", channel_cats_arr)
-        db_utils.create_record(self.db, "recommendations", recs_arr)
-        self.db.commit()
 
+    def save_results(self):
+        """
+        Writes recs and video information to the database. When streaming,
+        everything has already been handed to the writer; this just flushes it.
+        """
+        if self.writer is not None:
+            self.writer.flush()
+            return
 
-    def populate_info(self):
+        rows = self.metadata_rows(self.video_info, self.channel_info)
+        rows['recommendations'] = self.recommendation_rows(self.search_info)
+        for table in ["videos", "channels", "channel_categories", "recommendations"]:
+            with self.metrics.timer('db_insert', table=table):
+                db_utils.create_record(self.db, table, rows[table])
+            self.metrics.inc('rows_written', len(rows[table]), table=table)
+        with self.metrics.timer('db_commit'):
+            self.db.commit()
+
+
+    def store_metadata(self, videos, channels):
         """
-        Fills the video & channel info array with video / channel data
+        Adds fetched video / channel metadata to video_info / channel_info. When
+        streaming, the rows go straight to the writer and only the channel_id of
+        each video is kept in memory.
+
+        INPUT:
+            videos: (dict) video metadata: videos[video_id] = {}
+            channels: (dict) channel metadata: channels[channel_id] = {}
         """
-        # video information
-        self.logger.info("Getting batch video metadata")
-        video_ids = list(set(self.search_info.keys()))
-        metadata = utils.get_metadata(video_ids)
-        for video_id in video_ids:
+        videos = {video_id: data for video_id, data in videos.items() if data}
+        channels = {channel_id: data for channel_id, data in channels.items() if data}
+        for video_id in videos:
             self.logger.debug("Logging info for {}".format(video_id))
-            video_data = metadata.get(video_id)
-            if not video_data:
-                self.logger.warning("Could not get metadata for {}".format(video_id))
-                continue
-            video_data['search_id'] = self.search_id
-            self.video_info[video_id] = video_data
-
-        # channel information
-        self.logger.info("Getting batch channel metadata")
-        channel_ids = list(set([vid['channel_id'] for vid in self.video_info.values()]))
-        metadata = utils.get_channel_metadata(channel_ids)
-        for channel_id in channel_ids:
+        for channel_id in channels:
             self.logger.debug("Logging info for {}".format(channel_id))
-            channel_data = metadata.get(channel_id)
-            if not channel_data:
+
+        if self.writer is not None:
+            for table, rows in self.metadata_rows(videos, channels).items():
+                self.writer.add(table, rows)
+            videos = {video_id: {'channel_id': data['channel_id']}
+                      for video_id, data in videos.items()}
+            channels = {channel_id: {} for channel_id in channels}
+        self.video_info.update(videos)
+        self.channel_info.update(channels)
+
+
+    def populate_info(self):
+        """
+        Fills the video & channel info array with video / channel data. In
+        pipelined mode most of it has arrived during the crawl, so this only
+        waits for the outstanding batches. A chunk whose requests fail (e.g.
+        the daily quota is used up) is logged and left without metadata; the
+        recommendation tree is saved regardless.
+        """
+        if self.metadata_pipeline is not None:
+            self.logger.info("Waiting for pipelined metadata")
+            self.store_metadata(*self.metadata_pipeline.finish())
+        else:
+            # video information, in chunks so that a streaming crawl never
+            # holds all of the metadata at once
+            chunk_size = 900
+            # (a resumed crawl may have some of it already)
+            self.logger.info("Getting batch video metadata")
+            video_ids = [video_id for video_id in self.search_info
+                         if video_id not in self.video_info]
+            for ix in range(0, len(video_ids), chunk_size):
+                chunk = video_ids[ix: ix + chunk_size]
+                try:
+                    videos = utils.get_metadata(chunk, cache=self.video_cache)
+                except Exception as e:
+                    self.logger.error("Could not get a batch of video metadata: {!r}".format(e))
+                    continue
+                self.store_metadata(videos, {})
+
+            # channel information
+            self.logger.info("Getting batch channel metadata")
+            channel_ids = list(set([vid['channel_id'] for vid in self.video_info.values()])
+                               - set(self.channel_info))
+            for ix in range(0, len(channel_ids), chunk_size):
+                chunk = channel_ids[ix: ix + chunk_size]
+                try:
+                    channels = utils.get_channel_metadata(chunk, cache=self.channel_cache)
+                except Exception as e:
+                    self.logger.error("Could not get a batch of channel metadata: {!r}".format(e))
+                    continue
+                self.store_metadata({}, channels)
+
+        for video_id in self.search_info:
+            if video_id not in self.video_info:
+                self.logger.warning("Could not get metadata for {}".format(video_id))
+        for channel_id in set([vid['channel_id'] for vid in self.video_info.values()]):
+            if channel_id not in self.channel_info:
                 self.logger.warning("Could not get channel metadata for {}".format(channel_id))
-                continue
-            channel_data['search_id'] = self.search_id
-            self.channel_info[channel_id] = channel_data
 
 
     def parse_soup(self, soup):
@@ -150,96 +345,277 @@ class YoutubeFollower():
         return recs
 
 
-    def get_recommendations(self, video_id, depth):
+    def fetch_recommendations(self, video_id):
         """
-        Scrapes the recommendations corresponding to video_id.
+        Downloads and parses the watch page for video_id, unless rec_cache holds
+        a fresh copy. Touches no crawl state, so it is safe to call from worker
+        threads.
 
         INPUT:
             video_id: (str)
-            depth: (int) depth of search
 
         OUTPUT:
             recs: list of recommended video_ids
         """
-
-        # If we're a leaf node, don't get recommendations
-        if depth == self.depth:
-            self.search_info[video_id] = {'search_id': self.search_id,
-                                          'recommendations': [],
-                                          'depth': depth}
-            return []
+        if self.rec_cache is not None:
+            cached = self.rec_cache.get(video_id, self.n_splits)
+            if cached is not None:
+                recs, age = cached
+                self.logger.debug("Cached recommendations for video {} ({:.0f}s old): {}"
+                                  .format(video_id, age, recs))
+                return recs
 
         self.logger.debug("Getting recommendations for {}".format(video_id))
 
-        url = "http://youtube.com/watch?v={}".format(video_id)
-
-        for parser in ['lxml', 'html.parser', 'html5lib']:
-            while True:
-                try:
-                    html = urlopen(url)
+        url = self.watch_url.format(video_id)
+
+        def read(response):
+            return extract.read_recommendations(response, self.n_splits)
+
+        def on_retry(e):
+            self.logger.warning("Error getting html: {}".format(e))
+
+        try:
+            recs, html = self.scheduler.fetch(url, read, on_retry=on_retry)
+        except Exception as e:
+            # not worth retrying, e.g. a 404
+            self.logger.warning("Could not fetch {}: {}".format(url, e))
+            recs, html = [], b''
+
+        # fall back to full parses of the page we already have
+        if len(recs) < self.n_splits:
+            for parser in ['lxml', 'html.parser', 'html5lib']:
+                with self.metrics.timer('parse', parser=parser):
+                    soup = BeautifulSoup(html, parser)
+                    parsed = self.parse_soup(soup)
+                if len(parsed) > len(recs):
+                    recs = parsed
+                if len(recs) == self.n_splits:
+                    self.logger.debug("Recommendations retrieved with parser {}".format(parser))
                     break
-                except:
-                    e = sys.exc_info()[0]
-                    self.logger.warning("Error getting html: {}".format(e))
-                    time.sleep(1)
-            soup = BeautifulSoup(html, parser)
-            recs = self.parse_soup(soup)
-            if len(recs) == self.n_splits:
-                self.logger.debug("Recommendations retrieved with parser {}".format(parser))
-                break
         if len(recs) != self.n_splits:
+            self.metrics.inc('incomplete_pages')
             self.logger.warning("Could not get all recommendations for {}".format(video_id))
+        elif self.rec_cache is not None:
+            self.rec_cache.put(video_id, self.n_splits, recs)
 
         self.logger.debug("Recommendations for video {}: {}".format(video_id, recs))
+        return recs
+
+
+    def record_recommendations(self, video_id, recs, depth):
+        """
+        Samples (if applicable) and stores the recommendations for video_id
+        in search_info.
+
+        INPUT:
+            video_id: (str)
+            recs: list of recommended video_ids, as fetched
+            depth: (int) depth of search
+
+        OUTPUT:
+            recs: list of recommended video_ids to follow
+        """
         # If we're (a) sampling, and (b) at our point of critical depth,
         # hold onto recommendations uniformly at random
         if all([self.sample == True, depth >= self.const_depth, len(recs) != 0]):
-            recs = np.random.choice(recs, 1)
+            recs = self.rng.choice(recs, 1)
             self.logger.debug("Sampled recommendations for video {}: {}".format(video_id, recs))
 
-        self.search_info[video_id] = {'search_id': self.search_id,
-                                      'recommendations': list(recs),
-                                      'depth': depth}
+        if self.writer is not None:
+            info = {video_id: {'recommendations': list(recs), 'depth': depth}}
+            self.writer.add('recommendations', self.recommendation_rows(info))
+        self.search_info.add(video_id, recs, depth)
+        self.metrics.inc('videos_visited')
         return recs
 
+
+    def get_recommendations(self, video_id, depth):
+        """
+        Scrapes the recommendations corresponding to video_id.
+
+        INPUT:
+            video_id: (str)
+            depth: (int) depth of search
+
+        OUTPUT:
+            recs: list of recommended video_ids
+        """
+
+        # If we're a leaf node, don't get recommendations
+        if depth == self.depth:
+            return self.record_recommendations(video_id, [], depth)
+
+        recs = self.fetch_recommendations(video_id)
+        return self.record_recommendations(video_id, recs, depth)
+
+
+    def discover(self, video_ids):
+        """
+        Hands newly discovered videos to the metadata pipeline (if pipelining),
+        storing whatever metadata has arrived in the meantime
+        """
+        if self.metadata_pipeline is not None:
+            self.store_metadata(*self.metadata_pipeline.add_videos(video_ids))
+
+
     def get_recommendation_tree(self):
         """
-        Builds the recommendation tree via BFS. Calls functions to
-        populate video info and search info.
+        Builds the recommendation tree via BFS, one level at a time. The
+        watch pages of a level are fetched by up to n_workers threads;
+        results are recorded in queue order so dedup and sampling behave
+        exactly as in a sequential crawl. When checkpointing, levels are
+        processed in chunks so checkpoints can be taken mid-level.
+        """
+        if self.frontier is None:
+            self.frontier = Frontier(self.root_id, seen=self.search_info)
+            self.discover([self.root_id])
+        frontier = self.frontier
+        chunk_size = None if self.checkpoint_interval is None else 16 * self.n_workers
+
+        with ThreadPoolExecutor(max_workers=self.n_workers) as executor:
+            while frontier:
+                depth, level = frontier.pop_level(chunk_size)
+                if depth > self.depth:
+                    return
+                self.logger.debug("Tree at depth {} ({} videos)".format(depth, len(level)))
+                self.in_flight = deque(level)
+                # If we're at the leaves, don't get recommendations
+                if depth == self.depth:
+                    fetched = [[] for _ in level]
+                else:
+                    fetched = executor.map(bind(self.fetch_recommendations), level)
+
+                # the frontier skips recommendations we've seen before
+                for video_id, recs in zip(level, fetched):
+                    recs = self.record_recommendations(video_id, recs, depth)
+                    self.in_flight.popleft()
+                    frontier.extend(recs)
+                    self.discover(recs)
+
+                if (self.checkpoint_interval is not None
+                    and time.time() - self.last_checkpoint >= self.checkpoint_interval):
+                    self.checkpoint()
+
+
+    def checkpoint(self):
+        """
+        Saves the crawl state (frontier, depth, seen videos, RNG state) under
+        search_id, so that resume can continue from here
+        """
+        if self.frontier is None:
+            return
+        if self.writer is not None:
+            self.writer.flush()
+        frontier = self.frontier.to_dict()
+        frontier['current'] = list(self.in_flight) + frontier['current']
+        name, keys, pos, has_gauss, cached_gaussian = self.rng.get_state()
+        state = {'frontier': frontier,
+                 'search_info': self.search_info.to_dict(),
+                 'video_info': self.video_info.to_dict(),
+                 'channel_info': self.channel_info.to_dict(),
+                 'compact': True,
+                 'rng_state': [name, keys.tolist(), pos, has_gauss, cached_gaussian],
+                 'stream': self.writer is not None,
+                 'rowids': None}
+        if self.writer is not None:
+            # anything written after this point is discarded on resume
+            state['rowids'] = self.db_call(db_utils.max_rowids, self.search_id, STREAMED_TABLES)
+        with self.metrics.timer('checkpoint'):
+            self.db_call(db_utils.save_checkpoint, self.search_id, frontier['depth'], state)
+        self.last_checkpoint = time.time()
+        self.logger.debug("Checkpointed search {} at depth {} ({} videos seen)"
+                          .format(self.search_id, frontier['depth'], len(self.search_info)))
+
+
+    def restore(self, state):
+        """
+        Loads a state saved by checkpoint
 
         INPUT:
-            depth: (int) depth of tree
+            state: (dict) as returned by db_utils.load_checkpoint
         """
-        queue = [self.root_id]
-        inactive_queue = []
-
-        depth = 0
-        while depth <= self.depth:
-            if not queue and not inactive_queue:
-                return
-            if not queue:
-                queue = list(set(inactive_queue))
-                inactive_queue = []
-                depth += 1
-                self.logger.debug("Tree at depth {}".format(depth))
-            current_video = queue.pop(0)
-            recs = self.get_recommendations(current_video, depth)
-            for video_id in recs:
-                # skip video_id if we've seen the recommendation before
-                if video_id in self.search_info or video_id in queue:
-                    continue
-                inactive_queue.append(video_id)
+        if state.get('compact'):
+            self.search_info.load(state['search_info'])
+        else:
+            # checkpoints from before SearchInfo held search_info as a dict
+            self.search_info.update(state['search_info'])
+        self.video_info.update(state['video_info'])
+        self.channel_info.update(state['channel_info'])
+        self.frontier = Frontier.from_dict(state['frontier'], seen=self.search_info)
+        name, keys, pos, has_gauss, cached_gaussian = state['rng_state']
+        self.rng.set_state((name, np.array(keys, dtype=np.uint32), pos, has_gauss,
+                            cached_gaussian))
+        if state['rowids'] is not None:
+            self.db_call(db_utils.delete_after, self.search_id, state['rowids'])
+
+        # metadata requests that were in flight at the checkpoint are lost
+        if self.metadata_pipeline is not None:
+            self.metadata_pipeline.seen_videos.update(self.video_info)
+            self.metadata_pipeline.seen_channels.update(self.channel_info)
+            self.metadata_pipeline.add_channels(
+                [vid['channel_id'] for vid in self.video_info.values()])
+            queued = list(self.frontier.current) + list(self.frontier.next)
+            self.discover([video_id for video_id in list(self.search_info) + queued
+                           if video_id not in self.video_info])
+
+
+    @classmethod
+    def resume(cls, search_id, db_path='data/crawl.sqlite', **kwargs):
+        """
+        Continues an interrupted crawl from its last checkpoint without
+        refetching the videos it had already visited.
+
+        INPUT:
+            search_id: (int) search to continue
+            db_path: (str) where the sqlite database lives
+            kwargs: other constructor arguments (n_workers, caches, ...). The
+                    search parameters come from the searches table, and stream
+                    is set to what the interrupted crawl used
+
+        OUTPUT:
+            yf: the YoutubeFollower, after it has run
+        """
+        conn = db_utils.create_connection(db_path)
+        sql = '''
+        SELECT root_video, n_splits, depth, sample, const_depth FROM searches
+        WHERE search_id = ?'''
+        root_id, n_splits, depth, sample, const_depth = conn.execute(sql, (search_id,)).fetchone()
+        state = db_utils.load_checkpoint(conn, search_id)
+        conn.close()
+        if state is None:
+            raise ValueError("No checkpoint for search {}".format(search_id))
+
+        kwargs['stream'] = state['stream']
+        yf = cls(root_id, n_splits=n_splits, depth=depth, const_depth=const_depth,
+                 sample=str(sample) in ['1', 'True'], db_path=db_path,
+                 search_id=search_id, **kwargs)
+        yf.restore(state)
+        yf.run()
+        return yf
 
 
     def run(self):
+        # API calls, page fetches and database writes outside this class
+        # record to the active metrics of the thread making them
+        with recording(self.metrics):
+            self.crawl()
+
+
+    def crawl(self):
+        """
+        The body of run
+        """
+        start = time.time()
         # some safety checks and directory management
-        if not utils.video_exists(self.root_id):
-            print('Video {} is not available'.format(self.root_id))
-            return
+        resuming = self.frontier is not None
+        if not resuming and not utils.video_exists(self.root_id):
+            # the search is left unfinished, like that of any failed crawl
+            raise VideoUnavailable("Video {} is not available".format(self.root_id))
 
         # set up logger to save to the log folder
-        if not os.path.isdir('logs'):
-            os.mkdir('logs')
+        # (crawls in a batch may race to create it)
+        os.makedirs('logs', exist_ok=True)
         fh = logging.FileHandler(os.path.join('logs',
             '{}_{}.log'.format(self.root_id, str(date.today()))))
         fh.setLevel(logging.DEBUG)
@@ -249,10 +625,39 @@ class YoutubeFollower():
         self.logger.addHandler(fh)
 
         # start running
-        self.logger.info("Starting crawl from root video {}".format(self.root_id))
-        self.get_recommendation_tree()
-        self.populate_info()
-        self.save_results()
+        if resuming:
+            self.logger.info("Resuming search {} from depth {}"
+                             .format(self.search_id, self.frontier.depth))
+        else:
+            self.logger.info("Starting crawl from root video {}".format(self.root_id))
+        try:
+            with self.metrics.timer('recommendation_tree'):
+                self.get_recommendation_tree()
+            with self.metrics.timer('populate_info'):
+                self.populate_info()
+            with self.metrics.timer('save_results'):
+                self.save_results()
+        except BaseException:
+            # save what we have (KeyboardInterrupt included) so we can resume
+            if self.checkpoint_interval is not None:
+                if self.writer is None and self._db is not None:
+                    # without streaming, save_results writes every row in one
+                    # transaction; don't let the checkpoint commit part of it
+                    self._db.rollback()
+                self.checkpoint()
+            raise
+        if self.checkpoint_interval is not None or resuming:
+            self.db_call(db_utils.delete_checkpoint, self.search_id)
+        # only now may readers of the tables treat the search as complete
+        self.db_call(db_utils.finish_search, self.search_id)
+
+        if isinstance(self.metrics, Metrics):
+            self.metrics.write(os.path.join('logs', '{}_{}_{}_metrics.json'.format(
+                                   self.root_id, str(date.today()), self.search_id)),
+                               search_id=self.search_id, root_id=self.root_id,
+                               n_videos=len(self.search_info),
+                               seconds=time.time() - start,
+                               quota_remaining=self.scheduler.remaining_quota())
 
         # shutdown the logger
         for handler in self.logger.handlers:
@@ -260,8 +665,9 @@ class YoutubeFollower():
             self.logger.removeHandler(handler)
 
         # commit and close the cursor
-        self.db.commit()
-        self.db.close()
+        if self._db is not None:
+            self._db.commit()
+            self._db.close()
 
 
 